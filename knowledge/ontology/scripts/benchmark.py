@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for ontology.py on synthetic graphs.
+
+Usage:
+    python benchmark.py generate --records 100000 --out bench/graph.jsonl
+    python benchmark.py run --sizes 10000,100000 --output results.json
+    python benchmark.py run --sizes 1000000 --ops load,get,related --workdir bench
+    python benchmark.py measure --graph bench/graph.jsonl --op query
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import ontology_core as ontology  # noqa: E402
+
+DEFAULT_SIZES = (10_000, 100_000, 1_000_000, 10_000_000)
+OPS = ("load", "snapshot", "load_snapshot", "get", "query", "related", "validate", "append", "append_batch")
+DEFAULT_SAMPLES = 1000
+
+# Type mix of generated entities and the relations each type starts.
+TYPE_WEIGHTS = (("Person", 15), ("Project", 5), ("Task", 60), ("Document", 20))
+RELATIONS = {
+    "Person": (("member_of", "Project"),),
+    "Project": (("has_task", "Task"),),
+    "Task": (("blocks", "Task"), ("assigned_to", "Person")),
+    "Document": (("mentions", None),),
+}
+STATUSES = ("open", "in_progress", "done")
+BENCH_SCHEMA = {
+    "types": {
+        "Person": {"required": ["name"]},
+        "Project": {"required": ["name"], "status_enum": list(STATUSES)},
+        "Task": {"required": ["title", "status"], "status_enum": list(STATUSES)},
+        "Document": {"required": ["title"]},
+    },
+    "relations": {
+        "member_of": {"from_types": ["Person"], "to_types": ["Project"]},
+        "has_task": {"from_types": ["Project"], "to_types": ["Task"], "cardinality": "one_to_many"},
+        "blocks": {"from_types": ["Task"], "to_types": ["Task"], "acyclic": True},
+        "assigned_to": {"from_types": ["Task"], "to_types": ["Person"]},
+        "mentions": {"from_types": ["Document"]},
+    },
+}
+
+
+def _entity_id(type_name: str, number: int) -> str:
+    return f"{type_name.lower()[:4]}_{number:08x}"
+
+
+def _properties(type_name: str, number: int, rng: random.Random) -> dict:
+    if type_name == "Person":
+        return {"name": f"Person {number}", "email": f"p{number}@example.com"}
+    if type_name == "Project":
+        return {"name": f"Project {number}", "status": rng.choice(STATUSES)}
+    if type_name == "Task":
+        return {"title": f"Task {number}", "status": rng.choice(STATUSES), "priority": rng.randint(1, 5)}
+    return {"title": f"Document {number}", "summary": "lorem ipsum dolor sit amet " * rng.randint(2, 12)}
+
+
+def generate(out_path: str, records: int, fanout: float = 2.0, churn: float = 0.5,
+             delete_ratio: float = 0.05, unrelate_ratio: float = 0.1, seed: int = 0) -> dict:
+    """Write a synthetic graph log of `records` records and its schema.
+
+    Per entity, on average: `fanout` relates, `churn` updates and
+    `delete_ratio` deletes; `unrelate_ratio` of the relates are undone
+    later. blocks edges always point to an older task, so the graph stays
+    acyclic. Only per-entity type and liveness bytes are kept in memory.
+    Returns counts of what was written.
+    """
+    rng = random.Random(seed)
+    type_names = [name for name, _ in TYPE_WEIGHTS]
+    type_weights = [weight for _, weight in TYPE_WEIGHTS]
+    ops = ("create", "relate", "unrelate", "update", "delete")
+    op_weights = (1.0, fanout, fanout * unrelate_ratio, churn, delete_ratio)
+    kinds = bytearray()      # entity number -> index into type_names
+    alive = bytearray()      # entity number -> 1 while not deleted
+    by_type = {name: [] for name in type_names}
+    related = []             # recent relation keys that unrelate may pick
+    counts = dict.fromkeys(ops, 0)
+    moment = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+    def pick(type_name=None):
+        pool = by_type[type_name] if type_name else range(len(kinds))
+        for _ in range(8):
+            number = pool[rng.randrange(len(pool))] if pool else None
+            if number is not None and alive[number]:
+                return number
+        return None
+
+    Path(out_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(out_path, "w") as f:
+        written = 0
+        while written < records:
+            op = "create" if len(kinds) < 100 else rng.choices(ops, op_weights)[0]
+            moment += timedelta(seconds=1)
+            timestamp = moment.isoformat()
+            if op == "create":
+                number = len(kinds)
+                kind = rng.choices(range(len(type_names)), type_weights)[0]
+                type_name = type_names[kind]
+                kinds.append(kind)
+                alive.append(1)
+                by_type[type_name].append(number)
+                entity = {
+                    "id": _entity_id(type_name, number),
+                    "type": type_name,
+                    "properties": _properties(type_name, number, rng),
+                    "created": timestamp,
+                    "updated": timestamp,
+                }
+                record = {"op": "create", "entity": entity, "timestamp": timestamp}
+            elif op == "relate":
+                source = pick()
+                if source is None:
+                    continue
+                source_type = type_names[kinds[source]]
+                rel_type, target_type = rng.choice(RELATIONS[source_type])
+                target = pick(target_type)
+                if target is None or target == source:
+                    continue
+                if rel_type == "blocks" and target > source:
+                    source, target = target, source
+                key = (_entity_id(type_names[kinds[source]], source), rel_type,
+                       _entity_id(type_names[kinds[target]], target))
+                if len(related) < 100_000:
+                    related.append(key)
+                else:
+                    related[rng.randrange(len(related))] = key
+                record = {"op": "relate", "from": key[0], "rel": rel_type, "to": key[2],
+                          "properties": {}, "timestamp": timestamp}
+            elif op == "unrelate":
+                if not related:
+                    continue
+                index = rng.randrange(len(related))
+                related[index], related[-1] = related[-1], related[index]
+                from_id, rel_type, to_id = related.pop()
+                record = {"op": "unrelate", "from": from_id, "rel": rel_type, "to": to_id,
+                          "timestamp": timestamp}
+            else:
+                number = pick()
+                if number is None:
+                    continue
+                entity_id = _entity_id(type_names[kinds[number]], number)
+                if op == "update":
+                    properties = {"status": rng.choice(STATUSES), "revision": rng.randint(1, 99)}
+                    record = {"op": "update", "id": entity_id, "properties": properties,
+                              "timestamp": timestamp}
+                else:
+                    alive[number] = 0
+                    record = {"op": "delete", "id": entity_id, "timestamp": timestamp}
+            f.write(json.dumps(record) + "\n")
+            counts[op] += 1
+            written += 1
+
+    # JSON is valid YAML, so the schema needs no YAML writer.
+    with open(schema_for(out_path), "w") as f:
+        json.dump(BENCH_SCHEMA, f, indent=2)
+    return {"records": written, "bytes": os.path.getsize(out_path), "ops": counts,
+            "entities": len(kinds), "live_entities": sum(alive)}
+
+
+def schema_for(graph_path: str) -> Path:
+    """Schema file written next to a generated graph."""
+    return Path(graph_path).with_name("schema.yaml")
+
+
+def _timed(fn, repeat: int = 1) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return time.perf_counter() - start
+
+
+def measure(graph_path: str, op: str, samples: int = DEFAULT_SAMPLES, seed: int = 0) -> dict:
+    """Time one operation against graph_path in this process.
+
+    load/load_snapshot time a cold load; snapshot times writing one. The
+    lookup ops (get, query, related) and validate first load the graph into
+    a warm state cache, as `serve` would, and time only the operations;
+    the load is reported as setup_s. append/append_batch write to a fresh
+    log next to graph_path (one fsync per record, or per 1000 records).
+    """
+    os.environ[ontology.SNAPSHOT_THRESHOLD_ENV] = "0"  # Never refresh snapshots mid-run.
+    result = {"op": op}
+    rng = random.Random(seed)
+
+    if op in ("load", "load_snapshot"):
+        wall = _timed(lambda: ontology.load_graph_state(graph_path))
+        result.update(wall_s=wall, ops=1)
+    elif op == "snapshot":
+        wall = _timed(lambda: ontology.refresh_snapshot(graph_path))
+        result.update(wall_s=wall, ops=1)
+    elif op in ("append", "append_batch"):
+        with tempfile.TemporaryDirectory(dir=Path(graph_path).parent) as tmp:
+            log = str(Path(tmp) / "append.jsonl")
+            if op == "append":
+                wall = _timed(lambda: ontology.create_entity("Task", {"title": "x", "status": "open"}, log),
+                              samples)
+            else:
+                now = datetime.now(timezone.utc).isoformat()
+                batch = [{"op": "create", "entity": {"id": f"bench_{i}", "type": "Task",
+                                                     "properties": {"title": "x", "status": "open"},
+                                                     "created": now, "updated": now},
+                          "timestamp": now}
+                         for i in range(1000)]
+                rounds = max(samples // 1000, 1)
+                wall = _timed(lambda: ontology.append_ops(log, batch), rounds)
+                samples = rounds * 1000
+        result.update(wall_s=wall, ops=samples)
+    else:
+        ontology._STATE_CACHE = {}
+        setup = _timed(lambda: ontology.load_graph_state(graph_path))
+        graph = ontology.load_graph_state(graph_path)
+        ids = list(graph.entities)
+        picks = [ids[rng.randrange(len(ids))] for _ in range(samples)] if ids else []
+        if op == "get":
+            wall = _timed(lambda: [ontology.get_entity(entity_id, graph_path) for entity_id in picks])
+        elif op == "related":
+            wall = _timed(lambda: [ontology.get_related(entity_id, None, graph_path, "both")
+                                   for entity_id in picks])
+        elif op == "query":
+            samples = max(samples // 100, 1)
+            wall = _timed(lambda: ontology.query_entities("Task", {"status": "open"}, graph_path), samples)
+            result["matches"] = len(ontology.query_entities("Task", {"status": "open"}, graph_path))
+        elif op == "validate":
+            samples = 1
+            errors = []
+            wall = _timed(lambda: errors.extend(ontology.validate_graph(graph_path, str(schema_for(graph_path)))))
+            result["errors"] = len(errors)
+        else:
+            raise SystemExit(f"Unknown op: {op}")
+        result.update(wall_s=wall, ops=samples, setup_s=setup)
+
+    if result["ops"]:
+        result["per_op_us"] = result["wall_s"] / result["ops"] * 1e6
+        result["ops_per_s"] = result["ops"] / result["wall_s"] if result["wall_s"] else None
+    result["peak_rss_kb"] = ontology.peak_rss_kb()
+    return result
+
+
+def _measure_subprocess(graph_path: str, op: str, samples: int, seed: int) -> dict:
+    """Run measure() in a fresh interpreter so peak RSS belongs to this op alone."""
+    command = [sys.executable, str(Path(__file__).resolve()), "measure",
+               "--graph", graph_path, "--op", op, "--samples", str(samples), "--seed", str(seed)]
+    proc = subprocess.run(command, capture_output=True, text=True)
+    if proc.returncode != 0:
+        return {"op": op, "error": proc.stderr.strip().splitlines()[-1:] or [f"exit {proc.returncode}"]}
+    return json.loads(proc.stdout)
+
+
+def environment() -> dict:
+    """What the numbers depend on, so results from different runs can be compared."""
+    source = Path(ontology.__file__).read_bytes()
+    return {
+        "ontology_sha1": hashlib.sha1(source).hexdigest(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "env": {name: os.environ[name] for name in (
+            ontology.WORKERS_ENV, ontology.COMPACT_STORE_ENV, ontology.LAZY_PROPERTIES_ENV,
+        ) if name in os.environ},
+    }
+
+
+def run(sizes, ops, workdir: str, samples: int, seed: int, generator: dict) -> dict:
+    """Generate (or reuse) a graph per size and measure each op on it."""
+    results = []
+    for size in sizes:
+        params = {"records": size, "seed": seed, **generator}
+        digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:10]
+        graph_path = str(Path(workdir) / f"graph-{size}-{digest}" / "graph.jsonl")
+        info_file = Path(graph_path).with_name("generated.json")
+        if info_file.exists():
+            info = json.loads(info_file.read_text())
+        else:
+            print(f"generating {size} records -> {graph_path}", file=sys.stderr)
+            started = time.perf_counter()
+            info = generate(graph_path, size, seed=seed, **generator)
+            info["generate_s"] = time.perf_counter() - started
+            info_file.write_text(json.dumps(info, indent=2))
+        ontology.snapshot_path(graph_path).unlink(missing_ok=True)
+        for op in ops:
+            if op in ("get", "query", "related", "validate", "load_snapshot") \
+                    and not ontology.snapshot_path(graph_path).exists():
+                # Lookups start from a snapshot, as they would in practice.
+                _measure_subprocess(graph_path, "snapshot", samples, seed)
+            print(f"  {size}: {op}", file=sys.stderr)
+            result = _measure_subprocess(graph_path, op, samples, seed)
+            results.append({"records": size, "bytes": info["bytes"], "live_entities": info["live_entities"],
+                            **result})
+            if op == "load":
+                # A later load_snapshot needs the snapshot that load was not allowed to write.
+                ontology.snapshot_path(graph_path).unlink(missing_ok=True)
+    return {"environment": environment(), "generator": {"seed": seed, **generator}, "results": results}
+
+
+def parse_sizes(raw: str) -> list:
+    try:
+        return [int(float(size)) for size in raw.split(",") if size.strip()]
+    except ValueError:
+        raise SystemExit(f"Invalid --sizes: {raw!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ontology.py on synthetic graphs")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_generator_args(p):
+        p.add_argument("--fanout", type=float, default=2.0, help="Relates per entity")
+        p.add_argument("--churn", type=float, default=0.5, help="Updates per entity")
+        p.add_argument("--delete-ratio", type=float, default=0.05, help="Share of entities deleted")
+        p.add_argument("--unrelate-ratio", type=float, default=0.1, help="Share of relates undone")
+        p.add_argument("--seed", type=int, default=0)
+
+    gen_p = subparsers.add_parser("generate", help="Write a synthetic graph log")
+    gen_p.add_argument("--records", type=int, required=True)
+    gen_p.add_argument("--out", required=True, help="Graph log to write")
+    add_generator_args(gen_p)
+
+    run_p = subparsers.add_parser("run", help="Generate graphs and measure operations")
+    run_p.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES),
+                       help="Comma-separated record counts")
+    run_p.add_argument("--ops", default=",".join(OPS), help=f"Comma-separated subset of {', '.join(OPS)}")
+    run_p.add_argument("--workdir", default=None, help="Where graphs are generated and reused (default: temp dir)")
+    run_p.add_argument("--samples", type=int, default=DEFAULT_SAMPLES, help="Operations timed per lookup op")
+    run_p.add_argument("--output", "-o", default=None, help="Write results here instead of stdout")
+    add_generator_args(run_p)
+
+    measure_p = subparsers.add_parser("measure", help="Time one operation on an existing graph")
+    measure_p.add_argument("--graph", required=True)
+    measure_p.add_argument("--op", required=True, choices=OPS)
+    measure_p.add_argument("--samples", type=int, default=DEFAULT_SAMPLES)
+    measure_p.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        info = generate(args.out, args.records, args.fanout, args.churn, args.delete_ratio,
+                        args.unrelate_ratio, args.seed)
+        print(json.dumps(info, indent=2))
+
+    elif args.command == "measure":
+        print(json.dumps(measure(args.graph, args.op, args.samples, args.seed)))
+
+    elif args.command == "run":
+        ops = [op for op in args.ops.split(",") if op]
+        unknown = [op for op in ops if op not in OPS]
+        if unknown:
+            raise SystemExit(f"Unknown ops: {', '.join(unknown)}")
+        generator = {"fanout": args.fanout, "churn": args.churn, "delete_ratio": args.delete_ratio,
+                     "unrelate_ratio": args.unrelate_ratio}
+        with tempfile.TemporaryDirectory() as tmp:
+            report = run(parse_sizes(args.sizes), ops, args.workdir or tmp, args.samples, args.seed,
+                         generator)
+        text = json.dumps(report, indent=2)
+        if args.output:
+            Path(args.output).write_text(text + "\n")
+        else:
+            print(text)
+
+
+if __name__ == "__main__":
+    main()
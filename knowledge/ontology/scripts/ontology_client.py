@@ -0,0 +1,138 @@
+"""
+Thin client for ontology.py: hands a command to a running `serve` process.
+
+Only json and os are imported up front (socket once a socket file exists),
+so a command answered by the server costs an interpreter start plus one
+round trip. Anything the server
+cannot take (no server running, --stats/--profile, SQLite graphs, watch,
+serve itself) runs locally through ontology_core.
+"""
+
+import json
+import os
+import sys
+
+DEFAULT_GRAPH_PATH = "memory/ontology/graph.jsonl"
+BACKEND_ENV = "ONTOLOGY_BACKEND"
+SQLITE_SUFFIXES = (".db", ".sqlite", ".sqlite3")
+NO_SERVER_ENV = "ONTOLOGY_NO_SERVER"
+# Per-phase timings on stderr (--stats) and cProfile dumps (--profile).
+STATS_ENV = "ONTOLOGY_STATS"
+PROFILE_ENV = "ONTOLOGY_PROFILE"
+
+# Commands that never take --graph, or gain nothing from the server: watch
+# only tails the file and export reads a SQLite graph.
+LOCAL_COMMANDS = ("serve", "watch", "export", "schema-append")
+
+
+def socket_path(graph_path: str) -> str:
+    """Return the Unix socket a `serve` process for graph_path listens on."""
+    sock_file = f"{graph_path}.sock"
+    # AF_UNIX paths are limited to ~104 bytes; fall back to a hashed temp path.
+    if len(sock_file) > 100:
+        import hashlib
+        import tempfile
+        digest = hashlib.sha1(str(graph_path).encode()).hexdigest()[:16]
+        sock_file = os.path.join(tempfile.gettempdir(), f"ontology-{digest}.sock")
+    return sock_file
+
+
+def connect(sock_file: str) -> "socket.socket | None":
+    # Imported here: with no socket file there is nothing to connect to.
+    import socket
+    
+    try:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    except (AttributeError, OSError):
+        return None  # No AF_UNIX on this platform.
+    try:
+        conn.connect(str(sock_file))
+    except OSError:
+        conn.close()
+        return None
+    return conn
+
+
+def _option(args: list, long: str, short: str = None) -> str | None:
+    """The value given for an option (last one wins), or None."""
+    value = None
+    for position, arg in enumerate(args):
+        if arg in (long, short) and position + 1 < len(args):
+            value = args[position + 1]
+        elif arg.startswith(long + "="):
+            value = arg[len(long) + 1:]
+        elif short and arg.startswith(short) and len(arg) > len(short) and not arg.startswith("--"):
+            value = arg[len(short):]
+    return value
+
+
+def server_graph(argv: list) -> str | None:
+    """The resolved graph path whose server may answer argv, or None to run locally.
+
+    Looks only at what decides that: global options (any of them, e.g.
+    --stats or --profile, means a local run), the command, --graph and
+    --backend. The server parses argv in full itself.
+    """
+    if not argv or argv[0].startswith("-") or argv[0] in LOCAL_COMMANDS:
+        return None
+    if os.environ.get(NO_SERVER_ENV) or os.environ.get(STATS_ENV, "") not in ("", "0"):
+        return None
+    if os.environ.get(PROFILE_ENV):
+        return None
+    args = argv[1:]
+    if "-h" in args or "--help" in args:
+        return None
+    backend = _option(args, "--backend") or os.environ.get(BACKEND_ENV)
+    graph = _option(args, "--graph", "-g") or DEFAULT_GRAPH_PATH
+    if backend == "sqlite" or os.path.splitext(graph)[1].lower() in SQLITE_SUFFIXES:
+        return None  # `serve` only serves JSONL logs.
+    return os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(graph)))
+
+
+def forward_to_server(graph_path: str, argv: list, stdin_data: str = None) -> int | None:
+    """Run argv on the `serve` process for graph_path, if one is running.
+
+    Returns the command's exit code, or None when no server answered and the
+    command should run locally.
+    """
+    sock_file = socket_path(graph_path)
+    if not os.path.exists(sock_file):
+        return None
+    conn = connect(sock_file)
+    if conn is None:
+        return None
+    with conn, conn.makefile("rwb") as stream:
+        request = {"argv": list(argv), "cwd": os.getcwd()}
+        if stdin_data is not None:
+            request["stdin"] = stdin_data
+        stream.write((json.dumps(request) + "\n").encode())
+        stream.flush()
+        for line in stream:
+            message = json.loads(line)
+            if "exit" in message:
+                return message["exit"]
+            if "stdout" in message:
+                sys.stdout.write(message["stdout"])
+            if "stderr" in message:
+                sys.stderr.write(message["stderr"])
+    print(f"Ontology server at {sock_file} closed the connection", file=sys.stderr)
+    return 1
+
+
+def main(argv: list = None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    graph_path = server_graph(argv)
+    if graph_path is not None:
+        stdin_data = None
+        if argv[0] == "batch" and _option(argv[1:], "--file", "-f") is None:
+            # The server cannot read our stdin, so ship it with the request.
+            stdin_data = sys.stdin.read()
+        code = forward_to_server(graph_path, argv, stdin_data)
+        if code is not None:
+            raise SystemExit(code)
+        if stdin_data is not None:
+            import io
+            sys.stdin = io.StringIO(stdin_data)
+
+    import ontology_core
+    ontology_core.main(argv)
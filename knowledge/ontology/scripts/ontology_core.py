@@ -0,0 +1,4606 @@
+"""
+Ontology graph operations: create, query, relate, validate.
+
+The implementation behind ontology.py (see there for usage). Commands that
+a running `serve` process can answer are forwarded by ontology_client
+before this module is imported.
+"""
+
+import argparse
+import collections
+import collections.abc
+import contextlib
+import gc
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import math
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from ontology_client import (
+    BACKEND_ENV,
+    DEFAULT_GRAPH_PATH,
+    PROFILE_ENV,
+    SQLITE_SUFFIXES,
+    STATS_ENV,
+    connect,
+    socket_path,
+)
+
+try:
+    import fcntl
+except ImportError:  # Windows: writers lock with msvcrt instead.
+    fcntl = None
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+try:
+    import resource
+except ImportError:  # Windows: peak memory is not reported.
+    resource = None
+
+DEFAULT_SCHEMA_PATH = "memory/ontology/schema.yaml"
+
+# Files rewritten through a temp file get the mode a plain open() would give
+# them (mkstemp creates 0600); read once, before any server thread starts.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_THRESHOLD_ENV = "ONTOLOGY_SNAPSHOT_BYTES"
+DEFAULT_SNAPSHOT_THRESHOLD = 8 * 1024 * 1024
+# Snapshots at least this far apart are also kept as checkpoints for --as-of.
+CHECKPOINT_BYTES_ENV = "ONTOLOGY_CHECKPOINT_BYTES"
+DEFAULT_CHECKPOINT_BYTES = 64 * 1024 * 1024
+
+COMPACT_STORE_ENV = "ONTOLOGY_COMPACT"
+
+# Lazy property decoding: create records on lines of at least LAZY_MIN_BYTES
+# keep their properties as a byte span into the file (see LazyEntities).
+LAZY_PROPERTIES_ENV = "ONTOLOGY_LAZY"
+LAZY_MIN_BYTES = 16 * 1024
+
+# Parallel parsing of large logs and snapshots (see iter_records).
+WORKERS_ENV = "ONTOLOGY_WORKERS"
+PARALLEL_MIN_BYTES = 64 * 1024 * 1024
+PARALLEL_CHUNK_BYTES = 8 * 1024 * 1024
+
+VALIDATION_STATE_FORMAT = 2
+SCHEMA_CACHE_FORMAT = 1
+
+WHERE_OPERATORS = ("$eq", "$ne", "$gt", "$gte", "$lt", "$lte", "$in", "$nin", "$prefix", "$exists")
+
+BATCH_OPS = ("create", "update", "delete", "relate", "unrelate")
+
+SQLITE_FORMAT = 1
+SQLITE_SCHEMA = """
+CREATE TABLE entities (
+    seq INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    type TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX entities_by_type ON entities (type, seq);
+CREATE TABLE properties (
+    entity_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value,
+    PRIMARY KEY (entity_id, key)
+) WITHOUT ROWID;
+CREATE INDEX properties_by_value ON properties (key, value);
+CREATE TABLE relations (
+    seq INTEGER PRIMARY KEY,
+    from_id TEXT NOT NULL,
+    rel TEXT NOT NULL,
+    to_id TEXT NOT NULL,
+    properties TEXT NOT NULL
+);
+CREATE INDEX relations_out ON relations (from_id, rel, to_id);
+CREATE INDEX relations_in ON relations (to_id, rel, from_id);
+"""
+# Commands that only make sense on the JSONL log.
+JSONL_ONLY_COMMANDS = ("snapshot", "compact", "index", "watch", "serve", "migrate", "search")
+
+# Full-text search index kept next to the log (see SearchIndex).
+SEARCH_FORMAT = 1
+SEARCH_SCHEMA = """
+CREATE TABLE meta (
+    key TEXT PRIMARY KEY,
+    value
+) WITHOUT ROWID;
+CREATE TABLE docs (
+    doc INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    type TEXT,
+    length INTEGER NOT NULL,
+    fields TEXT NOT NULL
+);
+CREATE TABLE terms (
+    term TEXT PRIMARY KEY,
+    df INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE postings (
+    term TEXT NOT NULL,
+    doc INTEGER NOT NULL,
+    tf INTEGER NOT NULL,
+    PRIMARY KEY (term, doc)
+) WITHOUT ROWID;
+"""
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Words, with each CJK character a token of its own.
+_CJK = "\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff"
+_TOKEN = re.compile(f"[{_CJK}]|[^\\W_{_CJK}]+")
+
+SERVER_OUTPUT_CHUNK = 64 * 1024
+# Commands that write through commit(); the server runs them without holding
+# _STATE_LOCK so that concurrent writers can share one group commit.
+WRITE_COMMANDS = ("create", "update", "delete", "relate", "batch")
+
+# Graph path -> Graph kept warm between commands; only enabled by `serve`.
+_STATE_CACHE = None
+# Serializes access to the cached graphs between server threads.
+_STATE_LOCK = threading.RLock()
+# Graph path -> _GroupCommit queue shared by the writers in this process.
+_COMMITTERS = {}
+_COMMITTERS_LOCK = threading.Lock()
+# Schema path -> ((mtime_ns, size), CompiledSchema) for this process.
+_COMPILED_SCHEMAS = {}
+# SQLite graph path -> ((st_dev, st_ino), SqliteGraph) shared by the readers
+# in this process.
+_SQLITE_GRAPHS = {}
+_SQLITE_GRAPHS_LOCK = threading.Lock()
+# CommandStats of the running command; only set by --stats.
+_STATS = None
+
+
+def resolve_safe_path(
+    user_path: str,
+    *,
+    root: Path | None = None,
+    must_exist: bool = False,
+    label: str = "path",
+) -> Path:
+    """Resolve user path within root and reject traversal outside it."""
+    if not user_path or not user_path.strip():
+        raise SystemExit(f"Invalid {label}: empty path")
+
+    safe_root = (root or Path.cwd()).resolve()
+    candidate = Path(user_path).expanduser()
+    if not candidate.is_absolute():
+        candidate = safe_root / candidate
+
+    try:
+        resolved = candidate.resolve(strict=False)
+    except OSError as exc:
+        raise SystemExit(f"Invalid {label}: {exc}") from exc
+
+    try:
+        resolved.relative_to(safe_root)
+    except ValueError:
+        raise SystemExit(
+            f"Invalid {label}: must stay within workspace root '{safe_root}'"
+        )
+
+    if must_exist and not resolved.exists():
+        raise SystemExit(f"Invalid {label}: file not found '{resolved}'")
+
+    return resolved
+
+
+def generate_id(type_name: str) -> str:
+    """Generate a unique ID for an entity."""
+    prefix = type_name.lower()[:4]
+    suffix = uuid.uuid4().hex[:8]
+    return f"{prefix}_{suffix}"
+
+
+def snapshot_path(graph_path: str) -> Path:
+    """Return the snapshot file that accompanies a graph log."""
+    return Path(f"{graph_path}.snapshot")
+
+
+def checkpoints_path(graph_path: str) -> Path:
+    """Return the directory of checkpoints kept for --as-of queries."""
+    return Path(f"{graph_path}.checkpoints")
+
+
+def snapshot_threshold() -> int:
+    """Log bytes allowed past the snapshot before load_graph refreshes it (0 disables)."""
+    raw = os.environ.get(SNAPSHOT_THRESHOLD_ENV)
+    if not raw:
+        return DEFAULT_SNAPSHOT_THRESHOLD
+    try:
+        return max(int(raw), 0)
+    except ValueError:
+        raise SystemExit(f"Invalid {SNAPSHOT_THRESHOLD_ENV}: {raw!r}")
+
+
+def checkpoint_interval() -> int:
+    """Log bytes between kept checkpoints (0 disables them)."""
+    raw = os.environ.get(CHECKPOINT_BYTES_ENV)
+    if not raw:
+        return DEFAULT_CHECKPOINT_BYTES
+    try:
+        return max(int(raw), 0)
+    except ValueError:
+        raise SystemExit(f"Invalid {CHECKPOINT_BYTES_ENV}: {raw!r}")
+
+
+def compact_store_enabled() -> bool:
+    """Whether loaded graphs keep entities in a CompactEntities store."""
+    return os.environ.get(COMPACT_STORE_ENV, "") not in ("", "0")
+
+
+def lazy_properties_enabled() -> bool:
+    """Whether loaded graphs leave large property objects undecoded."""
+    return os.environ.get(LAZY_PROPERTIES_ENV, "") not in ("", "0")
+
+
+def parse_workers() -> int:
+    """Worker processes for parsing large files (1 parses in-process)."""
+    raw = os.environ.get(WORKERS_ENV)
+    if not raw:
+        return os.cpu_count() or 1
+    try:
+        return max(int(raw), 1)
+    except ValueError:
+        raise SystemExit(f"Invalid {WORKERS_ENV}: {raw!r}")
+
+
+def lock_path(graph_path: str) -> Path:
+    """Return the lock file writers of a graph log hold while appending."""
+    return Path(f"{graph_path}.lock")
+
+
+def index_path(graph_path: str) -> Path:
+    """Return the file declaring the property indexes of a graph log."""
+    return Path(f"{graph_path}.indexes")
+
+
+def load_index_specs(graph_path: str) -> list:
+    """Return the declared (type, property) indexes for a graph log."""
+    spec_file = index_path(graph_path)
+    if not spec_file.exists():
+        return []
+    with open(spec_file) as f:
+        return [tuple(spec) for spec in json.load(f).get("indexes", [])]
+
+
+def write_index_specs(graph_path: str, specs: list) -> None:
+    """Persist the declared (type, property) indexes for a graph log."""
+    spec_file = index_path(graph_path)
+    spec_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(spec_file, "w") as f:
+        json.dump({"indexes": [list(spec) for spec in specs]}, f, indent=2)
+
+
+def _index_key(value):
+    """Hashable bucket key for a property value (lists/dicts by canonical JSON)."""
+    try:
+        hash(value)
+    except TypeError:
+        return ("json", json.dumps(value, sort_keys=True))
+    return value
+
+
+def _index_value(key):
+    """Inverse of _index_key, used when persisting buckets."""
+    if isinstance(key, tuple):
+        return json.loads(key[1])
+    return key
+
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
+# Top-level entity layout the compact store can reproduce exactly.
+_ENTITY_KEYS = ("id", "type", "properties", "created", "updated")
+
+
+# _EntityRecord.micros bits: which timestamps are stored as microseconds.
+_CREATED_MICROS = 1
+_UPDATED_MICROS = 2
+
+
+def _encode_timestamp(value):
+    """UTC ISO timestamp -> microseconds since the epoch, or None if that would not round-trip."""
+    if not isinstance(value, str):
+        return None
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if moment.utcoffset() != timedelta(0):
+        return None
+    micros = (moment - _EPOCH) // _MICROSECOND
+    return micros if _decode_timestamp(micros) == value else None
+
+
+def _decode_timestamp(micros: int) -> str:
+    return (_EPOCH + micros * _MICROSECOND).isoformat()
+
+
+class _EntityRecord:
+    __slots__ = ("type", "keys", "values", "created", "updated", "micros")
+
+
+class CompactEntities(collections.abc.MutableMapping):
+    """Entity id -> entity map that keeps slotted records instead of dicts.
+
+    Type names and property key tuples are interned, property values sit
+    in a tuple and ISO timestamps are stored as integer microseconds. Reading
+    an entity decodes a fresh dict identical to the one stored; entities
+    with an unusual layout are kept as plain dicts.
+    """
+
+    def __init__(self):
+        self._records = {}
+        self._shapes = {}
+
+    def _encode(self, entity_id, entity):
+        if tuple(entity) != _ENTITY_KEYS or entity["id"] != entity_id:
+            return entity
+        record = _EntityRecord()
+        record.type = sys.intern(entity["type"]) if isinstance(entity["type"], str) else entity["type"]
+        keys = tuple(entity["properties"])
+        record.keys = self._shapes.setdefault(keys, keys)
+        record.values = tuple(entity["properties"].values())
+        # Only timestamps that decode back identically are converted, and
+        # micros says which: any other value (an int, say) is kept as is.
+        record.micros = 0
+        micros = _encode_timestamp(entity["created"])
+        if micros is None:
+            record.created = entity["created"]
+        else:
+            record.created = micros
+            record.micros |= _CREATED_MICROS
+        if entity["updated"] == entity["created"]:
+            record.updated = record.created
+            if micros is not None:
+                record.micros |= _UPDATED_MICROS
+            return record
+        micros = _encode_timestamp(entity["updated"])
+        if micros is None:
+            record.updated = entity["updated"]
+        else:
+            record.updated = micros
+            record.micros |= _UPDATED_MICROS
+        return record
+
+    @staticmethod
+    def _decode(entity_id, record):
+        if not isinstance(record, _EntityRecord):
+            return record
+        return {
+            "id": entity_id,
+            "type": record.type,
+            "properties": dict(zip(record.keys, record.values)),
+            "created": _decode_timestamp(record.created) if record.micros & _CREATED_MICROS else record.created,
+            "updated": _decode_timestamp(record.updated) if record.micros & _UPDATED_MICROS else record.updated,
+        }
+
+    def __getitem__(self, entity_id):
+        return self._decode(entity_id, self._records[entity_id])
+
+    def __setitem__(self, entity_id, entity):
+        self._records[entity_id] = self._encode(entity_id, entity)
+
+    def __delitem__(self, entity_id):
+        del self._records[entity_id]
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, entity_id):
+        return entity_id in self._records
+
+    def get(self, entity_id, default=None):
+        record = self._records.get(entity_id)
+        return default if record is None else self._decode(entity_id, record)
+
+    def values_of_type(self, type_name: str):
+        """Decode only the entities of one type."""
+        for entity_id, record in self._records.items():
+            if isinstance(record, _EntityRecord):
+                if record.type == type_name:
+                    yield self._decode(entity_id, record)
+            elif record["type"] == type_name:
+                yield record
+
+
+class _RawSource:
+    """A file that lazily decoded properties are read back from.
+
+    Holds its own handle, so the bytes stay readable after the log or
+    snapshot is replaced by a rewrite.
+    """
+
+    def __init__(self, f):
+        self.file = f
+        self.lock = threading.Lock()
+
+    def read(self, offset: int, size: int) -> bytes:
+        if _STATS is not None:
+            _STATS.bytes_read["lazy"] += size
+        with self.lock:
+            return _read_at(self.file.fileno(), size, offset)
+
+
+class RawProperties:
+    """Properties object left undecoded: `size` bytes at `offset` of source."""
+
+    __slots__ = ("offset", "size", "source")
+
+    def __init__(self, offset: int, size: int):
+        self.offset = offset
+        self.size = size
+        self.source = None
+
+    def __getstate__(self):
+        return self.offset, self.size
+
+    def __setstate__(self, state):
+        self.offset, self.size = state
+        self.source = None
+
+    def decode(self) -> dict:
+        return json.loads(self.source.read(self.offset, self.size))
+
+
+def _properties_of(entity: dict) -> dict:
+    """An entity's properties, decoding them if they were left raw."""
+    properties = entity["properties"]
+    if isinstance(properties, RawProperties):
+        return properties.decode()
+    return properties
+
+
+class LazyEntities(collections.abc.MutableMapping):
+    """Entity id -> entity map that decodes raw properties on access.
+
+    Entities whose properties were loaded as RawProperties are kept as
+    skeleton dicts; reading one decodes a fresh dict, so ids, types and
+    membership never touch the properties bytes. Nothing is cached: an
+    entity that is read twice is decoded twice.
+    """
+
+    def __init__(self):
+        self._entities = {}
+
+    @staticmethod
+    def _decode(entity):
+        if isinstance(entity, dict) and isinstance(entity.get("properties"), RawProperties):
+            return {**entity, "properties": entity["properties"].decode()}
+        return entity
+
+    def __getitem__(self, entity_id):
+        return self._decode(self._entities[entity_id])
+
+    def __setitem__(self, entity_id, entity):
+        self._entities[entity_id] = entity
+
+    def __delitem__(self, entity_id):
+        del self._entities[entity_id]
+
+    def __iter__(self):
+        return iter(self._entities)
+
+    def __len__(self):
+        return len(self._entities)
+
+    def __contains__(self, entity_id):
+        return entity_id in self._entities
+
+    def get(self, entity_id, default=None):
+        entity = self._entities.get(entity_id)
+        return default if entity is None else self._decode(entity)
+
+    def values_of_type(self, type_name: str):
+        """Decode only the entities of one type."""
+        for entity in self._entities.values():
+            if entity["type"] == type_name:
+                yield self._decode(entity)
+
+
+class _TopologicalOrder:
+    """Positions of the nodes of one relation type, every edge going upwards."""
+
+    __slots__ = ("positions", "low", "high")
+
+    def __init__(self, positions: dict):
+        self.positions = positions
+        self.low = 0
+        self.high = len(positions) - 1
+
+
+def _reachable(successors, start, keep) -> set:
+    """start and the nodes reachable from it through nodes for which keep(node) holds."""
+    seen = {start}
+    stack = [start]
+    while stack:
+        for other in successors(stack.pop()):
+            if other not in seen and keep(other):
+                seen.add(other)
+                stack.append(other)
+    return seen
+
+
+def _reaches(successors, start, target, keep=None) -> bool:
+    """Whether target is reachable from start (only passing nodes for which keep holds)."""
+    seen = {start}
+    stack = [start]
+    while stack:
+        for other in successors(stack.pop()):
+            if other == target:
+                return True
+            if other not in seen and (keep is None or keep(other)):
+                seen.add(other)
+                stack.append(other)
+    return False
+
+
+class Graph:
+    """Materialized graph state: entities, relations and adjacency maps.
+
+    Relations are stored as a multiset keyed by (from, rel, to): each key maps
+    to the list of property dicts of its parallel edges, in insertion order,
+    and a matching list of relate sequence numbers, so relations can still
+    be listed in log order. That keeps relate/unrelate O(1) during replay.
+    outgoing/incoming map entity id -> relation type -> other
+    id -> the same property list, so neighborhood lookups cost O(degree).
+
+    indexes holds the declared (type, property) hash indexes: property value
+    -> ids of entities of that type carrying it (a missing property is
+    indexed as None, matching how query compares it).
+
+    With compact=True (default: compact_store_enabled()) entities live in a
+    CompactEntities store, which trades decoding on access for memory.
+    With lazy=True (default: lazy_properties_enabled()) large properties are
+    loaded as RawProperties into a LazyEntities store instead; it takes
+    precedence over compact.
+    """
+
+    def __init__(self, index_specs=(), compact: bool = None, lazy: bool = None):
+        if compact is None:
+            compact = compact_store_enabled()
+        if lazy is None:
+            lazy = lazy_properties_enabled()
+        self.lazy = lazy
+        self._sources = {}
+        if lazy:
+            self.entities = LazyEntities()
+        else:
+            self.entities = CompactEntities() if compact else {}
+        self.edges = {}
+        self._edge_seqs = {}
+        self._next_seq = 0
+        self.outgoing = {}
+        self.incoming = {}
+        self.relation_count = 0
+        self._relations = None
+        self.indexes = {}
+        self.maintain_indexes = True
+        self._indexed_props = {}
+        self._order = {}
+        self._next_order = 0
+        # rel type -> _TopologicalOrder of its edges, or None while cyclic;
+        # only kept for types creates_cycle() was asked about.
+        self._orders = {}
+        # Log bytes covered, the snapshot offset they started from, and a
+        # fingerprint of the bytes before offset (see _log_fingerprint).
+        self.offset = 0
+        self.base_offset = 0
+        self.fingerprint = None
+        self.partial_tail = False
+        for type_name, prop in index_specs:
+            self.indexes[(type_name, prop)] = {}
+            self._indexed_props.setdefault(type_name, []).append(prop)
+
+    @property
+    def relations(self) -> list:
+        """Relations as a list of dicts, in the order they were related."""
+        if self._relations is None:
+            self._relations = [
+                {"from": from_id, "rel": rel_type, "to": to_id, "properties": props}
+                for (from_id, rel_type, to_id), props in self.ordered_edges()
+            ]
+        return self._relations
+
+    def ordered_edges(self) -> list:
+        """(key, properties) for every edge, parallel ones included, in relate order."""
+        edges = [
+            (seq, key, props)
+            for key, parallel in self.edges.items()
+            for seq, props in zip(self._edge_seqs[key], parallel)
+        ]
+        edges.sort(key=lambda edge: edge[0])
+        return [(key, props) for _, key, props in edges]
+
+    def apply(self, record: dict) -> None:
+        """Apply a single log record."""
+        op = record.get("op")
+
+        if op == "create":
+            entity = record["entity"]
+            entity_id = entity["id"]
+            previous = self.entities.get(entity_id)
+            if previous is not None:
+                self._unindex(previous)
+            elif self.indexes:
+                self._order[entity_id] = self._next_order
+                self._next_order += 1
+            self.entities[entity_id] = entity
+            self._index(entity)
+        elif op == "update":
+            entity = self.entities.get(record["id"])
+            if entity is not None:
+                properties = record.get("properties", {})
+                self._unindex(entity, properties)
+                entity["properties"].update(properties)
+                entity["updated"] = record.get("timestamp")
+                self._index(entity, properties)
+                # A compact store hands out copies; write the change back.
+                self.entities[record["id"]] = entity
+        elif op == "delete":
+            entity = self.entities.pop(record["id"], None)
+            if entity is not None:
+                self._unindex(entity)
+                self._order.pop(entity["id"], None)
+        elif op == "relate":
+            self._relate(record["from"], record["rel"], record["to"], record.get("properties", {}))
+        elif op == "unrelate":
+            self._unrelate(record["from"], record["rel"], record["to"])
+
+    def _indexed(self, entity: dict, only: dict = None) -> list:
+        if not self.maintain_indexes:
+            return []
+        props = self._indexed_props.get(entity["type"], [])
+        if only is not None:
+            props = [prop for prop in props if prop in only]
+        return props
+
+    def _index(self, entity: dict, only: dict = None) -> None:
+        props = self._indexed(entity, only)
+        properties = _properties_of(entity) if props else None
+        for prop in props:
+            key = _index_key(properties.get(prop))
+            self.indexes[(entity["type"], prop)].setdefault(key, {})[entity["id"]] = None
+
+    def _unindex(self, entity: dict, only: dict = None) -> None:
+        props = self._indexed(entity, only)
+        properties = _properties_of(entity) if props else None
+        for prop in props:
+            buckets = self.indexes[(entity["type"], prop)]
+            key = _index_key(properties.get(prop))
+            bucket = buckets.get(key)
+            if bucket is not None:
+                bucket.pop(entity["id"], None)
+                if not bucket:
+                    del buckets[key]
+
+    def entities_of(self, type_name: str = None):
+        """Iterate all entities, or those of one type."""
+        if not type_name:
+            return iter(self.entities.values())
+        if isinstance(self.entities, (CompactEntities, LazyEntities)):
+            return self.entities.values_of_type(type_name)
+        return (entity for entity in self.entities.values() if entity["type"] == type_name)
+
+    def raw_source(self, f):
+        """The _RawSource for the file behind f, or None when not loading lazily."""
+        if not self.lazy:
+            return None
+        stat = os.fstat(f.fileno())
+        key = (stat.st_dev, stat.st_ino)
+        source = self._sources.get(key)
+        if source is None:
+            try:
+                handle = open(f.name, "rb")
+            except OSError:
+                return None
+            opened = os.fstat(handle.fileno())
+            if (opened.st_dev, opened.st_ino) != key:
+                # Replaced since f was opened: decode this file eagerly.
+                handle.close()
+                return None
+            source = self._sources[key] = _RawSource(handle)
+        return source
+
+    def build_index(self, type_name: str, prop: str) -> None:
+        """(Re)build one declared index from the current entities."""
+        buckets = self.indexes[(type_name, prop)] = {}
+        for entity in self.entities_of(type_name):
+            key = _index_key(entity["properties"].get(prop))
+            buckets.setdefault(key, {})[entity["id"]] = None
+
+    def index_bucket(self, type_name: str, prop: str, value) -> dict | None:
+        """Ids of type_name entities whose prop equals value, or None if not indexed."""
+        buckets = self.indexes.get((type_name, prop))
+        if buckets is None:
+            return None
+        return buckets.get(_index_key(value), {})
+
+    def in_entity_order(self, ids) -> list:
+        """Sort indexed ids into entity order, so indexed and scanned queries agree."""
+        return sorted(ids, key=self._order.__getitem__)
+
+    def _relate(self, from_id: str, rel_type: str, to_id: str, properties: dict) -> None:
+        key = (from_id, rel_type, to_id)
+        parallel = self.edges.get(key)
+        if parallel is None:
+            parallel = self.edges[key] = []
+            self._edge_seqs[key] = []
+            self.outgoing.setdefault(from_id, {}).setdefault(rel_type, {})[to_id] = parallel
+            self.incoming.setdefault(to_id, {}).setdefault(rel_type, {})[from_id] = parallel
+            order = self._orders.get(rel_type)
+            if order is not None and not self._reorder(order, from_id, rel_type, to_id):
+                self._orders[rel_type] = None
+        parallel.append(properties)
+        self._edge_seqs[key].append(self._next_seq)
+        self._next_seq += 1
+        self.relation_count += 1
+        self._relations = None
+
+    def _unrelate(self, from_id: str, rel_type: str, to_id: str) -> None:
+        parallel = self.edges.pop((from_id, rel_type, to_id), None)
+        if parallel is None:
+            return
+        del self._edge_seqs[(from_id, rel_type, to_id)]
+        self.relation_count -= len(parallel)
+        self._relations = None
+        if rel_type in self._orders and self._orders[rel_type] is None:
+            del self._orders[rel_type]  # The cycle may be gone; rebuild on demand.
+        for index, node, other in ((self.outgoing, from_id, to_id), (self.incoming, to_id, from_id)):
+            by_rel = index[node]
+            del by_rel[rel_type][other]
+            if not by_rel[rel_type]:
+                del by_rel[rel_type]
+                if not by_rel:
+                    del index[node]
+
+    def _successors(self, rel_type: str):
+        return lambda node: self.outgoing.get(node, {}).get(rel_type, ())
+
+    def _topological_order(self, rel_type: str):
+        """The maintained _TopologicalOrder of rel_type edges, or None if they have a cycle."""
+        if rel_type in self._orders:
+            return self._orders[rel_type]
+        # Kahn's algorithm over the rel_type edges.
+        indegree = {}
+        for node, by_rel in self.outgoing.items():
+            if rel_type in by_rel:
+                indegree.setdefault(node, 0)
+                for other in by_rel[rel_type]:
+                    indegree[other] = indegree.get(other, 0) + 1
+        ready = [node for node, count in indegree.items() if count == 0]
+        positions = {}
+        while ready:
+            node = ready.pop()
+            positions[node] = len(positions)
+            for other in self.outgoing.get(node, {}).get(rel_type, ()):
+                indegree[other] -= 1
+                if not indegree[other]:
+                    ready.append(other)
+        order = _TopologicalOrder(positions) if len(positions) == len(indegree) else None
+        self._orders[rel_type] = order
+        return order
+
+    def _reorder(self, order, from_id: str, rel_type: str, to_id: str) -> bool:
+        """Keep order topological after adding from_id -> to_id; False if that closed a cycle.
+
+        Only nodes positioned between the two endpoints move (Pearce-Kelly):
+        those reachable from to_id and those reaching from_id swap places.
+        """
+        positions = order.positions
+        if from_id == to_id:
+            return False
+        if from_id not in positions:
+            order.low -= 1
+            positions[from_id] = order.low
+        if to_id not in positions:
+            order.high += 1
+            positions[to_id] = order.high
+        low, high = positions[to_id], positions[from_id]
+        if high < low:
+            return True
+        forward = _reachable(self._successors(rel_type), to_id, lambda node: positions[node] <= high)
+        if from_id in forward:
+            return False
+        predecessors = lambda node: self.incoming.get(node, {}).get(rel_type, ())
+        backward = _reachable(predecessors, from_id, lambda node: positions[node] >= low)
+        moved = sorted(backward, key=positions.get) + sorted(forward, key=positions.get)
+        for node, position in zip(moved, sorted(positions[node] for node in moved)):
+            positions[node] = position
+        return True
+
+    def creates_cycle(self, from_id: str, rel_type: str, to_id: str) -> bool:
+        """Whether adding from_id -> to_id would close a cycle of rel_type edges.
+
+        Keeps a topological order of rel_type up to date from then on: an
+        edge that agrees with it cannot close a cycle, and otherwise only
+        nodes positioned between the endpoints are searched. If the edges
+        already have a cycle, everything reachable from to_id is searched.
+        """
+        if from_id == to_id:
+            return True
+        order = self._topological_order(rel_type)
+        if order is None:
+            return _reaches(self._successors(rel_type), to_id, from_id)
+        high = order.positions.get(from_id)
+        low = order.positions.get(to_id)
+        if high is None or low is None or high < low:
+            return False
+        return _reaches(self._successors(rel_type), to_id, from_id,
+                        lambda node: order.positions[node] <= high)
+
+    def edges_of(self, entity_id: str, rel_type: str = None, direction: str = "outgoing"):
+        """Yield (relation, other_id, direction) for edges touching entity_id, in relate order."""
+        edges = []
+        if direction in ("outgoing", "both"):
+            by_rel = self.outgoing.get(entity_id, {})
+            for rel_name in ([rel_type] if rel_type else list(by_rel)):
+                for to_id, parallel in by_rel.get(rel_name, {}).items():
+                    seqs = self._edge_seqs[(entity_id, rel_name, to_id)]
+                    for seq, props in zip(seqs, parallel):
+                        rel = {"from": entity_id, "rel": rel_name, "to": to_id, "properties": props}
+                        edges.append((seq, rel, to_id, "outgoing"))
+        if direction in ("incoming", "both"):
+            by_rel = self.incoming.get(entity_id, {})
+            for rel_name in ([rel_type] if rel_type else list(by_rel)):
+                for from_id, parallel in by_rel.get(rel_name, {}).items():
+                    # A self-loop was already reported as outgoing.
+                    if direction == "both" and from_id == entity_id:
+                        continue
+                    seqs = self._edge_seqs[(from_id, rel_name, entity_id)]
+                    for seq, props in zip(seqs, parallel):
+                        rel = {"from": from_id, "rel": rel_name, "to": entity_id, "properties": props}
+                        edges.append((seq, rel, from_id, "incoming"))
+        edges.sort(key=lambda edge: edge[0])
+        for _, rel, other_id, rel_dir in edges:
+            yield rel, other_id, rel_dir
+
+    def neighbors(self, entity_id: str, rel_types=None, direction: str = "outgoing"):
+        """Yield (rel_type, other_id, direction) once per distinct neighbor edge key."""
+        if direction in ("outgoing", "both"):
+            by_rel = self.outgoing.get(entity_id, {})
+            for rel_type in (rel_types or list(by_rel)):
+                for other_id in by_rel.get(rel_type, {}):
+                    yield rel_type, other_id, "outgoing"
+        if direction in ("incoming", "both"):
+            by_rel = self.incoming.get(entity_id, {})
+            for rel_type in (rel_types or list(by_rel)):
+                for other_id in by_rel.get(rel_type, {}):
+                    if direction == "both" and other_id == entity_id:
+                        continue
+                    yield rel_type, other_id, "incoming"
+
+    def degrees(self, direction: str = "outgoing", rel_type: str = None):
+        """Yield (rel_type, entity_id, edge count) for every entity with edges in direction."""
+        adjacency = self.outgoing if direction == "outgoing" else self.incoming
+        for entity_id, by_rel in adjacency.items():
+            for rel, others in by_rel.items():
+                if rel_type is None or rel == rel_type:
+                    yield rel, entity_id, sum(len(parallel) for parallel in others.values())
+
+    def traverse(self, seeds: list, rel_types=None, direction: str = "outgoing",
+                 max_depth: int = None, order: str = "bfs"):
+        """Walk from seeds, yielding each reachable entity once.
+
+        Yields (entity_id, depth, parent_id, rel_type, direction). Seeds are not
+        yielded; edges to entities that no longer exist are not followed.
+        """
+        visited = set(seeds)
+        if order == "bfs":
+            frontier = collections.deque((seed, 0) for seed in seeds)
+            while frontier:
+                node, depth = frontier.popleft()
+                if max_depth is not None and depth >= max_depth:
+                    continue
+                for rel_type, other_id, rel_dir in self.neighbors(node, rel_types, direction):
+                    if other_id in visited or other_id not in self.entities:
+                        continue
+                    visited.add(other_id)
+                    yield other_id, depth + 1, node, rel_type, rel_dir
+                    frontier.append((other_id, depth + 1))
+        else:
+            # A node first reached deep (say at the depth limit) is expanded
+            # again when a shorter path to it turns up later, or the entities
+            # only that shorter path leaves room to reach would be missed.
+            # It is still yielded once, where it was first reached.
+            stack = [(seed, 0, None, None, None) for seed in reversed(seeds)]
+            best_depth = {}
+            while stack:
+                node, depth, parent, rel_type, rel_dir = stack.pop()
+                if best_depth.get(node, math.inf) <= depth:
+                    continue
+                if node not in visited:
+                    visited.add(node)
+                    yield node, depth, parent, rel_type, rel_dir
+                best_depth[node] = depth
+                if max_depth is not None and depth >= max_depth:
+                    continue
+                children = [
+                    (other_id, depth + 1, node, rel, other_dir)
+                    for rel, other_id, other_dir in self.neighbors(node, rel_types, direction)
+                    if best_depth.get(other_id, math.inf) > depth + 1 and other_id in self.entities
+                ]
+                stack.extend(reversed(children))
+
+    def shortest_path(self, from_id: str, to_id: str, rel_types=None,
+                      direction: str = "outgoing", max_depth: int = None) -> list | None:
+        """Fewest-hop path as a list of (from, rel, to, direction) steps, or None."""
+        if from_id == to_id:
+            return []
+        parents = {from_id: None}
+        frontier = collections.deque([(from_id, 0)])
+        while frontier:
+            node, depth = frontier.popleft()
+            if max_depth is not None and depth >= max_depth:
+                continue
+            for rel_type, other_id, rel_dir in self.neighbors(node, rel_types, direction):
+                if other_id in parents or other_id not in self.entities:
+                    continue
+                parents[other_id] = (node, rel_type, rel_dir)
+                if other_id == to_id:
+                    steps = []
+                    while parents[other_id] is not None:
+                        prev, rel, step_dir = parents[other_id]
+                        steps.append((prev, rel, other_id, step_dir))
+                        other_id = prev
+                    return steps[::-1]
+                frontier.append((other_id, depth + 1))
+        return None
+
+
+def _decode_lines(data: bytes) -> list:
+    """Decode a block of newline-separated JSON records (blank lines are skipped)."""
+    text = data.decode()
+    lines = text.rstrip("\n")
+    # One json.loads over the block as an array costs far less than one call
+    # per line. JSON strings cannot hold raw newlines, so the join is safe.
+    try:
+        records = json.loads("[" + lines.replace("\n", ",") + "]")
+    except ValueError:
+        records = None
+    if records is None or len(records) != lines.count("\n") + 1:
+        # Blank lines or a bad record: go line by line so a bad one raises alone.
+        records = [json.loads(line) for line in text.split("\n") if line.strip()]
+    return records
+
+
+# Characters that matter when walking a record line without decoding it.
+_JSON_STRUCTURE = re.compile(rb'["{}\[\]:]')
+_PROPERTIES_PATH = [None, b'"entity"']
+_SCANNER = json.JSONDecoder()
+
+
+def _string_end(line: bytes, pos: int) -> int:
+    """Offset just past the JSON string whose opening quote is at pos."""
+    while True:
+        pos = line.find(b'"', pos + 1)
+        if pos == -1:
+            return len(line)
+        escapes = 0
+        while line[pos - 1 - escapes] == 0x5C:  # backslash
+            escapes += 1
+        if not escapes % 2:
+            return pos + 1
+
+
+def _properties_span(line: bytes):
+    """(start, end) of the entity.properties object on a record line, or None.
+
+    Strings are skipped with bytes.find, so long text values cost little.
+    Each escaped quote costs a find too, so on lines full of them the end
+    of the object is found by the C JSON scanner instead, over a latin-1
+    view whose character offsets are the byte offsets. The result is only
+    a candidate that _decode_lazy checks by parsing.
+    """
+    path = []
+    key = pending = None
+    span = start = None
+    dense = line.count(b'\\"') * 256 > len(line)
+    pos = 0
+    while True:
+        match = _JSON_STRUCTURE.search(line, pos)
+        if match is None:
+            return span
+        pos = match.end()
+        char = match.group()
+        if char == b'"':
+            pos = _string_end(line, match.start())
+            # Only short strings can be the keys compared below.
+            pending = line[match.start():pos] if pos - match.start() <= 64 else b""
+        elif char == b":":
+            key = pending
+        elif char in b"{[":
+            if char == b"{" and key == b'"properties"' and path == _PROPERTIES_PATH:
+                if dense:
+                    try:
+                        pos = _SCANNER.raw_decode(line.decode("latin-1"), match.start())[1]
+                    except ValueError:
+                        return None
+                    span = (match.start(), pos)
+                    key = None
+                    continue
+                start = match.start()
+            path.append(key)
+            key = None
+        else:
+            if not path:
+                return None
+            path.pop()
+            key = None
+            if start is not None and len(path) == 2:
+                # Keep scanning: with duplicate keys the last one wins.
+                span = (start, pos)
+                start = None
+
+
+def _decode_lazy(data: bytes, base: int) -> tuple:
+    """Decode a block like _decode_lines, leaving large create properties raw.
+
+    base is the file offset of data. Returns the records and the
+    RawProperties placed in them, whose source the caller must set.
+    """
+    lines = []
+    spans = []
+    offset = base
+    for line in data.split(b"\n"):
+        size = len(line)
+        if size >= LAZY_MIN_BYTES:
+            span = _properties_span(line)
+            if span is not None:
+                start, end = span
+                spans.append((len(lines), RawProperties(offset + start, end - start), line))
+                line = line[:start] + b"{}" + line[end:]
+        if line.strip():
+            lines.append(line)
+        offset += size + 1
+    records = _decode_lines(b"\n".join(lines))
+    raws = []
+    for position, raw, line in spans:
+        record = records[position]
+        entity = record.get("entity") if isinstance(record, dict) else None
+        if isinstance(entity, dict) and record.get("op") == "create" and entity.get("properties") == {}:
+            entity["properties"] = raw
+            raws.append(raw)
+        else:
+            records[position] = json.loads(line)
+    return records, raws
+
+
+class _FileReplaced(OSError):
+    """The file at a path is no longer the one the caller had open."""
+
+
+def _parse_chunk(path: str, identity: tuple, start: int, end: int, lazy: bool = False) -> tuple:
+    """Parse the JSON lines in bytes [start, end) of path (worker process side).
+
+    identity is the (st_dev, st_ino) of the file the offsets were computed
+    on; if path has since been replaced (snapshot refresh, compact),
+    _FileReplaced is raised rather than decoding another file. Returns
+    (records, raws) as _decode_lazy does; raws is empty unless lazy.
+    """
+    import mmap
+    
+    with open(path, "rb") as f:
+        stat = os.fstat(f.fileno())
+        if (stat.st_dev, stat.st_ino) != identity:
+            raise _FileReplaced(f"{path} was replaced while it was being read")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if lazy:
+                return _decode_lazy(data[start:end], start)
+            return _decode_lines(data[start:end]), []
+
+
+def _chunk_bounds(f, start: int, end: int, chunk_bytes: int) -> list:
+    """Split [start, end) of the file behind f into chunks ending at newlines."""
+    import mmap
+    
+    bounds = []
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        while start < end:
+            cut = data.find(b"\n", min(start + chunk_bytes, end) - 1, end)
+            cut = end if cut == -1 else cut + 1
+            bounds.append((start, cut))
+            start = cut
+    return bounds
+
+
+@contextlib.contextmanager
+def _gc_paused():
+    """Suspend the cyclic GC for bulk work that allocates many acyclic objects."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def peak_rss_kb() -> int | None:
+    """Peak resident set size of this process in KiB, where available."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+class CommandStats:
+    """Where one command spends its time and what it loads (--stats).
+
+    Phases are wall-clock seconds. Loading is split per source (snapshot,
+    log) into reading the file, decoding JSON and applying records; time
+    in parse workers shows up as parse time in this process. Whatever no
+    phase claims (filtering, validation, traversal) is reported as
+    "command".
+    """
+
+    PHASE_ORDER = ("snapshot.read", "snapshot.parse", "snapshot.apply",
+                   "log.read", "log.parse", "log.apply", "snapshot.write", "write", "output")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.bytes_read = collections.Counter()
+        self.records = {}
+        self.graphs = {}
+
+    def add(self, phase: str, seconds: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def count(self, source: str, record: dict) -> None:
+        counts = self.records.setdefault(source, collections.Counter())
+        counts[record.get("op", "index")] += 1
+
+    def replayed(self, records, source: str):
+        """Pass records through, counting them and charging their decoding to source."""
+        clock = time.perf_counter
+        read_before = self.phases.get("read", 0.0)
+        decode = 0.0
+        records = iter(records)
+        try:
+            while True:
+                start = clock()
+                record = next(records, None)
+                decode += clock() - start
+                if record is None:
+                    break
+                self.count(source, record)
+                yield record
+        finally:
+            read = self.phases.get("read", 0.0) - read_before
+            self.phases["read"] = read_before
+            self.add(f"{source}.read", read)
+            self.add(f"{source}.parse", decode - read)
+
+    def report(self, command: str) -> dict:
+        total = time.perf_counter() - self.started
+        phases = dict(self.phases)
+        phases.pop("read", None)
+        for source in ("snapshot", "log"):
+            loaded = phases.pop(f"{source}.load", None)
+            # No read phase: there was no usable snapshot, only the check
+            # for one, which is left to "command".
+            if loaded is not None and f"{source}.read" in phases:
+                phases[f"{source}.apply"] = loaded - phases[f"{source}.read"] \
+                    - phases.get(f"{source}.parse", 0.0)
+        ordered = {name: round(phases[name], 6) for name in self.PHASE_ORDER if name in phases}
+        ordered["command"] = round(total - sum(phases.values()), 6)
+        return {
+            "command": command,
+            "wall_s": round(total, 6),
+            "phases": ordered,
+            "bytes_read": dict(self.bytes_read),
+            "records": {source: dict(counts) for source, counts in self.records.items()},
+            "materialized": {
+                path: {"entities": len(graph.entities), "relations": graph.relation_count}
+                for path, graph in self.graphs.items()
+            },
+            "peak_rss_kb": peak_rss_kb(),
+        }
+
+
+def _phase(name: str):
+    """Time a block as phase `name` of the running command, when --stats is on."""
+    return _STATS.phase(name) if _STATS is not None else contextlib.nullcontext()
+
+
+def _tracked(records, source: str):
+    """records, counted and timed under source when --stats is on."""
+    return _STATS.replayed(records, source) if _STATS is not None else records
+
+
+def iter_records(f, start: int, end: int, source: _RawSource = None):
+    """Yield the JSON records on the lines in [start, end) of f, in file order.
+
+    The span is decoded in blocks of PARALLEL_CHUNK_BYTES cut at newlines.
+    Spans of at least PARALLEL_MIN_BYTES are spread over parse_workers()
+    processes that decode blocks concurrently while this process applies
+    them in order, so replay is unchanged. A line that does not parse
+    raises ValueError either way. Leaves f positioned at end. Workers
+    reopen the file by name; if it was replaced since f was opened, the
+    rest of the span is read from f in this process instead.
+
+    With a source (see Graph.raw_source), large create records come back
+    with RawProperties read from it instead of decoded properties.
+    """
+    workers = parse_workers()
+    if workers == 1 or end - start < PARALLEL_MIN_BYTES:
+        yield from _iter_serial(f, start, end, source)
+        return
+    
+    # Only a parallel load pays for these imports.
+    import concurrent.futures
+    import multiprocessing
+    
+    lazy = source is not None
+    stat = os.fstat(f.fileno())
+    identity = (stat.st_dev, stat.st_ino)
+    bounds = _chunk_bounds(f, start, end, PARALLEL_CHUNK_BYTES)
+    # fork is cheap and needs no importable __main__, but is unsafe once other
+    # threads (e.g. the server's) are running; spawn then.
+    forkable = "fork" in multiprocessing.get_all_start_methods() and threading.active_count() == 1
+    context = multiprocessing.get_context("fork" if forkable else "spawn")
+    with concurrent.futures.ProcessPoolExecutor(workers, mp_context=context) as pool:
+        # Keep a bounded window of chunks in flight so parsed records don't pile up.
+        pending = collections.deque()
+        chunks = iter(bounds)
+
+        def submit(count):
+            for chunk_start, chunk_end in itertools.islice(chunks, count):
+                future = pool.submit(_parse_chunk, f.name, identity, chunk_start, chunk_end, lazy)
+                pending.append((chunk_start, future))
+
+        submit(2 * workers)
+        while pending:
+            start, future = pending.popleft()
+            try:
+                records, raws = future.result()
+            except _FileReplaced:
+                # f still holds the original file: finish from start in-process.
+                pool.shutdown(cancel_futures=True)
+                break
+            submit(1)
+            for raw in raws:
+                raw.source = source
+            yield from records
+        else:
+            f.seek(end)
+            return
+    yield from _iter_serial(f, start, end, source)
+
+
+def _iter_serial(f, start: int, end: int, source: _RawSource = None):
+    """iter_records in this process: read [start, end) of f block by block."""
+    lazy = source is not None
+    f.seek(start)
+    remaining = end - start
+    carry = b""
+    while remaining > 0:
+        with _phase("read"):
+            block = carry + f.read(min(PARALLEL_CHUNK_BYTES, remaining))
+        remaining -= len(block) - len(carry)
+        cut = block.rfind(b"\n") + 1 if remaining > 0 else len(block)
+        carry = block[cut:]
+        if not lazy:
+            yield from _decode_lines(block[:cut])
+            continue
+        records, raws = _decode_lazy(block[:cut], start)
+        for raw in raws:
+            raw.source = source
+        start += cut
+        yield from records
+
+
+def _last_line_end(f) -> int:
+    """Offset just past the last newline in the file behind f (0 if none)."""
+    return _line_start(f, os.fstat(f.fileno()).st_size)
+
+
+def _line_start(f, offset: int) -> int:
+    """Start of the line that offset falls in (offset itself if a line starts there)."""
+    end = offset
+    while end > 0:
+        start = max(end - 65536, 0)
+        f.seek(start)
+        newline = f.read(end - start).rfind(b"\n")
+        if newline != -1:
+            return start + newline + 1
+        end = start
+    return 0
+
+
+def _replay(f, graph: Graph) -> int:
+    """Replay records from the current position of a binary file handle.
+
+    Returns the offset just past the last newline-terminated line, i.e. the
+    part of the log that a snapshot may safely claim to cover. A final line
+    without a newline is applied if it parses (hand-written logs) but marks
+    the graph as partial_tail; if it does not parse, a writer is still
+    appending it and it is skipped.
+    """
+    offset = f.tell()
+    end = _last_line_end(f)
+    if _STATS is not None:
+        _STATS.bytes_read["log"] += max(os.fstat(f.fileno()).st_size - offset, 0)
+    with _gc_paused():
+        for record in _tracked(iter_records(f, offset, end, graph.raw_source(f)), "log"):
+            graph.apply(record)
+    offset = max(offset, end)
+    f.seek(offset)
+    for line in f:
+        terminated = line.endswith(b"\n")
+        if terminated:
+            offset += len(line)
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            if terminated:
+                raise
+            break
+        if _STATS is not None:
+            _STATS.count("log", record)
+        graph.apply(record)
+        if not terminated:
+            graph.partial_tail = True
+    return offset
+
+
+def _log_fingerprint(f, offset: int) -> str:
+    """Hash the log bytes just before offset so a rewritten log is detected."""
+    start = max(offset - 4096, 0)
+    f.seek(start)
+    return hashlib.sha1(f.read(offset - start)).hexdigest()
+
+
+def _load_snapshot(graph_path: str, f, graph: Graph) -> int:
+    """Load the snapshot into graph if it matches the log.
+
+    Returns the log offset the snapshot covers, or 0 when there is no usable
+    snapshot (missing, stale after a rewrite, or unreadable). The log handle
+    is left positioned at the returned offset.
+    """
+    offset = _read_snapshot(graph_path, f, graph)
+    f.seek(offset)
+    return offset
+
+
+def _read_snapshot(graph_path: str, f, graph: Graph, snap_file: Path = None) -> int:
+    snap_file = snap_file or snapshot_path(graph_path)
+    if not snap_file.exists():
+        return 0
+    try:
+        with open(snap_file, "rb") as snap:
+            header = json.loads(snap.readline())
+            offset = header.get("offset", 0)
+            if header.get("snapshot") != SNAPSHOT_FORMAT or not offset:
+                return 0
+            if offset > os.fstat(f.fileno()).st_size:
+                return 0
+            if _log_fingerprint(f, offset) != header.get("fingerprint"):
+                return 0
+            # Index buckets are stored after the records; don't rebuild them twice.
+            graph.maintain_indexes = False
+            size = os.fstat(snap.fileno()).st_size
+            if _STATS is not None:
+                _STATS.bytes_read["snapshot"] += size
+            with _gc_paused():
+                records = _tracked(iter_records(snap, snap.tell(), size, graph.raw_source(snap)),
+                                   "snapshot")
+                for record in records:
+                    if "op" in record:
+                        graph.apply(record)
+                        continue
+                    spec = tuple(record.get("index", ()))
+                    if spec in graph.indexes:
+                        graph.indexes[spec] = {
+                            _index_key(value): dict.fromkeys(ids)
+                            for value, ids in record["buckets"]
+                        }
+            graph.maintain_indexes = True
+            if (header.get("entities") != len(graph.entities)
+                    or header.get("relations") != graph.relation_count):
+                raise ValueError(f"{snap_file} does not hold the state its header describes")
+            for spec in graph.indexes:
+                if list(spec) not in header.get("indexes", []):
+                    graph.build_index(*spec)
+    except (OSError, ValueError, KeyError):
+        graph.__init__(list(graph.indexes))
+        return 0
+    return offset
+
+
+def snapshot_records(graph: Graph):
+    """Yield the minimal create/relate records that rebuild the given state."""
+    for entity in graph.entities.values():
+        yield {"op": "create", "entity": entity, "timestamp": entity.get("created")}
+    for rel in graph.relations:
+        yield {
+            "op": "relate",
+            "from": rel["from"],
+            "rel": rel["rel"],
+            "to": rel["to"],
+            "properties": rel.get("properties", {})
+        }
+
+
+def compacted_records(graph, timestamp: str):
+    """snapshot_records as the content of a rewritten log whose history is gone.
+
+    Every record is stamped with timestamp, the moment the state is as of,
+    and the first one is marked "compacted": --as-of a timestamp before it
+    is refused rather than answered from the wrong state (see _load_as_of).
+    """
+    for n, record in enumerate(snapshot_records(graph)):
+        record["timestamp"] = timestamp
+        if n == 0:
+            record["compacted"] = True
+        yield record
+
+
+def write_snapshot(graph_path: str, graph: Graph, offset: int, fingerprint: str) -> Path:
+    """Atomically (and durably) write a snapshot covering the first offset bytes of the log.
+
+    The header also carries the timestamp of the last record covered, so
+    the snapshot can serve as a checkpoint for --as-of (see
+    keep_checkpoint).
+    """
+    snap_file = snapshot_path(graph_path)
+    with open(graph_path, "rb") as log:
+        timestamp = _timestamp_before(log, offset)
+    header = {
+        "snapshot": SNAPSHOT_FORMAT,
+        "offset": offset,
+        "fingerprint": fingerprint,
+        "timestamp": timestamp,
+        "entities": len(graph.entities),
+        "relations": graph.relation_count,
+        "indexes": [list(spec) for spec in graph.indexes],
+    }
+    with _atomic_write(snap_file) as f:
+        f.write(json.dumps(header) + "\n")
+        for record in snapshot_records(graph):
+            f.write(json.dumps(record) + "\n")
+        for spec, buckets in graph.indexes.items():
+            entry = {
+                "index": list(spec),
+                "buckets": [[_index_value(key), list(ids)] for key, ids in buckets.items()],
+            }
+            f.write(json.dumps(entry) + "\n")
+    keep_checkpoint(graph_path, snap_file, offset)
+    return snap_file
+
+
+def _timestamp_before(f, offset: int) -> str | None:
+    """Timestamp of the record on the line that ends at offset, if any."""
+    if offset <= 0:
+        return None
+    start = _line_start(f, offset - 1)
+    f.seek(start)
+    try:
+        return json.loads(f.read(offset - start)).get("timestamp")
+    except (ValueError, AttributeError):
+        return None
+
+
+def _snapshot_header(snap_file: Path) -> dict | None:
+    try:
+        with open(snap_file, "rb") as snap:
+            header = json.loads(snap.readline())
+    except (OSError, ValueError):
+        return None
+    if not isinstance(header, dict) or header.get("snapshot") != SNAPSHOT_FORMAT or not header.get("offset"):
+        return None
+    return header
+
+
+def keep_checkpoint(graph_path: str, snap_file: Path, offset: int) -> Path | None:
+    """Keep a just-written snapshot as a checkpoint when the last one is far enough back.
+
+    Checkpoints are the snapshots of every checkpoint_interval() bytes of
+    log, hard-linked (or copied) into graph.jsonl.checkpoints/. Ones that no
+    longer match the log are dropped.
+    """
+    interval = checkpoint_interval()
+    if not interval:
+        return None
+    directory = checkpoints_path(graph_path)
+    last = 0
+    if directory.exists():
+        with open(graph_path, "rb") as log:
+            size = os.fstat(log.fileno()).st_size
+            for checkpoint in directory.glob("*.snapshot"):
+                header = _snapshot_header(checkpoint)
+                if header is None or header["offset"] > size \
+                        or _log_fingerprint(log, header["offset"]) != header.get("fingerprint"):
+                    checkpoint.unlink(missing_ok=True)
+                else:
+                    last = max(last, header["offset"])
+    if offset - last < interval:
+        return None
+    directory.mkdir(exist_ok=True)
+    target = directory / f"{offset:016d}.snapshot"
+    try:
+        target.unlink(missing_ok=True)
+        os.link(snap_file, target)
+    except OSError:
+        shutil.copyfile(snap_file, target)
+    return target
+
+
+def parse_as_of(value: str):
+    """Parse an --as-of value: a log byte offset (int) or an aware datetime."""
+    if value.isdigit():
+        return int(value)
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        raise SystemExit(f"Invalid --as-of: {value!r} (expected a log offset or ISO timestamp)")
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def _stamped_after(timestamp, moment: datetime) -> bool:
+    """Whether a record timestamp lies after moment (unparseable ones never do)."""
+    try:
+        stamp = datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        return False
+    return (stamp if stamp.tzinfo else stamp.replace(tzinfo=timezone.utc)) > moment
+
+
+def _nearest_checkpoint(graph_path: str, f, as_of) -> Path | None:
+    """The latest checkpoint (or the snapshot) that matches the log and precedes as_of."""
+    size = os.fstat(f.fileno()).st_size
+    best, best_offset = None, 0
+    directory = checkpoints_path(graph_path)
+    candidates = list(directory.glob("*.snapshot")) if directory.exists() else []
+    for candidate in candidates + [snapshot_path(graph_path)]:
+        header = _snapshot_header(candidate)
+        if header is None or not best_offset < header["offset"] <= size:
+            continue
+        if isinstance(as_of, int):
+            if header["offset"] > as_of:
+                continue
+        elif not header.get("timestamp") or _stamped_after(header["timestamp"], as_of):
+            continue
+        if _log_fingerprint(f, header["offset"]) == header.get("fingerprint"):
+            best, best_offset = candidate, header["offset"]
+    return best
+
+
+def _check_history(path: str, f, moment: datetime) -> None:
+    """Refuse a moment before the log was compacted (see compacted_records).
+
+    Compaction merges updates into creates and drops deletes, so the state
+    at an earlier moment cannot be rebuilt from what is left.
+    """
+    f.seek(0)
+    try:
+        first = json.loads(f.readline())
+    except ValueError:
+        return
+    if isinstance(first, dict) and first.get("compacted") and _stamped_after(first.get("timestamp"), moment):
+        raise SystemExit(f"{path} was compacted as of {first['timestamp']}; its state at "
+                         f"{moment.isoformat()} is no longer in the log (--as-of needs a later time)")
+
+
+def _load_as_of(path: str, as_of) -> Graph:
+    """The graph as of a log offset or moment; see load_graph_state."""
+    graph = Graph(load_index_specs(path))
+    graph_file = Path(path)
+    if not graph_file.exists():
+        return graph
+    with open(graph_file, "rb") as f:
+        if not isinstance(as_of, int):
+            _check_history(path, f, as_of)
+        end = _last_line_end(f)
+        if isinstance(as_of, int):
+            end = _line_start(f, min(as_of, end))
+        start = 0
+        checkpoint = _nearest_checkpoint(path, f, as_of)
+        if checkpoint is not None:
+            with _phase("snapshot.load"):
+                start = _read_snapshot(path, f, graph, checkpoint)
+        with _phase("log.load"), _gc_paused():
+            records = _tracked(iter_records(f, start, max(start, end), graph.raw_source(f)), "log")
+            for record in records:
+                if not isinstance(as_of, int) and _stamped_after(record.get("timestamp"), as_of):
+                    break
+                graph.apply(record)
+    return graph
+
+
+def refresh_snapshot(graph_path: str) -> dict:
+    """Rebuild the snapshot from the current log and return its header info."""
+    graph = Graph(load_index_specs(graph_path))
+    graph_file = Path(graph_path)
+    if not graph_file.exists():
+        raise SystemExit(f"Graph not found: {graph_path}")
+    with open(graph_file, "rb") as f:
+        start = _load_snapshot(graph_path, f, graph)
+        offset = _replay(f, graph)
+        fingerprint = _log_fingerprint(f, offset)
+    write_snapshot(graph_path, graph, offset, fingerprint)
+    return {
+        "snapshot": str(snapshot_path(graph_path)),
+        "offset": offset,
+        "replayed_bytes": offset - start,
+        "entities": len(graph.entities),
+        "relations": graph.relation_count,
+    }
+
+
+def _can_resume(graph: Graph, f, index_specs: list) -> bool:
+    """Whether a cached graph is still a prefix of the log behind f."""
+    if graph.partial_tail or list(graph.indexes) != index_specs:
+        return False
+    if os.fstat(f.fileno()).st_size < graph.offset:
+        return False
+    return _log_fingerprint(f, graph.offset) == graph.fingerprint
+
+
+def load_graph_state(path: str, as_of=None) -> Graph:
+    """Load the graph file into a Graph.
+
+    Starts from the snapshot (if it still matches the log) and replays only
+    the tail written since. The snapshot is refreshed once that tail grows
+    past snapshot_threshold() bytes. Declared property indexes are loaded
+    from the snapshot and kept current while the tail is replayed.
+
+    When a state cache is active (`serve`), the cached graph for path is
+    brought up to date by replaying only the bytes appended since its last
+    refresh; a rewritten log (e.g. after `compact`) triggers a full reload.
+    A SQLite graph path returns a SqliteGraph reading the database directly,
+    one connection per database shared by every reader in the process.
+
+    With as_of (a log byte offset, or an aware datetime from parse_as_of)
+    the graph is rebuilt as it was then: from the latest checkpoint before
+    that point, replaying the log up to the offset, or up to the first
+    record stamped after the moment. Timestamps are taken to grow along
+    the log. Such graphs bypass the state cache.
+    """
+    if as_of is not None:
+        if is_sqlite(path):
+            raise SystemExit("--as-of needs the JSONL log; a SQLite graph keeps no history")
+        graph = _load_as_of(path, as_of)
+    elif is_sqlite(path):
+        graph = _sqlite_graph(path)
+    else:
+        graph = _load_log(path)
+    if _STATS is not None:
+        _STATS.graphs[path] = graph
+    return graph
+
+
+def _load_log(path: str) -> Graph:
+    index_specs = load_index_specs(path)
+    
+    graph_path = Path(path)
+    if not graph_path.exists():
+        return Graph(index_specs)
+    
+    cached = _STATE_CACHE.get(path) if _STATE_CACHE is not None else None
+    with open(graph_path, "rb") as f:
+        if cached is not None and _can_resume(cached, f, index_specs):
+            graph = cached
+            f.seek(graph.offset)
+        else:
+            graph = Graph(index_specs)
+            with _phase("snapshot.load"):
+                graph.base_offset = _load_snapshot(path, f, graph)
+        with _phase("log.load"):
+            graph.offset = _replay(f, graph)
+        graph.fingerprint = _log_fingerprint(f, graph.offset)
+        threshold = snapshot_threshold()
+        if threshold and graph.offset - graph.base_offset >= threshold:
+            try:
+                with _phase("snapshot.write"):
+                    write_snapshot(path, graph, graph.offset, graph.fingerprint)
+                graph.base_offset = graph.offset
+            except OSError:
+                pass  # Snapshots are an optimization; a read-only workspace still loads.
+    
+    if _STATE_CACHE is not None:
+        _STATE_CACHE[path] = graph
+    return graph
+
+
+def load_graph(path: str) -> tuple[dict, list]:
+    """Load entities and relations from graph file."""
+    graph = load_graph_state(path)
+    return graph.entities, graph.relations
+
+
+def is_sqlite(graph_path) -> bool:
+    """Whether graph_path names a SQLite database rather than a JSONL log."""
+    return Path(graph_path).suffix.lower() in SQLITE_SUFFIXES
+
+
+def sqlite_path(graph_path) -> Path:
+    """Return the SQLite database used for graph_path with --backend sqlite."""
+    path = Path(graph_path)
+    return path if is_sqlite(path) else path.with_suffix(".db")
+
+
+def _sql_value(value):
+    """A property value as stored in the indexed properties column.
+
+    Only scalars are stored (bools as integers, out-of-range integers as
+    floats); anything else is NULL and never matched by SQL conditions.
+    """
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, int):
+        if -2**63 <= value < 2**63:
+            return value
+        try:
+            return float(value)
+        except OverflowError:
+            return None
+    if isinstance(value, float):
+        return value
+    if isinstance(value, str):
+        try:
+            value.encode()
+        except UnicodeEncodeError:
+            return None
+        return value
+    return None
+
+
+def _sql_condition(prop: str, op: str, operand):
+    """SQL condition (and params) met by every entity the predicate matches, or None.
+
+    Conditions only narrow the candidates; the predicate itself is still
+    applied in Python, so comparisons here may be looser (e.g. >= for >).
+    """
+    subquery = "id IN (SELECT entity_id FROM properties WHERE key = ?{})"
+    if op == "$exists":
+        return (subquery.format(""), [prop]) if operand else None
+    if op == "$eq":
+        value = _sql_value(operand)
+        return None if value is None else (subquery.format(" AND value = ?"), [prop, value])
+    if op == "$in":
+        values = [_sql_value(item) for item in operand]
+        if not values or any(value is None for value in values):
+            return None
+        marks = ", ".join("?" * len(values))
+        return subquery.format(f" AND value IN ({marks})"), [prop, *values]
+    if op in ("$gt", "$gte", "$lt", "$lte"):
+        value = _sql_value(operand)
+        if value is None:
+            return None
+        comparison = ">=" if op in ("$gt", "$gte") else "<="
+        return subquery.format(f" AND value {comparison} ?"), [prop, value]
+    if op == "$prefix" and operand and _sql_value(operand) is not None:
+        last = ord(operand[-1]) + 1
+        if last > 0x10FFFF or 0xD800 <= last <= 0xDFFF:
+            return subquery.format(" AND value >= ?"), [prop, operand]
+        upper = operand[:-1] + chr(last)
+        return subquery.format(" AND value >= ? AND value < ?"), [prop, operand, upper]
+    return None
+
+
+class _SqliteEntities(collections.abc.Mapping):
+    """Entity id -> entity mapping answered by point lookups on the entities table."""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getitem__(self, entity_id):
+        row = self._conn.execute("SELECT data FROM entities WHERE id = ?", (entity_id,)).fetchone()
+        if row is None:
+            raise KeyError(entity_id)
+        return json.loads(row[0])
+
+    def __contains__(self, entity_id):
+        return self._conn.execute("SELECT 1 FROM entities WHERE id = ?", (entity_id,)).fetchone() is not None
+
+    def __iter__(self):
+        for (entity_id,) in self._conn.execute("SELECT id FROM entities ORDER BY seq"):
+            yield entity_id
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM entities").fetchone()[0]
+
+    def values(self):
+        return (json.loads(data) for (data,) in self._conn.execute("SELECT data FROM entities ORDER BY seq"))
+
+
+class SqliteGraph(Graph):
+    """Graph kept in indexed SQLite tables instead of a replayed log.
+
+    Offers the read side of Graph that the commands use (entities,
+    entities_of, edges_of, neighbors and so traverse/shortest_path,
+    relations) through indexed queries, plus apply() for writes. The
+    adjacency dicts are not built; materialize() returns an in-memory Graph
+    for whole-graph work such as validation.
+    """
+
+    def __init__(self, path):
+        import sqlite3
+        
+        self.path = str(path)
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        # Autocommit mode: transactions are opened explicitly by transaction().
+        self.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version == 0:
+            self.conn.execute("PRAGMA journal_mode = WAL")
+            self.conn.executescript(SQLITE_SCHEMA)
+            self.conn.execute(f"PRAGMA user_version = {SQLITE_FORMAT}")
+        elif version != SQLITE_FORMAT:
+            raise SystemExit(f"Unsupported SQLite graph format {version} in {self.path}")
+        self.entities = _SqliteEntities(self.conn)
+        self.indexes = {}
+        self.partial_tail = False
+
+    def close(self) -> None:
+        self.conn.close()
+
+    @contextlib.contextmanager
+    def transaction(self, write: bool = True):
+        """Run a transaction (taking the write lock up front unless write=False)."""
+        self.conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        try:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    @property
+    def relation_count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM relations").fetchone()[0]
+
+    @property
+    def relations(self) -> list:
+        return [
+            {"from": from_id, "rel": rel_type, "to": to_id, "properties": json.loads(props)}
+            for from_id, rel_type, to_id, props in self.conn.execute(
+                "SELECT from_id, rel, to_id, properties FROM relations ORDER BY seq")
+        ]
+
+    def _set_properties(self, entity_id: str, properties: dict) -> None:
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO properties (entity_id, key, value) VALUES (?, ?, ?)",
+            [(entity_id, key, _sql_value(value)) for key, value in properties.items()])
+
+    def apply(self, record: dict) -> None:
+        """Apply a single log record to the tables."""
+        op = record.get("op")
+
+        if op == "create":
+            entity = record["entity"]
+            self.conn.execute(
+                "INSERT INTO entities (id, type, data) VALUES (?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET type = excluded.type, data = excluded.data",
+                (entity["id"], entity.get("type"), json.dumps(entity)))
+            self.conn.execute("DELETE FROM properties WHERE entity_id = ?", (entity["id"],))
+            self._set_properties(entity["id"], entity.get("properties", {}))
+        elif op == "update":
+            entity = self.entities.get(record["id"])
+            if entity is not None:
+                properties = record.get("properties", {})
+                entity["properties"].update(properties)
+                entity["updated"] = record.get("timestamp")
+                self.conn.execute("UPDATE entities SET data = ? WHERE id = ?",
+                                  (json.dumps(entity), record["id"]))
+                self._set_properties(record["id"], properties)
+        elif op == "delete":
+            self.conn.execute("DELETE FROM entities WHERE id = ?", (record["id"],))
+            self.conn.execute("DELETE FROM properties WHERE entity_id = ?", (record["id"],))
+        elif op == "relate":
+            self.conn.execute(
+                "INSERT INTO relations (from_id, rel, to_id, properties) VALUES (?, ?, ?, ?)",
+                (record["from"], record["rel"], record["to"], json.dumps(record.get("properties", {}))))
+        elif op == "unrelate":
+            self.conn.execute("DELETE FROM relations WHERE from_id = ? AND rel = ? AND to_id = ?",
+                              (record["from"], record["rel"], record["to"]))
+
+    def entities_of(self, type_name: str = None):
+        if not type_name:
+            return self.entities.values()
+        rows = self.conn.execute("SELECT data FROM entities WHERE type = ? ORDER BY seq", (type_name,))
+        return (json.loads(data) for (data,) in rows)
+
+    def query_sql(self, type_name: str, predicates: list) -> tuple[str, list, list]:
+        """SQL selecting the candidates for a query: (sql, params, pushed predicates)."""
+        conditions, params, pushed = [], [], []
+        if type_name:
+            conditions.append("type = ?")
+            params.append(type_name)
+        for prop, op, operand in predicates:
+            condition = _sql_condition(prop, op, operand)
+            if condition is not None:
+                conditions.append(condition[0])
+                params.extend(condition[1])
+                pushed.append({"property": prop, "operator": op, "operand": operand})
+        sql = "SELECT data FROM entities"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        return sql + " ORDER BY seq", params, pushed
+
+    def matching(self, type_name: str, predicates: list):
+        """Entities the query's SQL conditions select (a superset of the matches)."""
+        sql, params, _ = self.query_sql(type_name, predicates)
+        return (json.loads(data) for (data,) in self.conn.execute(sql, params))
+
+    def plan_query(self, type_name: str, predicates: list) -> dict:
+        sql, params, pushed = self.query_sql(type_name, predicates)
+        steps = [row[-1] for row in self.conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        return {"type": type_name, "access": "sqlite", "sql": sql, "pushed_down": pushed,
+                "sqlite_plan": steps}
+
+    def _edge_rows(self, entity_id: str, rel_types, direction: str, columns: str):
+        near, far = ("from_id", "to_id") if direction == "outgoing" else ("to_id", "from_id")
+        sql = f"SELECT {columns.format(far=far)} FROM relations WHERE {near} = ?"
+        params = [entity_id]
+        if rel_types:
+            sql += f" AND rel IN ({', '.join('?' * len(rel_types))})"
+            params.extend(rel_types)
+        return sql, params
+
+    def edges_of(self, entity_id: str, rel_type: str = None, direction: str = "outgoing"):
+        """Yield (relation, other_id, direction) for edges touching entity_id."""
+        for side in ("outgoing", "incoming"):
+            if direction not in (side, "both"):
+                continue
+            sql, params = self._edge_rows(entity_id, [rel_type] if rel_type else None, side,
+                                          "rel, {far}, properties")
+            for rel_name, other_id, props in self.conn.execute(sql + " ORDER BY seq", params):
+                # A self-loop was already reported as outgoing.
+                if side == "incoming" and direction == "both" and other_id == entity_id:
+                    continue
+                if side == "outgoing":
+                    rel = {"from": entity_id, "rel": rel_name, "to": other_id}
+                else:
+                    rel = {"from": other_id, "rel": rel_name, "to": entity_id}
+                rel["properties"] = json.loads(props)
+                yield rel, other_id, side
+
+    def neighbors(self, entity_id: str, rel_types=None, direction: str = "outgoing"):
+        """Yield (rel_type, other_id, direction) once per distinct neighbor edge key."""
+        for side in ("outgoing", "incoming"):
+            if direction not in (side, "both"):
+                continue
+            sql, params = self._edge_rows(entity_id, rel_types, side, "rel, {far}")
+            sql += " GROUP BY rel, {far} ORDER BY MIN(seq)".format(far="to_id" if side == "outgoing" else "from_id")
+            for rel_type, other_id in self.conn.execute(sql, params):
+                if side == "incoming" and direction == "both" and other_id == entity_id:
+                    continue
+                yield rel_type, other_id, side
+
+    def degrees(self, direction: str = "outgoing", rel_type: str = None):
+        """Yield (rel_type, entity_id, edge count) for every entity with edges in direction."""
+        column = "from_id" if direction == "outgoing" else "to_id"
+        sql = f"SELECT rel, {column}, COUNT(*) FROM relations"
+        params = ()
+        if rel_type is not None:
+            sql += " WHERE rel = ?"
+            params = (rel_type,)
+        yield from self.conn.execute(sql + f" GROUP BY rel, {column}", params)
+
+    def creates_cycle(self, from_id: str, rel_type: str, to_id: str) -> bool:
+        """Whether adding from_id -> to_id would close a cycle (indexed search from to_id)."""
+        if from_id == to_id:
+            return True
+        successors = lambda node: (other for _, other, _ in self.neighbors(node, [rel_type]))
+        return _reaches(successors, to_id, from_id)
+
+    def materialize(self) -> Graph:
+        """Load everything into an in-memory Graph."""
+        graph = Graph()
+        for record in snapshot_records(self):
+            graph.apply(record)
+        return graph
+
+
+def _sqlite_graph(path: str) -> SqliteGraph:
+    """The shared SqliteGraph for path, reopened if the file was replaced (migrate --force)."""
+    try:
+        stat = os.stat(path)
+        key = (stat.st_dev, stat.st_ino)
+    except OSError:
+        key = None
+    with _SQLITE_GRAPHS_LOCK:
+        cached = _SQLITE_GRAPHS.get(path)
+        if cached is not None and key is not None and cached[0] == key:
+            return cached[1]
+        # A replaced graph's connection closes once its last reader drops it.
+        graph = SqliteGraph(path)
+        stat = os.stat(path)
+        _SQLITE_GRAPHS[path] = ((stat.st_dev, stat.st_ino), graph)
+        return graph
+
+
+def _close_sqlite_graphs(path) -> None:
+    """Close the shared connections to the database at path before it is replaced.
+
+    Closing checkpoints the WAL, which must land in the old file, not the new one.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return
+    with _SQLITE_GRAPHS_LOCK:
+        for cached_path, (key, graph) in list(_SQLITE_GRAPHS.items()):
+            if key == (stat.st_dev, stat.st_ino):
+                del _SQLITE_GRAPHS[cached_path]
+                graph.close()
+
+
+def migrate_to_sqlite(graph_path: str, target: str = None, force: bool = False) -> dict:
+    """Copy the live state of a JSONL log into a new SQLite database."""
+    if not Path(graph_path).exists():
+        raise SystemExit(f"Graph not found: {graph_path}")
+    target_file = Path(target) if target else sqlite_path(graph_path)
+    if not is_sqlite(target_file):
+        raise SystemExit(f"Target must end in {', '.join(SQLITE_SUFFIXES)}: {target_file}")
+    if target_file.exists() and not force:
+        raise SystemExit(f"{target_file} already exists (use --force to replace it)")
+
+    graph = load_graph_state(graph_path)
+    target_file.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = _temp_file(target_file)
+    os.close(fd)
+    tmp_file = Path(tmp_name)
+    try:
+        store = SqliteGraph(tmp_file)
+        try:
+            with store.transaction():
+                for record in snapshot_records(graph):
+                    store.apply(record)
+            # Fold the WAL back in so the renamed file stands on its own.
+            store.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            store.close()
+        _close_sqlite_graphs(target_file)
+        os.replace(tmp_file, target_file)
+    finally:
+        for leftover in (tmp_file, Path(f"{tmp_file}-wal"), Path(f"{tmp_file}-shm")):
+            leftover.unlink(missing_ok=True)
+    _fsync_dir(target_file.parent)
+    return {"graph": str(target_file), "entities": len(graph.entities), "relations": graph.relation_count}
+
+
+def export_jsonl(graph_path: str, target: str = None, force: bool = False) -> dict:
+    """Write the state of a SQLite graph as a compact JSONL log."""
+    if not Path(graph_path).exists():
+        raise SystemExit(f"Graph not found: {graph_path}")
+    target_file = Path(target) if target else Path(graph_path).with_suffix(".jsonl")
+    if is_sqlite(target_file):
+        raise SystemExit(f"Export target must be a JSONL file: {target_file}")
+    if target_file.exists() and not force:
+        raise SystemExit(f"{target_file} already exists (use --force to replace it)")
+
+    store = SqliteGraph(graph_path)
+    target_file.parent.mkdir(parents=True, exist_ok=True)
+    entities = relations = 0
+    try:
+        with store.transaction(write=False), _atomic_write(target_file, "wb") as out:
+            timestamp = datetime.now(timezone.utc).isoformat()
+            for record in compacted_records(store, timestamp):
+                if record["op"] == "create":
+                    entities += 1
+                else:
+                    relations += 1
+                out.write((json.dumps(record) + "\n").encode())
+    finally:
+        store.close()
+    _fsync_dir(target_file.parent)
+    # Sidecars of a previous log at target describe a different file.
+    snapshot_path(str(target_file)).unlink(missing_ok=True)
+    return {"graph": str(target_file), "entities": entities, "relations": relations}
+
+
+def format_cursor(offset: int, fingerprint: str) -> str:
+    """Encode a change-feed position: byte offset plus a short log fingerprint."""
+    return f"{offset}:{fingerprint[:16]}"
+
+
+def parse_cursor(cursor: str | None) -> tuple[int, str | None]:
+    """Decode a cursor from format_cursor (a bare byte offset is accepted too)."""
+    if not cursor:
+        return 0, None
+    offset, _, fingerprint = cursor.partition(":")
+    try:
+        offset = int(offset)
+    except ValueError:
+        raise SystemExit(f"Invalid cursor: {cursor!r}")
+    if offset < 0:
+        raise SystemExit(f"Invalid cursor: {cursor!r}")
+    return offset, fingerprint or None
+
+
+def watch_changes(graph_path: str, cursor: str = None, types: list = None, rels: list = None,
+                  follow: bool = False, interval: float = 1.0):
+    """Yield the log operations written after cursor.
+
+    Operations come back as they appear in the log, each read followed by
+    {"cursor": ...} to resume from. types keeps create/update/delete records
+    of those entity types, rels keeps relate/unrelate records of those
+    relation types; with neither set every operation is kept. If the log
+    was rewritten since the cursor (e.g. by `compact`), {"reset": true} is
+    yielded and the feed restarts from the beginning of the new log. A bare
+    byte offset is moved back to the start of the line it falls in.
+    With follow=True the log is polled every interval seconds until the
+    consumer stops.
+    """
+    offset, expected = parse_cursor(cursor)
+    known_types = {}
+    # The graph as of the starting offset, loaded on demand for entity types.
+    earlier = None
+    start = offset
+    emitted = None
+    graph_file = Path(graph_path)
+    
+    def type_of(entity_id):
+        nonlocal earlier
+        if entity_id in known_types:
+            return known_types[entity_id]
+        if not start:
+            return None
+        if earlier is None:
+            earlier = load_graph_state(graph_path, as_of=start)
+        entity = earlier.entities.get(entity_id)
+        return entity["type"] if entity is not None else None
+    
+    def wanted(record):
+        if not types and not rels:
+            return True
+        op = record.get("op")
+        if op in ("relate", "unrelate"):
+            return bool(rels) and record.get("rel") in rels
+        if not types:
+            return False
+        if op == "create":
+            return record["entity"].get("type") in types
+        return type_of(record.get("id")) in types
+    
+    while True:
+        fingerprint = expected
+        if graph_file.exists():
+            with open(graph_file, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                if expected is None and 0 < offset <= size:
+                    offset = start = _line_start(f, offset)
+                if offset and (size < offset or (expected and not _log_fingerprint(f, offset).startswith(expected))):
+                    yield {"reset": True}
+                    offset = start = 0
+                    known_types, earlier = {}, None
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # A write in progress; pick it up next time.
+                    line_offset = offset
+                    offset += len(line)
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        raise SystemExit(f"Invalid record at byte {line_offset} of {graph_path}")
+                    if record.get("op") == "create":
+                        known_types[record["entity"]["id"]] = record["entity"].get("type")
+                    if wanted(record):
+                        yield record
+                fingerprint = _log_fingerprint(f, offset)[:16]
+        elif offset:
+            yield {"reset": True}
+            offset = start = 0
+            known_types, earlier = {}, None
+        
+        position = format_cursor(offset, fingerprint or hashlib.sha1(b"").hexdigest())
+        if position != emitted:
+            yield {"cursor": position}
+            emitted = position
+        expected = fingerprint
+        if not follow:
+            return
+        time.sleep(interval)
+
+
+def _fsync_dir(directory: Path) -> None:
+    """Persist a rename by syncing its directory (no-op where unsupported)."""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _temp_file(target: Path) -> tuple[int, str]:
+    """Create a uniquely named temp file next to target, with target's file mode.
+
+    Returns (fd, name). Each call gets its own file, so concurrent writers
+    never write into each other's.
+    """
+    import tempfile
+    
+    fd, tmp_name = tempfile.mkstemp(dir=target.parent, prefix=target.name + ".", suffix=".tmp")
+    try:
+        file_mode = os.stat(target).st_mode & 0o7777
+    except OSError:
+        file_mode = 0o666 & ~_UMASK
+    try:
+        os.chmod(tmp_name, file_mode)
+    except OSError:
+        pass
+    return fd, tmp_name
+
+
+@contextlib.contextmanager
+def _atomic_write(target: Path, mode: str = "w"):
+    """Write target through a temp file (see _temp_file), fsynced and renamed over it.
+
+    Readers see either the old or the new target. On error the temp file
+    is removed and target is left alone.
+    """
+    fd, tmp_name = _temp_file(target)
+    try:
+        with open(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_name, target)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp_name)
+        raise
+
+
+def compact_graph(graph_path: str) -> dict:
+    """Rewrite the log in its smallest equivalent form.
+
+    Every live entity becomes one create record carrying its merged
+    properties and every live relation one relate record. The new log is
+    written to a temp file, fsynced and renamed over the original, so a crash
+    leaves either the old or the new log intact.
+    """
+    graph_file = Path(graph_path)
+    if not graph_file.exists():
+        raise SystemExit(f"Graph not found: {graph_path}")
+
+    # Writers wait on the lock, so nothing is appended to the old log while
+    # it is rewritten.
+    with graph_lock(graph_path):
+        graph = Graph()
+        before_bytes = graph_file.stat().st_size
+        with open(graph_file, "rb") as f:
+            _load_snapshot(graph_path, f, graph)
+            # An unterminated last line is either applied already or a torn
+            # write, so the compacted records cover the whole log.
+            _replay(f, graph)
+            # The state is as of the last record (now, if that has no timestamp).
+            timestamp = _timestamp_before(f, os.fstat(f.fileno()).st_size) \
+                or datetime.now(timezone.utc).isoformat()
+
+        with _atomic_write(graph_file, "wb") as out:
+            for record in compacted_records(graph, timestamp):
+                out.write((json.dumps(record) + "\n").encode())
+        _fsync_dir(graph_file.parent)
+        # The old snapshot and checkpoints describe offsets in the old log.
+        snapshot_path(graph_path).unlink(missing_ok=True)
+        shutil.rmtree(checkpoints_path(graph_path), ignore_errors=True)
+
+    return {
+        "graph": str(graph_file),
+        "before_bytes": before_bytes,
+        "after_bytes": graph_file.stat().st_size,
+        "entities": len(graph.entities),
+        "relations": graph.relation_count,
+    }
+
+
+def add_index(graph_path: str, type_name: str, prop: str) -> list:
+    """Declare a (type, property) index and persist it in the snapshot."""
+    specs = load_index_specs(graph_path)
+    if (type_name, prop) not in specs:
+        specs.append((type_name, prop))
+        write_index_specs(graph_path, specs)
+        if Path(graph_path).exists():
+            refresh_snapshot(graph_path)
+    return specs
+
+
+def drop_index(graph_path: str, type_name: str, prop: str) -> list:
+    """Remove a declared (type, property) index."""
+    specs = [spec for spec in load_index_specs(graph_path) if spec != (type_name, prop)]
+    write_index_specs(graph_path, specs)
+    return specs
+
+
+@contextlib.contextmanager
+def graph_lock(graph_path: str):
+    """Hold the exclusive lock that serializes writers of graph_path.
+
+    The lock lives in a sidecar file, so readers never wait for it. flock
+    (msvcrt.locking on Windows) conflicts between separate opens even within
+    one process, so it also serializes threads of a server. Yields whether a
+    lock is actually held: False on platforms with neither.
+    """
+    if fcntl is None and msvcrt is None:
+        yield False
+        return
+    lock_file = lock_path(graph_path)
+    lock_file.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    # Locks the first byte; gives up after ~10s of retries.
+                    msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        yield True
+    finally:
+        os.close(fd)  # Releases the lock.
+
+
+def _read_at(fd: int, size: int, offset: int) -> bytes:
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+
+def _repair_tail(fd: int, locked: bool = True) -> bytes:
+    """Return the prefix needed before appending to the log behind fd.
+
+    With the writer lock held an unterminated last line cannot be a write in
+    progress: if it parses it is a hand-written record and only needs its
+    newline, otherwise it is a torn write from a crashed writer and is cut
+    off. Without a lock (locked=False) it may be another writer's line, so
+    it is never cut; the new records just start on a line of their own.
+    """
+    size = os.fstat(fd).st_size
+    if size == 0 or _read_at(fd, 1, size - 1) == b"\n":
+        return b""
+    start = size
+    while start > 0:
+        chunk_start = max(start - 4096, 0)
+        newline = _read_at(fd, start - chunk_start, chunk_start).rfind(b"\n")
+        if newline != -1:
+            start = chunk_start + newline + 1
+            break
+        start = chunk_start
+    tail = _read_at(fd, size - start, start)
+    try:
+        json.loads(tail)
+    except ValueError:
+        if not locked:
+            return b"\n"
+        os.ftruncate(fd, start)
+        return b""
+    return b"\n"
+
+
+def _append_locked(graph_path: str, records: list, locked: bool = True) -> None:
+    """Append records with one write and one fsync; the caller holds graph_lock.
+
+    locked is what graph_lock yielded (see _repair_tail).
+    """
+    if not records:
+        return
+    graph_file = Path(graph_path)
+    graph_file.parent.mkdir(parents=True, exist_ok=True)
+    payload = "".join(json.dumps(record) + "\n" for record in records).encode()
+    fd = os.open(graph_file, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        payload = _repair_tail(fd, locked) + payload
+        while payload:
+            written = os.write(fd, payload)
+            payload = payload[written:]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _PendingView:
+    """Entities as of the log plus records staged ahead of the next append.
+
+    lookup(entity_id) answers for entities the view has not seen change;
+    views stack, so a batch sees its own earlier operations on top of those
+    committed earlier in the same group. graph() returns the graph as of
+    the log, for the relation checks of relate --enforce.
+    """
+
+    def __init__(self, lookup, graph=None):
+        self._lookup = lookup
+        self._graph = graph
+        self._pending = {}
+        self._relations = []
+
+    def entity(self, entity_id: str) -> dict | None:
+        if entity_id in self._pending:
+            return self._pending[entity_id]
+        return self._lookup(entity_id)
+
+    def record(self, record: dict) -> None:
+        op = record["op"]
+        if op == "create":
+            self._pending[record["entity"]["id"]] = record["entity"]
+        elif op == "update":
+            entity = self.entity(record["id"])
+            if entity is not None:
+                self._pending[record["id"]] = {
+                    **entity,
+                    "properties": {**entity["properties"], **record.get("properties", {})},
+                    "updated": record.get("timestamp"),
+                }
+        elif op == "delete":
+            self._pending[record["id"]] = None
+        elif op in ("relate", "unrelate"):
+            self._relations.append(record)
+
+    def degree(self, entity_id: str, rel_type: str, side: str) -> int:
+        """rel_type edges with entity_id as their side ("from"/"to"), parallel ones included."""
+        near, far, direction = ("from", "to", "outgoing") if side == "from" else ("to", "from", "incoming")
+        counts = collections.Counter(
+            other for _, other, _ in self._graph().edges_of(entity_id, rel_type, direction)
+        )
+        for record in self._relations:
+            if record["rel"] == rel_type and record[near] == entity_id:
+                if record["op"] == "relate":
+                    counts[record[far]] += 1
+                else:
+                    counts[record[far]] = 0
+        return sum(counts.values())
+
+    def creates_cycle(self, from_id: str, rel_type: str, to_id: str) -> bool:
+        """Whether adding from_id -> to_id would close a cycle of rel_type edges."""
+        graph = self._graph()
+        staged = {}
+        for record in self._relations:
+            if record["rel"] == rel_type:
+                staged[(record["from"], record["to"])] = record["op"] == "relate"
+        if not staged:
+            return graph.creates_cycle(from_id, rel_type, to_id)
+        if from_id == to_id:
+            return True
+        # Edges staged by writers ahead of us in this group: search plainly.
+        added = {}
+        for (source, target), present in staged.items():
+            if present:
+                added.setdefault(source, []).append(target)
+
+        def successors(node):
+            for _, other, _ in graph.neighbors(node, [rel_type]):
+                if staged.get((node, other), True):
+                    yield other
+            yield from added.get(node, ())
+
+        return _reaches(successors, to_id, from_id)
+
+
+def _log_graph(graph_path: str):
+    """Graph loader that loads the graph on first use only."""
+    graph = None
+
+    def load():
+        nonlocal graph
+        if graph is None:
+            graph = load_graph_state(graph_path)
+        return graph
+
+    return load
+
+
+class _GroupCommit:
+    """Writers queued for one graph log; whoever finds it idle leads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue = []
+        self.leading = False
+
+
+class _Ticket:
+    def __init__(self, prepare):
+        self.prepare = prepare
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+def _prepare_group(group: list, view: _PendingView) -> list:
+    """Run each ticket's prepare step in turn and collect the records to write."""
+    records = []
+    for ticket in group:
+        try:
+            ticket_records, ticket.result = ticket.prepare(view)
+        except BaseException as exc:
+            ticket.error = exc
+            continue
+        for record in ticket_records:
+            view.record(record)
+        records.extend(ticket_records)
+    return records
+
+
+def _commit_group(graph_path: str, group: list) -> None:
+    """Prepare every ticket under the writer lock, then write them all at once.
+
+    For a JSONL log that is one append and fsync under graph_lock; for a
+    SQLite graph it is one write transaction.
+    """
+    try:
+        if is_sqlite(graph_path):
+            # Its own connection, so readers sharing _sqlite_graph() never
+            # see the open transaction.
+            store = SqliteGraph(graph_path)
+            try:
+                with store.transaction():
+                    for record in _prepare_group(group, _PendingView(store.entities.get, lambda: store)):
+                        store.apply(record)
+            finally:
+                store.close()
+        else:
+            with _STATE_LOCK, graph_lock(graph_path) as locked:
+                load = _log_graph(graph_path)
+                view = _PendingView(lambda entity_id: load().entities.get(entity_id), load)
+                records = _prepare_group(group, view)
+                with _phase("write"):
+                    _append_locked(graph_path, records, locked)
+    except BaseException as exc:
+        for ticket in group:
+            if ticket.error is None:
+                ticket.error = exc
+    finally:
+        for ticket in group:
+            ticket.done.set()
+
+
+def commit(graph_path: str, prepare):
+    """Run a read-check-append step atomically with respect to other writers.
+
+    prepare(view) inspects the graph through view.entity(id) and returns
+    (records, result); it runs while the writer lock is held, so what it
+    checked is still true when its records land, and timestamps it takes
+    grow in log order (which --as-of relies on). Writers that arrive while
+    a commit is in flight queue up and are written together by the next
+    leader with a single write and fsync. Returns prepare's result.
+    """
+    with _COMMITTERS_LOCK:
+        committer = _COMMITTERS.setdefault(graph_path, _GroupCommit())
+    ticket = _Ticket(prepare)
+    with committer.lock:
+        committer.queue.append(ticket)
+        lead = not committer.leading
+        committer.leading = True
+    if lead:
+        while True:
+            with committer.lock:
+                group, committer.queue = committer.queue, []
+                if not group:
+                    committer.leading = False
+                    break
+            _commit_group(graph_path, group)
+    ticket.done.wait()
+    if ticket.error is not None:
+        raise ticket.error
+    return ticket.result
+
+
+def append_op(path: str, record: dict):
+    """Append an operation to the graph file."""
+    append_ops(path, [record])
+
+
+def append_ops(path: str, records: list) -> None:
+    """Append several operations with a single write and one fsync."""
+    if records:
+        commit(path, lambda view: (records, None))
+
+
+def _batch_record(op: dict, lookup) -> tuple[dict, dict]:
+    """Validate one batch operation and turn it into a log record.
+
+    lookup(entity_id) returns the entity as of the preceding operations (or
+    None). Returns (record, summary); raises ValueError when the operation is
+    malformed or refers to a missing entity.
+    """
+    kind = op.get("op")
+    properties = op.get("props", op.get("properties", {}))
+    if not isinstance(properties, dict):
+        raise ValueError("props must be a JSON object")
+    timestamp = datetime.now(timezone.utc).isoformat()
+    
+    if kind == "create":
+        if not op.get("type"):
+            raise ValueError("create requires type")
+        entity = {
+            "id": op.get("id") or generate_id(op["type"]),
+            "type": op["type"],
+            "properties": properties,
+            "created": timestamp,
+            "updated": timestamp
+        }
+        return {"op": "create", "entity": entity, "timestamp": timestamp}, {"id": entity["id"]}
+    
+    if kind in ("update", "delete"):
+        entity_id = op.get("id")
+        if not entity_id:
+            raise ValueError(f"{kind} requires id")
+        if lookup(entity_id) is None:
+            raise ValueError(f"Entity not found: {entity_id}")
+        if kind == "update":
+            record = {"op": "update", "id": entity_id, "properties": properties, "timestamp": timestamp}
+        else:
+            record = {"op": "delete", "id": entity_id, "timestamp": timestamp}
+        return record, {"id": entity_id}
+    
+    if kind in ("relate", "unrelate"):
+        missing = [key for key in ("from", "rel", "to") if not op.get(key)]
+        if missing:
+            raise ValueError(f"{kind} requires {', '.join(missing)}")
+        record = {"op": kind, "from": op["from"], "rel": op["rel"], "to": op["to"]}
+        if kind == "relate":
+            record["properties"] = properties
+        record["timestamp"] = timestamp
+        return record, {"from": op["from"], "rel": op["rel"], "to": op["to"]}
+    
+    raise ValueError(f"unknown op {kind!r} (expected one of {', '.join(BATCH_OPS)})")
+
+
+def apply_batch(lines, graph_path: str, atomic: bool = False) -> tuple[list, int]:
+    """Validate NDJSON operations against the graph and append them together.
+
+    Each operation sees the effect of the ones before it. Invalid operations
+    are reported and skipped; with atomic=True any failure writes nothing.
+    Validation and the append happen under the writer lock, so concurrent
+    writers cannot invalidate the checks in between.
+    Returns (per-operation results, number of records written).
+    """
+    ops = []
+    for line_no, line in enumerate(lines, 1):
+        line = line.strip()
+        if line:
+            ops.append((line_no, line))
+    
+    def prepare(view):
+        # Effects of earlier operations in this batch, kept apart from the
+        # loaded graph (which may be the server's cached state).
+        pending = _PendingView(view.entity)
+        records, results = [], []
+        for line_no, line in ops:
+            try:
+                op = json.loads(line)
+                if not isinstance(op, dict):
+                    raise ValueError("operation must be a JSON object")
+                record, summary = _batch_record(op, pending.entity)
+            except ValueError as exc:
+                results.append({"line": line_no, "ok": False, "error": str(exc)})
+                continue
+            
+            pending.record(record)
+            records.append(record)
+            results.append({"line": line_no, "ok": True, "op": record["op"], **summary})
+        
+        if atomic and len(records) != len(results):
+            records = []
+        return records, (results, len(records))
+    
+    return commit(graph_path, prepare)
+
+
+def create_entity(type_name: str, properties: dict, graph_path: str, entity_id: str = None) -> dict:
+    """Create a new entity."""
+    entity_id = entity_id or generate_id(type_name)
+    
+    def prepare(view):
+        # Stamped under the writer lock, so timestamps follow log order.
+        timestamp = datetime.now(timezone.utc).isoformat()
+        entity = {
+            "id": entity_id,
+            "type": type_name,
+            "properties": properties,
+            "created": timestamp,
+            "updated": timestamp
+        }
+        return [{"op": "create", "entity": entity, "timestamp": timestamp}], entity
+    
+    return commit(graph_path, prepare)
+
+
+def get_entity(entity_id: str, graph_path: str, as_of=None) -> dict | None:
+    """Get entity by ID."""
+    return load_graph_state(graph_path, as_of).entities.get(entity_id)
+
+
+def parse_where(where: dict) -> list:
+    """Turn a --where object into (property, operator, operand) predicates.
+
+    A plain value means equality (the original form). An object whose keys
+    all start with "$" applies operators: $eq, $ne, $gt, $gte, $lt, $lte,
+    $in, $nin, $prefix and $exists.
+    """
+    if not isinstance(where, dict):
+        raise SystemExit("Invalid where clause: expected a JSON object")
+    predicates = []
+    for prop, condition in where.items():
+        if isinstance(condition, dict) and condition and all(str(k).startswith("$") for k in condition):
+            for op, operand in condition.items():
+                if op not in WHERE_OPERATORS:
+                    raise SystemExit(f"Invalid where clause: unknown operator {op} on '{prop}'")
+                if op in ("$in", "$nin") and not isinstance(operand, list):
+                    raise SystemExit(f"Invalid where clause: {op} on '{prop}' needs a list")
+                if op == "$prefix" and not isinstance(operand, str):
+                    raise SystemExit(f"Invalid where clause: $prefix on '{prop}' needs a string")
+                predicates.append((prop, op, operand))
+        else:
+            predicates.append((prop, "$eq", condition))
+    return predicates
+
+
+def _matches(properties: dict, prop: str, op: str, operand) -> bool:
+    """Evaluate one predicate; comparisons between incompatible types are false."""
+    if op == "$exists":
+        return (prop in properties) == bool(operand)
+    value = properties.get(prop)
+    if op == "$eq":
+        return value == operand
+    if op == "$ne":
+        return value != operand
+    if op == "$in":
+        return value in operand
+    if op == "$nin":
+        return value not in operand
+    if op == "$prefix":
+        return isinstance(value, str) and value.startswith(operand)
+    if value is None:
+        return False
+    try:
+        if op == "$gt":
+            return value > operand
+        if op == "$gte":
+            return value >= operand
+        if op == "$lt":
+            return value < operand
+        return value <= operand
+    except TypeError:
+        return False
+
+
+def plan_query(graph: Graph, type_name: str, predicates: list) -> dict:
+    """Choose how to find candidates for a query.
+
+    Equality and $in predicates on an indexed (type, property) can be served
+    from the index; the one with the fewest matching ids wins. Every
+    predicate is still applied to the candidates as a streaming filter.
+    A SqliteGraph pushes whatever predicates it can into its SQL instead.
+    """
+    if isinstance(graph, SqliteGraph):
+        plan = graph.plan_query(type_name, predicates)
+        plan["filter"] = [{"property": prop, "operator": op, "operand": operand}
+                          for prop, op, operand in predicates]
+        plan["candidates"] = None
+        return plan
+    plan = {"type": type_name, "access": "scan", "estimated_rows": len(graph.entities)}
+    best_ids = None
+    if type_name:
+        for prop, op, operand in predicates:
+            if op == "$eq":
+                values = [operand]
+            elif op == "$in":
+                values = operand
+            else:
+                continue
+            buckets = [graph.index_bucket(type_name, prop, value) for value in values]
+            if any(bucket is None for bucket in buckets):
+                continue
+            ids = set().union(*buckets) if len(buckets) != 1 else buckets[0]
+            if best_ids is None or len(ids) < len(best_ids):
+                best_ids = ids
+                plan.update({
+                    "access": "index",
+                    "index": {"type": type_name, "property": prop, "operator": op},
+                    "estimated_rows": len(ids),
+                })
+    plan["filter"] = [{"property": prop, "operator": op, "operand": operand}
+                      for prop, op, operand in predicates]
+    plan["candidates"] = best_ids
+    return plan
+
+
+def _sort_key(properties: dict, prop: str):
+    # Numbers before strings before anything else (compared as JSON).
+    value = properties.get(prop)
+    if isinstance(value, (int, float)):
+        return (0, value)
+    if isinstance(value, str):
+        return (1, value)
+    return (2, json.dumps(value, sort_keys=True))
+
+
+def _sorted_entities(entities, prop: str, descending: bool = False, top: int = None) -> list:
+    """Sort by one property; entities missing it always come last.
+
+    With top set, only the first top entities are kept, using a bounded heap.
+    """
+    present, missing = [], []
+    for entity in entities:
+        (present if prop in entity["properties"] else missing).append(entity)
+    key = lambda entity: _sort_key(entity["properties"], prop)
+    if top is None:
+        ordered = sorted(present, key=key, reverse=descending)
+    elif descending:
+        ordered = heapq.nlargest(top, present, key=key)
+    else:
+        ordered = heapq.nsmallest(top, present, key=key)
+    ordered.extend(missing)
+    return ordered if top is None else ordered[:top]
+
+
+def iter_query(type_name: str, where: dict, graph_path: str, sort: str = None,
+               descending: bool = False, top: int = None, as_of=None):
+    """Yield entities matching type and where predicates.
+
+    Results stream as they are found unless sort names a property, in which
+    case the first top results (all if None) come back ordered by it.
+    """
+    graph = load_graph_state(graph_path, as_of)
+    matching = _matching(graph, type_name, parse_where(where))
+    if sort:
+        yield from _sorted_entities(matching, sort, descending, top)
+    else:
+        yield from matching
+
+
+def _matching(graph: Graph, type_name: str, predicates: list):
+    """Yield the entities of graph matching type and predicates, using the query plan."""
+    candidate_ids = plan_query(graph, type_name, predicates).pop("candidates")
+    if isinstance(graph, SqliteGraph):
+        candidates = graph.matching(type_name, predicates)
+    elif candidate_ids is None:
+        candidates = graph.entities_of(type_name)
+    else:
+        candidates = (graph.entities[entity_id] for entity_id in graph.in_entity_order(candidate_ids))
+    for entity in candidates:
+        if type_name and entity["type"] != type_name:
+            continue
+        properties = entity["properties"]
+        if all(_matches(properties, prop, op, operand) for prop, op, operand in predicates):
+            yield entity
+
+
+def explain_query(type_name: str, where: dict, graph_path: str, sort: str = None,
+                  descending: bool = False, top: int = None, as_of=None) -> dict:
+    """Return the plan iter_query would use, without running the query."""
+    graph = load_graph_state(graph_path, as_of)
+    plan = plan_query(graph, type_name, parse_where(where))
+    plan.pop("candidates")
+    if sort:
+        plan["sort"] = {"property": sort, "descending": descending, "top": top}
+    return plan
+
+
+def query_entities(type_name: str, where: dict, graph_path: str) -> list:
+    """Query entities by type and properties."""
+    return list(iter_query(type_name, where, graph_path))
+
+
+def iter_entities(type_name: str, graph_path: str, as_of=None):
+    """Yield all entities, or those of one type."""
+    yield from load_graph_state(graph_path, as_of).entities_of(type_name)
+
+
+def aggregate_entities(graph_path: str, type_name: str = None, where: dict = None, group_by=(),
+                       distinct=(), as_of=None) -> list:
+    """Count matching entities per group in a single pass, without listing them.
+
+    group_by names "type" and/or properties; distinct names properties whose
+    distinct (non-null) values are counted per group. Rows come back as
+    {"group": {...}, "count": n, "distinct": {...}}, largest count first
+    ("group"/"distinct" only when asked for). Counting all entities of an
+    indexed type, or grouping them by one indexed property, reads the
+    index buckets instead of the entities.
+    """
+    graph = load_graph_state(graph_path, as_of)
+    predicates = parse_where(where or {})
+    group_by = list(group_by)
+    counts = collections.Counter()
+    values = collections.defaultdict(lambda: collections.defaultdict(set))
+
+    indexed = [prop for spec_type, prop in graph.indexes if spec_type == type_name]
+    if type_name and indexed and not predicates and not distinct and (
+            not group_by or (len(group_by) == 1 and group_by[0] in indexed)):
+        prop = group_by[0] if group_by else indexed[0]
+        for key, ids in graph.indexes[(type_name, prop)].items():
+            counts[(key,) if group_by else ()] += len(ids)
+    else:
+        for entity in _matching(graph, type_name, predicates):
+            properties = entity["properties"]
+            key = tuple(entity["type"] if field == "type" else _index_key(properties.get(field))
+                        for field in group_by)
+            counts[key] += 1
+            for prop in distinct:
+                value = properties.get(prop)
+                if value is not None:
+                    values[key][prop].add(_index_key(value))
+    if not group_by and not counts:
+        counts[()] = 0
+
+    rows = []
+    for key, count in counts.items():
+        row = {}
+        if group_by:
+            row["group"] = {field: _index_value(value) for field, value in zip(group_by, key)}
+        row["count"] = count
+        if distinct:
+            row["distinct"] = {prop: len(values[key][prop]) for prop in distinct}
+        rows.append(row)
+    rows.sort(key=lambda row: (-row["count"], json.dumps(row.get("group"), sort_keys=True, default=str)))
+    return rows
+
+
+def degree_stats(graph_path: str, rel_type: str = None, direction: str = "both", as_of=None) -> list:
+    """Per relation type and direction: entities with such edges, edge count and min/max/mean degree."""
+    graph = load_graph_state(graph_path, as_of)
+    rows = []
+    for side in ("outgoing", "incoming"):
+        if direction not in (side, "both"):
+            continue
+        stats = {}
+        for rel, _, degree in graph.degrees(side, rel_type):
+            entry = stats.get(rel)
+            if entry is None:
+                stats[rel] = [1, degree, degree, degree]
+            else:
+                entry[0] += 1
+                entry[1] += degree
+                entry[2] = min(entry[2], degree)
+                entry[3] = max(entry[3], degree)
+        for rel, (entities, edges, low, high) in stats.items():
+            rows.append({"relation": rel, "direction": side, "entities": entities, "edges": edges,
+                         "min": low, "max": high, "mean": round(edges / entities, 4)})
+    rows.sort(key=lambda row: (row["relation"], row["direction"] != "outgoing"))
+    return rows
+
+
+def list_entities(type_name: str, graph_path: str) -> list:
+    """List all entities of a type."""
+    return list(iter_entities(type_name, graph_path))
+
+
+def update_entity(entity_id: str, properties: dict, graph_path: str) -> dict | None:
+    """Update entity properties."""
+    def prepare(view):
+        current = view.entity(entity_id)
+        if current is None:
+            return [], None
+        
+        timestamp = datetime.now(timezone.utc).isoformat()
+        record = {"op": "update", "id": entity_id, "properties": properties, "timestamp": timestamp}
+        # Build the result without touching the loaded graph, which may be cached.
+        entity = dict(current)
+        entity["properties"] = {**entity["properties"], **properties}
+        entity["updated"] = timestamp
+        return [record], entity
+    
+    return commit(graph_path, prepare)
+
+
+def delete_entity(entity_id: str, graph_path: str) -> bool:
+    """Delete an entity."""
+    def prepare(view):
+        if view.entity(entity_id) is None:
+            return [], False
+        timestamp = datetime.now(timezone.utc).isoformat()
+        return [{"op": "delete", "id": entity_id, "timestamp": timestamp}], True
+    
+    return commit(graph_path, prepare)
+
+
+def relation_violations(view: _PendingView, schema: "CompiledSchema", from_id: str, rel_type: str,
+                        to_id: str) -> list:
+    """Validation errors that relating from_id -> to_id would introduce.
+
+    Covers what `validate` checks for an edge of a schema relation
+    (endpoints and their types, cardinality, acyclicity) against the graph
+    plus the writes committed ahead of it. Cardinality looks only at the
+    endpoints' edges and acyclicity at nodes between them in the relation's
+    topological order, so the cost follows the neighborhood, not the graph.
+    """
+    rel_schema = schema.relations.get(rel_type)
+    if rel_schema is None:
+        return []
+    types = {}
+    for entity_id in (from_id, to_id):
+        entity = view.entity(entity_id)
+        if entity is not None:
+            types[entity_id] = entity["type"]
+    errors = _edge_errors(types, rel_type, rel_schema, from_id, to_id)
+    for side in rel_schema["sides"]:
+        node = from_id if side == "from" else to_id
+        if view.degree(node, rel_type, side) >= 1:
+            errors.append(f"{rel_type}: {side} entity {node} violates cardinality {rel_schema['cardinality']}")
+    if rel_schema["acyclic"] and view.creates_cycle(from_id, rel_type, to_id):
+        errors.append(f"{rel_type}: {from_id} -> {to_id} would create a cycle")
+    return errors
+
+
+def create_relation(from_id: str, rel_type: str, to_id: str, properties: dict, graph_path: str,
+                    enforce: bool = False, schema_path: str = DEFAULT_SCHEMA_PATH):
+    """Create a relation between entities.
+
+    With enforce=True the relation is first checked against the schema
+    (see relation_violations) under the writer lock, and rejected with
+    SystemExit instead of appended if it would violate it.
+    """
+    schema = load_compiled_schema(schema_path) if enforce else None
+
+    def prepare(view):
+        if enforce:
+            errors = relation_violations(view, schema, from_id, rel_type, to_id)
+            if errors:
+                raise SystemExit("Relation rejected:\n" + "\n".join(f"  - {error}" for error in errors))
+        # Stamped under the writer lock, so timestamps follow log order.
+        record = {
+            "op": "relate",
+            "from": from_id,
+            "rel": rel_type,
+            "to": to_id,
+            "properties": properties,
+            "timestamp": datetime.now(timezone.utc).isoformat()
+        }
+        return [record], record
+
+    return commit(graph_path, prepare)
+
+
+def iter_related(entity_id: str, rel_type: str, graph_path: str, direction: str = "outgoing",
+                 as_of=None):
+    """Yield related entities as they are found."""
+    graph = load_graph_state(graph_path, as_of)
+    
+    for rel, other_id, rel_dir in graph.edges_of(entity_id, rel_type, direction):
+        entity = graph.entities.get(other_id)
+        if entity is None:
+            continue
+        if direction == "both":
+            yield {"relation": rel["rel"], "direction": rel_dir, "entity": entity}
+        else:
+            yield {"relation": rel["rel"], "entity": entity}
+
+
+def get_related(entity_id: str, rel_type: str, graph_path: str, direction: str = "outgoing") -> list:
+    """Get related entities."""
+    return list(iter_related(entity_id, rel_type, graph_path, direction))
+
+
+def traverse(seeds: list, rel_types: list, graph_path: str, direction: str = "outgoing",
+             max_depth: int = None, order: str = "bfs"):
+    """Yield entities reachable from seeds within max_depth hops (one graph load)."""
+    graph = load_graph_state(graph_path)
+    for entity_id, depth, parent_id, rel_type, rel_dir in graph.traverse(
+            seeds, rel_types, direction, max_depth, order):
+        yield {
+            "depth": depth,
+            "parent": parent_id,
+            "relation": rel_type,
+            "direction": rel_dir,
+            "entity": graph.entities[entity_id]
+        }
+
+
+def find_path(from_id: str, to_id: str, rel_types: list, graph_path: str,
+              direction: str = "outgoing", max_depth: int = None) -> dict | None:
+    """Shortest path between two entities, or None if they are not connected."""
+    graph = load_graph_state(graph_path)
+    if from_id not in graph.entities or to_id not in graph.entities:
+        return None
+    steps = graph.shortest_path(from_id, to_id, rel_types, direction, max_depth)
+    if steps is None:
+        return None
+    return {
+        "length": len(steps),
+        "ids": [from_id] + [step[2] for step in steps],
+        "steps": [
+            {"from": a, "rel": rel, "to": b, "direction": step_dir} for a, rel, b, step_dir in steps
+        ]
+    }
+
+
+def tokenize(text: str) -> list:
+    """Lowercased search tokens of text."""
+    return _TOKEN.findall(text.lower())
+
+
+def _field_terms(value) -> dict:
+    """Term counts of a property value: its strings, including inside lists."""
+    counts = collections.Counter()
+    if isinstance(value, str):
+        counts.update(tokenize(value))
+    elif isinstance(value, list):
+        for item in value:
+            counts.update(_field_terms(item))
+    return counts
+
+
+def search_index_path(graph_path: str) -> Path:
+    """Return the full-text search index file for a graph log."""
+    return Path(f"{graph_path}.search")
+
+
+class SearchIndex:
+    """Inverted index over the string property values of a graph's entities.
+
+    Kept in SQLite next to the log: postings per term, document frequency
+    per term, and per entity its type, token count and per-property term
+    counts (so an update replaces only the properties it touches). `meta`
+    records the log offset and fingerprint the index covers; sync() indexes
+    what was appended since. Ranking is BM25.
+    """
+
+    def __init__(self, path):
+        import sqlite3
+        
+        self.path = str(path)
+        self.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != SEARCH_FORMAT:
+            # Derived data: an unknown or missing format is simply rebuilt.
+            with self.transaction():
+                if self.conn.execute("PRAGMA user_version").fetchone()[0] == SEARCH_FORMAT:
+                    return  # Another process created it meanwhile.
+                for table in ("meta", "docs", "terms", "postings"):
+                    self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+                # executescript() would commit; run the statements one by one.
+                for statement in SEARCH_SCHEMA.split(";"):
+                    if statement.strip():
+                        self.conn.execute(statement)
+                self.conn.execute(f"PRAGMA user_version = {SEARCH_FORMAT}")
+
+    def close(self) -> None:
+        self.conn.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def _meta(self, key: str, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def _set_meta(self, **values) -> None:
+        self.conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", values.items())
+
+    def position(self) -> tuple[int, str | None]:
+        """(log offset, fingerprint) the index covers."""
+        return self._meta("offset", 0), self._meta("fingerprint")
+
+    def _current(self, f) -> bool:
+        offset, fingerprint = self.position()
+        return offset == _last_line_end(f) and (not offset or _log_fingerprint(f, offset) == fingerprint)
+
+    def sync(self, graph_path: str) -> None:
+        """Bring the index up to date with the log at graph_path.
+
+        Records appended since the covered offset are applied in one
+        transaction; a rewritten log (e.g. after `compact`) or a new index
+        is rebuilt from the loaded graph instead.
+        """
+        graph_file = Path(graph_path)
+        if not graph_file.exists():
+            if self.position()[0]:
+                with self.transaction():
+                    self._clear()
+            return
+        with open(graph_file, "rb") as f:
+            if self._current(f):
+                return
+            with self.transaction():
+                offset, fingerprint = self.position()
+                stale = offset > os.fstat(f.fileno()).st_size or (
+                    offset and _log_fingerprint(f, offset) != fingerprint)
+                if not offset or stale:
+                    self._rebuild(load_graph_state(graph_path))
+                    return
+                end = _last_line_end(f)
+                with _gc_paused():
+                    for record in iter_records(f, offset, end):
+                        self.apply(record)
+                self._set_meta(offset=end, fingerprint=_log_fingerprint(f, end))
+
+    def _clear(self) -> None:
+        for table in ("meta", "docs", "terms", "postings"):
+            self.conn.execute(f"DELETE FROM {table}")
+
+    def _rebuild(self, graph: Graph) -> None:
+        self._clear()
+        df = collections.Counter()
+        total = 0
+        for doc, entity in enumerate(graph.entities.values(), 1):
+            fields = {prop: _field_terms(value) for prop, value in _properties_of(entity).items()}
+            counts = self._merged(fields)
+            length = sum(counts.values())
+            total += length
+            df.update(counts.keys())
+            self.conn.execute("INSERT INTO docs VALUES (?, ?, ?, ?, ?)",
+                              (doc, entity["id"], entity.get("type"), length, self._dump(fields)))
+            self.conn.executemany("INSERT INTO postings VALUES (?, ?, ?)",
+                                  ((term, doc, tf) for term, tf in counts.items()))
+        self.conn.executemany("INSERT INTO terms VALUES (?, ?)", df.items())
+        self._set_meta(docs=len(graph.entities), length=total, offset=graph.offset,
+                       fingerprint=graph.fingerprint)
+
+    @staticmethod
+    def _merged(fields: dict) -> collections.Counter:
+        counts = collections.Counter()
+        for terms in fields.values():
+            counts.update(terms)
+        return counts
+
+    @staticmethod
+    def _dump(fields: dict) -> str:
+        return json.dumps({prop: terms for prop, terms in fields.items() if terms})
+
+    def apply(self, record: dict) -> None:
+        """Apply one log record to the index."""
+        op = record.get("op")
+        if op == "create":
+            entity = record["entity"]
+            self._remove(entity["id"])
+            fields = {prop: _field_terms(value) for prop, value in entity.get("properties", {}).items()}
+            self._add(entity["id"], entity.get("type"), fields)
+        elif op == "update":
+            row = self.conn.execute("SELECT type, fields FROM docs WHERE id = ?", (record["id"],)).fetchone()
+            if row is not None:
+                fields = json.loads(row[1])
+                for prop, value in record.get("properties", {}).items():
+                    fields[prop] = _field_terms(value)
+                self._remove(record["id"])
+                self._add(record["id"], row[0], fields)
+        elif op == "delete":
+            self._remove(record["id"])
+
+    def _add(self, entity_id: str, type_name: str, fields: dict) -> None:
+        counts = self._merged(fields)
+        length = sum(counts.values())
+        doc = self.conn.execute("INSERT INTO docs (id, type, length, fields) VALUES (?, ?, ?, ?)",
+                                (entity_id, type_name, length, self._dump(fields))).lastrowid
+        self.conn.executemany("INSERT INTO postings VALUES (?, ?, ?)",
+                              ((term, doc, tf) for term, tf in counts.items()))
+        self.conn.executemany("INSERT INTO terms VALUES (?, 1) ON CONFLICT (term) DO UPDATE SET df = df + 1",
+                              ((term,) for term in counts))
+        self._set_meta(docs=self._meta("docs", 0) + 1, length=self._meta("length", 0) + length)
+
+    def _remove(self, entity_id: str) -> None:
+        row = self.conn.execute("SELECT doc, length, fields FROM docs WHERE id = ?", (entity_id,)).fetchone()
+        if row is None:
+            return
+        doc, length, fields = row
+        terms = [(term,) for term in self._merged(json.loads(fields))]
+        self.conn.executemany("DELETE FROM postings WHERE term = ? AND doc = ?",
+                              ((term, doc) for (term,) in terms))
+        self.conn.executemany("UPDATE terms SET df = df - 1 WHERE term = ?", terms)
+        self.conn.executemany("DELETE FROM terms WHERE term = ? AND df <= 0", terms)
+        self.conn.execute("DELETE FROM docs WHERE doc = ?", (doc,))
+        self._set_meta(docs=self._meta("docs", 0) - 1, length=self._meta("length", 0) - length)
+
+    def _expand(self, word: str) -> list:
+        """(term, df) pairs a query word matches; a trailing * matches by prefix."""
+        prefix = word.endswith("*")
+        tokens = tokenize(word)
+        if not tokens:
+            return []
+        if not prefix:
+            return [self.conn.execute("SELECT term, df FROM terms WHERE term = ?", (token,)).fetchone()
+                    for token in tokens]
+        *exact, stem = tokens
+        matched = [self.conn.execute("SELECT term, df FROM terms WHERE term = ?", (token,)).fetchone()
+                   for token in exact]
+        # Every term starting with stem sorts in [stem, stem + U+10FFFF).
+        matched += self.conn.execute("SELECT term, df FROM terms WHERE term >= ? AND term < ?",
+                                     (stem, stem + "\U0010ffff")).fetchall()
+        return matched
+
+    def search(self, query: str, type_name: str = None, top: int = None) -> list:
+        """Entities matching any query term, best BM25 score first.
+
+        Words ending in * match every term with that prefix. Returns
+        {"id", "type", "score"} dicts; top keeps only the best top results.
+        """
+        docs = self._meta("docs", 0)
+        if not docs:
+            return []
+        average = (self._meta("length", 0) / docs) or 1
+        terms = {}
+        for word in query.split():
+            for match in self._expand(word):
+                if match is not None:
+                    terms[match[0]] = match[1]
+        sql = "SELECT p.doc, p.tf, d.length FROM postings p JOIN docs d ON d.doc = p.doc WHERE p.term = ?"
+        if type_name:
+            sql += " AND d.type = ?"
+        scores = collections.defaultdict(float)
+        for term, df in terms.items():
+            idf = math.log(1 + (docs - df + 0.5) / (df + 0.5))
+            params = (term, type_name) if type_name else (term,)
+            for doc, tf, length in self.conn.execute(sql, params):
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * length / average)
+                scores[doc] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        ranked = ((-score, doc) for doc, score in scores.items())
+        best = heapq.nsmallest(top, ranked) if top is not None else sorted(ranked)
+        results = []
+        for score, doc in best:
+            entity_id, type_ = self.conn.execute("SELECT id, type FROM docs WHERE doc = ?", (doc,)).fetchone()
+            results.append({"id": entity_id, "type": type_, "score": round(-score, 6)})
+        return results
+
+
+def search_entities(query: str, graph_path: str, type_name: str = None, top: int = None) -> list:
+    """Full-text search over entity string properties, ranked by BM25."""
+    index = SearchIndex(search_index_path(graph_path))
+    try:
+        index.sync(graph_path)
+        return index.search(query, type_name, top)
+    finally:
+        index.close()
+
+
+def print_results(results, fmt: str = "json", limit: int = None, offset: int = 0) -> None:
+    """Print results as a JSON array, or stream them one per line for ndjson."""
+    stop = None if limit is None else offset + limit
+    results = itertools.islice(results, offset, stop)
+    if fmt == "ndjson":
+        for item in results:
+            with _phase("output"):
+                sys.stdout.write(json.dumps(item) + "\n")
+    else:
+        results = list(results)
+        with _phase("output"):
+            print(json.dumps(results, indent=2))
+
+
+def _compile_schema(schema: dict) -> dict:
+    """Reduce a schema to the JSON spec CompiledSchema builds its checks from.
+
+    Per type: required and forbidden properties and (property, allowed)
+    pairs from its *_enum keys; types without checks are left out. Per
+    relation: endpoint types, cardinality (and the sides it limits) and
+    acyclicity. event_rules counts the Event end >= start constraints.
+    """
+    types = {}
+    for type_name, type_schema in (schema.get("types") or {}).items():
+        type_schema = type_schema or {}
+        spec = {
+            "required": list(type_schema.get("required") or []),
+            "forbidden": list(type_schema.get("forbidden_properties") or []),
+            "enums": [
+                [prop.replace("_enum", ""), allowed]
+                for prop, allowed in type_schema.items() if prop.endswith("_enum")
+            ],
+        }
+        if any(spec.values()):
+            types[type_name] = spec
+    relations = {}
+    for rel_type, rel_schema in (schema.get("relations") or {}).items():
+        rel_schema = rel_schema or {}
+        cardinality = rel_schema.get("cardinality")
+        relations[rel_type] = {
+            "from_types": list(rel_schema.get("from_types") or []),
+            "to_types": list(rel_schema.get("to_types") or []),
+            "cardinality": cardinality,
+            "sides": _cardinality_sides(cardinality),
+            "acyclic": bool(rel_schema.get("acyclic", False)),
+        }
+    # relation/acyclic constraints are enforced via the relations schema.
+    event_rules = 0
+    for constraint in schema.get("constraints") or []:
+        rule = (constraint.get("rule") or "").strip().lower()
+        if constraint.get("type") == "Event" and "end" in rule and "start" in rule:
+            event_rules += 1
+    return {"types": types, "relations": relations, "event_rules": event_rules}
+
+
+def _members(allowed):
+    """allowed as a frozenset for fast lookups when its values are hashable."""
+    if isinstance(allowed, list):
+        try:
+            return frozenset(allowed)
+        except TypeError:
+            pass
+    return allowed
+
+
+def _type_checker(spec: dict):
+    """Build the required/forbidden/enum check for one type."""
+    required = tuple(spec["required"])
+    forbidden = tuple(spec["forbidden"])
+    enums = [(field, _members(allowed), allowed) for field, allowed in spec["enums"]]
+
+    def check(entity: dict) -> list:
+        entity_id = entity["id"]
+        properties = entity["properties"]
+        errors = [
+            f"{entity_id}: missing required property '{prop}'"
+            for prop in required if prop not in properties
+        ]
+        for prop in forbidden:
+            if prop in properties:
+                errors.append(f"{entity_id}: contains forbidden property '{prop}'")
+        for field, members, allowed in enums:
+            value = properties.get(field)
+            if not value:
+                continue
+            try:
+                valid = value in members
+            except TypeError:  # Unhashable value: compare against the list.
+                valid = value in allowed
+            if not valid:
+                errors.append(f"{entity_id}: '{field}' must be one of {allowed}, got '{value}'")
+        return errors
+
+    return check
+
+
+def _event_window_errors(entity: dict) -> list:
+    """Errors for an Event whose end is before its start."""
+    start = entity["properties"].get("start")
+    end = entity["properties"].get("end")
+    if start and end:
+        try:
+            if datetime.fromisoformat(end) < datetime.fromisoformat(start):
+                return [f"{entity['id']}: end must be >= start"]
+        except ValueError:
+            return [f"{entity['id']}: invalid datetime format in start/end"]
+    return []
+
+
+class CompiledSchema:
+    """A schema compiled into per-type check functions for validation.
+
+    schema is the parsed schema, hash the SHA-256 of its file, relations
+    the compiled relation specs in schema order (see _compile_schema).
+    """
+
+    def __init__(self, schema: dict, spec: dict, schema_hash: str):
+        self.schema = schema
+        self.hash = schema_hash
+        self.relations = spec["relations"]
+        self._checks = {type_name: _type_checker(type_spec) for type_name, type_spec in spec["types"].items()}
+        self._event_rules = spec["event_rules"]
+
+    def entity_errors(self, entity: dict) -> list:
+        """Required/forbidden/enum errors for one entity."""
+        check = self._checks.get(entity["type"])
+        return check(entity) if check is not None else []
+
+    def event_errors(self, entity: dict) -> list:
+        """Errors from global constraints (limited enforcement: Event end >= start)."""
+        if not self._event_rules or entity["type"] != "Event":
+            return []
+        return _event_window_errors(entity) * self._event_rules
+
+
+def _edge_errors(types: dict, rel_type: str, rel_schema: dict, from_id: str, to_id: str) -> list:
+    """Endpoint existence/type errors for one relation edge (types: entity id -> type)."""
+    if from_id not in types or to_id not in types:
+        return [f"{rel_type}: relation references missing entity ({from_id} -> {to_id})"]
+    from_type = types[from_id]
+    to_type = types[to_id]
+    errors = []
+    from_types = rel_schema["from_types"]
+    to_types = rel_schema["to_types"]
+    if from_types and from_type not in from_types:
+        errors.append(
+            f"{rel_type}: from entity {from_id} type {from_type} not in {from_types}"
+        )
+    if to_types and to_type not in to_types:
+        errors.append(
+            f"{rel_type}: to entity {to_id} type {to_type} not in {to_types}"
+        )
+    return errors
+
+
+def _degree(adjacency: dict, node: str, rel_type: str) -> int:
+    """Number of rel_type edges (parallel edges included) on one side of node."""
+    return sum(len(parallel) for parallel in adjacency.get(node, {}).get(rel_type, {}).values())
+
+
+def _cardinality_sides(cardinality: str) -> list:
+    """Which endpoints of a relation may appear at most once."""
+    sides = []
+    if cardinality in ("one_to_one", "many_to_one"):
+        sides.append("from")
+    if cardinality in ("one_to_one", "one_to_many"):
+        sides.append("to")
+    return sides
+
+
+def _cycle_groups(graph: Graph, rel_type: str) -> list:
+    """The groups of entities that lie on a directed cycle of rel_type edges.
+
+    Each group is a strongly connected component (found with an iterative
+    Tarjan pass, so long chains cannot hit the recursion limit) with more
+    than one member, or a single entity with a self-loop. Members are
+    listed in discovery order and groups by their first member.
+    """
+    outgoing = graph.outgoing
+    no_edges = {}
+    order = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    groups = []
+    for root, by_rel in outgoing.items():
+        if rel_type not in by_rel or root in order:
+            continue
+        order[root] = low[root] = len(order)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(by_rel[rel_type]))]
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in order:
+                    order[child] = low[child] = len(order)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(outgoing.get(child, no_edges).get(rel_type, no_edges))))
+                    break
+                if child in on_stack and order[child] < low[node]:
+                    low[node] = order[child]
+            else:
+                work.pop()
+                node_low = low[node]
+                if work and node_low < low[work[-1][0]]:
+                    low[work[-1][0]] = node_low
+                if node_low != order[node]:
+                    continue
+                member = stack.pop()
+                on_stack.discard(member)
+                if member == node:
+                    # A single entity: a cycle only through a self-loop.
+                    if node in outgoing.get(node, no_edges).get(rel_type, no_edges):
+                        groups.append([node])
+                    continue
+                members = [member]
+                while member != node:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    members.append(member)
+                groups.append(members[::-1])
+    groups.sort(key=lambda members: order[members[0]])
+    return groups
+
+
+class ValidationState:
+    """Per-check validation results for a graph, keyed so they can be patched.
+
+    entity_errors/event_errors map entity id -> errors, edge_errors maps
+    (from, rel, to) -> errors of a single edge, cardinality maps rel type ->
+    side ("from"/"to") -> ids over the limit, cyclic maps each acyclic
+    relation type that has cycles to its cycle groups (see _cycle_groups).
+    offset/fingerprint record how much of the log the results cover.
+    """
+
+    def __init__(self, schema_hash: str = None):
+        self.schema_hash = schema_hash
+        self.offset = 0
+        self.fingerprint = None
+        self.entity_errors = {}
+        self.event_errors = {}
+        self.edge_errors = {}
+        self.cardinality = {}
+        self.cyclic = {}
+
+    def to_json(self) -> dict:
+        return {
+            "version": VALIDATION_STATE_FORMAT,
+            "schema_hash": self.schema_hash,
+            "offset": self.offset,
+            "fingerprint": self.fingerprint,
+            "entity_errors": self.entity_errors,
+            "event_errors": self.event_errors,
+            "edge_errors": [[*key, errors] for key, errors in self.edge_errors.items()],
+            "cardinality": {
+                rel_type: {side: sorted(ids) for side, ids in sides.items()}
+                for rel_type, sides in self.cardinality.items()
+            },
+            "cyclic": self.cyclic,
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> "ValidationState":
+        if data.get("version") != VALIDATION_STATE_FORMAT:
+            raise ValueError("unsupported validation state")
+        state = cls(data["schema_hash"])
+        state.offset = data["offset"]
+        state.fingerprint = data["fingerprint"]
+        state.entity_errors = data["entity_errors"]
+        state.event_errors = data["event_errors"]
+        state.edge_errors = {(f, r, t): errors for f, r, t, errors in data["edge_errors"]}
+        state.cardinality = {
+            rel_type: {side: set(ids) for side, ids in sides.items()}
+            for rel_type, sides in data["cardinality"].items()
+        }
+        state.cyclic = data["cyclic"]
+        return state
+
+    def check_entity(self, graph: Graph, entity_id: str, schema: CompiledSchema) -> None:
+        self.entity_errors.pop(entity_id, None)
+        self.event_errors.pop(entity_id, None)
+        entity = graph.entities.get(entity_id)
+        if entity is None:
+            return
+        errors = schema.entity_errors(entity)
+        if errors:
+            self.entity_errors[entity_id] = errors
+        errors = schema.event_errors(entity)
+        if errors:
+            self.event_errors[entity_id] = errors
+
+    def check_edge(self, graph: Graph, key: tuple, schema: CompiledSchema) -> None:
+        self.edge_errors.pop(key, None)
+        from_id, rel_type, to_id = key
+        rel_schema = schema.relations.get(rel_type)
+        if rel_schema is None or key not in graph.edges:
+            return
+        types = {}
+        for entity_id in (from_id, to_id):
+            entity = graph.entities.get(entity_id)
+            if entity is not None:
+                types[entity_id] = entity["type"]
+        errors = _edge_errors(types, rel_type, rel_schema, from_id, to_id)
+        if errors:
+            self.edge_errors[key] = errors
+
+    def check_cardinality(self, graph: Graph, rel_type: str, side: str, node: str,
+                          schema: CompiledSchema) -> None:
+        violators = self.cardinality.setdefault(rel_type, {}).setdefault(side, set())
+        violators.discard(node)
+        rel_schema = schema.relations.get(rel_type)
+        if rel_schema is not None and side in rel_schema["sides"]:
+            adjacency = graph.outgoing if side == "from" else graph.incoming
+            if _degree(adjacency, node, rel_type) > 1:
+                violators.add(node)
+
+    def check_cycles(self, graph: Graph, rel_type: str, schema: CompiledSchema) -> None:
+        self.cyclic.pop(rel_type, None)
+        rel_schema = schema.relations.get(rel_type)
+        if rel_schema is not None and rel_schema["acyclic"]:
+            with _gc_paused():
+                groups = _cycle_groups(graph, rel_type)
+            if groups:
+                self.cyclic[rel_type] = groups
+
+    def errors(self, graph: Graph, schema: CompiledSchema) -> list:
+        """Render the results in the order a full validation reports them."""
+        errors = []
+        if self.entity_errors:
+            for entity_id in graph.entities:
+                errors.extend(self.entity_errors.get(entity_id, ()))
+        
+        edges = None
+        for rel_type, rel_schema in schema.relations.items():
+            if any(key[1] == rel_type for key in self.edge_errors):
+                edges = edges or graph.ordered_edges()
+                for key, _ in edges:
+                    if key[1] == rel_type and key in self.edge_errors:
+                        errors.extend(self.edge_errors[key])
+            cardinality = rel_schema["cardinality"]
+            for side in ("from", "to"):
+                violators = self.cardinality.get(rel_type, {}).get(side)
+                if not violators:
+                    continue
+                index = 0 if side == "from" else 2
+                seen = set()
+                edges = edges or graph.ordered_edges()
+                for key, _ in edges:
+                    node = key[index]
+                    if key[1] == rel_type and node in violators and node not in seen:
+                        seen.add(node)
+                        errors.append(f"{rel_type}: {side} entity {node} violates cardinality {cardinality}")
+            for members in self.cyclic.get(rel_type, ()):
+                errors.append(f"{rel_type}: cyclic dependency detected among {', '.join(members)}")
+        
+        if self.event_errors:
+            for entity_id in graph.entities:
+                errors.extend(self.event_errors.get(entity_id, ()))
+        return errors
+
+
+def _full_validation(graph: Graph, schema: CompiledSchema) -> ValidationState:
+    """Run every check in one pass per kind, filling a fresh ValidationState."""
+    state = ValidationState(schema.hash)
+    types = {}
+    for entity_id, entity in graph.entities.items():
+        types[entity_id] = entity["type"]
+        errors = schema.entity_errors(entity)
+        if errors:
+            state.entity_errors[entity_id] = errors
+        errors = schema.event_errors(entity)
+        if errors:
+            state.event_errors[entity_id] = errors
+    relation_schemas = schema.relations
+    for key in graph.edges:
+        from_id, rel_type, to_id = key
+        rel_schema = relation_schemas.get(rel_type)
+        if rel_schema is not None:
+            errors = _edge_errors(types, rel_type, rel_schema, from_id, to_id)
+            if errors:
+                state.edge_errors[key] = errors
+    for rel_type, rel_schema in relation_schemas.items():
+        for side in rel_schema["sides"]:
+            adjacency = graph.outgoing if side == "from" else graph.incoming
+            violators = state.cardinality.setdefault(rel_type, {}).setdefault(side, set())
+            for node, by_rel in adjacency.items():
+                others = by_rel.get(rel_type)
+                if others and sum(map(len, others.values())) > 1:
+                    violators.add(node)
+        state.check_cycles(graph, rel_type, schema)
+    return state
+
+
+def validation_state_path(graph_path: str) -> Path:
+    """Return the file holding incremental validation state for a graph log."""
+    return Path(f"{graph_path}.validation")
+
+
+def _schema_hash(schema_path: str) -> str:
+    schema_file = Path(schema_path)
+    data = schema_file.read_bytes() if schema_file.exists() else b""
+    return hashlib.sha256(data).hexdigest()
+
+
+def _load_validation_state(graph_path: str, schema_hash: str, f) -> ValidationState | None:
+    """Return the saved state if it matches the schema and is a prefix of the log."""
+    state_file = validation_state_path(graph_path)
+    if not state_file.exists():
+        return None
+    try:
+        with open(state_file) as sf:
+            state = ValidationState.from_json(json.load(sf))
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if state.schema_hash != schema_hash:
+        return None
+    if os.fstat(f.fileno()).st_size < state.offset:
+        return None
+    if _log_fingerprint(f, state.offset) != state.fingerprint:
+        return None
+    return state
+
+
+def _touched_since(f, offset: int, end: int) -> tuple[set, set]:
+    """Entity ids and relation keys written to the log between offset and end."""
+    entity_ids, relation_keys = set(), set()
+    f.seek(offset)
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            break  # Unterminated tail still being written.
+        op = record.get("op")
+        if op == "create":
+            entity_ids.add(record["entity"]["id"])
+        elif op in ("update", "delete"):
+            entity_ids.add(record["id"])
+        elif op in ("relate", "unrelate"):
+            relation_keys.add((record["from"], record["rel"], record["to"]))
+        if f.tell() >= end:
+            break
+    return entity_ids, relation_keys
+
+
+def validate_graph_incremental(graph_path: str, schema_path: str) -> tuple[list, dict]:
+    """Validate, rechecking only what changed since the last incremental run.
+
+    The per-check results and the log offset they cover are kept in
+    graph.jsonl.validation. Entities written since then are rechecked, as are
+    relation edges that were written or touch a rewritten entity,
+    cardinality for their endpoints and acyclicity for their relation types.
+    A changed schema (by content hash) or rewritten log falls back to a full
+    validation. Returns (errors, info about what was rechecked). A SQLite
+    graph has no log offsets to track and is always validated in full.
+    """
+    if is_sqlite(graph_path):
+        graph = load_graph_state(graph_path).materialize()
+        info = {"mode": "full", "entities": len(graph.entities), "relations": graph.relation_count}
+        schema = load_compiled_schema(schema_path)
+        return _full_validation(graph, schema).errors(graph, schema), info
+    graph = load_graph_state(graph_path)
+    schema = load_compiled_schema(schema_path)
+    relation_schemas = schema.relations
+    
+    graph_file = Path(graph_path)
+    state = None
+    info = {"mode": "full", "entities": len(graph.entities), "relations": graph.relation_count}
+    if graph_file.exists():
+        with open(graph_file, "rb") as f:
+            state = _load_validation_state(graph_path, schema.hash, f)
+            if state is not None:
+                entity_ids, relation_keys = _touched_since(f, state.offset, graph.offset)
+    
+    if state is None:
+        state = _full_validation(graph, schema)
+    else:
+        edge_keys = {key for key in relation_keys if key[1] in relation_schemas}
+        for entity_id in entity_ids:
+            state.check_entity(graph, entity_id, schema)
+            for adjacency, index in ((graph.outgoing, 0), (graph.incoming, 2)):
+                for rel_type, others in adjacency.get(entity_id, {}).items():
+                    if rel_type not in relation_schemas:
+                        continue
+                    for other in others:
+                        key = (entity_id, rel_type, other) if index == 0 else (other, rel_type, entity_id)
+                        edge_keys.add(key)
+        for key in edge_keys:
+            state.check_edge(graph, key, schema)
+        touched_types = set()
+        for from_id, rel_type, to_id in relation_keys:
+            if rel_type not in relation_schemas:
+                continue
+            touched_types.add(rel_type)
+            state.check_cardinality(graph, rel_type, "from", from_id, schema)
+            state.check_cardinality(graph, rel_type, "to", to_id, schema)
+        for rel_type in touched_types:
+            state.check_cycles(graph, rel_type, schema)
+        info = {
+            "mode": "incremental",
+            "entities": len(entity_ids),
+            "relations": len(edge_keys),
+            "relation_types": sorted(touched_types),
+        }
+    
+    state.offset = graph.offset
+    state.fingerprint = graph.fingerprint
+    if graph_file.exists():
+        try:
+            with _atomic_write(validation_state_path(graph_path)) as f:
+                json.dump(state.to_json(), f)
+        except OSError:
+            pass  # Next run simply validates in full again.
+    return state.errors(graph, schema), info
+
+
+def validate_graph(graph_path: str, schema_path: str) -> list:
+    """Validate graph against schema constraints."""
+    graph = load_graph_state(graph_path)
+    if isinstance(graph, SqliteGraph):
+        graph = graph.materialize()
+    schema = load_compiled_schema(schema_path)
+    return _full_validation(graph, schema).errors(graph, schema)
+
+
+def load_schema(schema_path: str) -> dict:
+    """Load schema from YAML if it exists."""
+    schema = {}
+    schema_file = Path(schema_path)
+    if schema_file.exists():
+        import yaml
+        with open(schema_file) as f:
+            schema = yaml.safe_load(f) or {}
+    return schema
+
+
+def compiled_schema_path(schema_path: str) -> Path:
+    """Return the cache of the compiled form of a schema file."""
+    return Path(f"{schema_path}.compiled")
+
+
+def _read_compiled_schema(cache_file: Path) -> dict | None:
+    try:
+        with open(cache_file) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get("format") != SCHEMA_CACHE_FORMAT:
+        return None
+    return data
+
+
+def load_compiled_schema(schema_path: str) -> CompiledSchema:
+    """Load the schema as a CompiledSchema, through its cache when current.
+
+    The cache (schema.yaml.compiled) holds the parsed schema and its
+    compiled spec together with the schema file's mtime, size and hash.
+    A matching mtime and size use it without reading the schema; a
+    matching hash only refreshes the recorded mtime. Only a changed
+    schema is parsed (importing PyYAML) and compiled again. Compiled
+    schemas are also kept per process, so `serve` compiles once.
+    """
+    schema_file = Path(schema_path)
+    try:
+        stat = schema_file.stat()
+    except FileNotFoundError:
+        return CompiledSchema({}, _compile_schema({}), _schema_hash(schema_path))
+    stamp = [stat.st_mtime_ns, stat.st_size]
+    cached = _COMPILED_SCHEMAS.get(str(schema_file))
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    cache_file = compiled_schema_path(schema_path)
+    data = _read_compiled_schema(cache_file)
+    if data is None or data.get("stamp") != stamp:
+        raw = schema_file.read_bytes()
+        digest = hashlib.sha256(raw).hexdigest()
+        if data is None or data.get("hash") != digest:
+            import yaml
+            schema = yaml.safe_load(raw) or {}
+            data = {"format": SCHEMA_CACHE_FORMAT, "hash": digest, "schema": schema,
+                    "spec": _compile_schema(schema)}
+        data["stamp"] = stamp
+        try:
+            # Values JSON cannot round-trip (e.g. YAML dates) are not cached.
+            text = json.dumps(data)
+            if json.loads(text) == data:
+                with _atomic_write(cache_file) as f:
+                    f.write(text)
+        except (TypeError, ValueError, OSError):
+            pass  # The cache is an optimization; validation still works without it.
+
+    compiled = CompiledSchema(data["schema"], data["spec"], data["hash"])
+    _COMPILED_SCHEMAS[str(schema_file)] = (stamp, compiled)
+    return compiled
+
+
+def write_schema(schema_path: str, schema: dict) -> None:
+    """Write schema to YAML."""
+    schema_file = Path(schema_path)
+    schema_file.parent.mkdir(parents=True, exist_ok=True)
+    import yaml
+    with open(schema_file, "w") as f:
+        yaml.safe_dump(schema, f, sort_keys=False)
+
+
+def merge_schema(base: dict, incoming: dict) -> dict:
+    """Merge incoming schema into base, appending lists and deep-merging dicts."""
+    for key, value in (incoming or {}).items():
+        if key in base and isinstance(base[key], dict) and isinstance(value, dict):
+            base[key] = merge_schema(base[key], value)
+        elif key in base and isinstance(base[key], list) and isinstance(value, list):
+            base[key] = base[key] + [v for v in value if v not in base[key]]
+        else:
+            base[key] = value
+    return base
+
+
+def append_schema(schema_path: str, incoming: dict) -> dict:
+    """Append/merge schema fragment into existing schema."""
+    base = load_schema(schema_path)
+    merged = merge_schema(base, incoming)
+    write_schema(schema_path, merged)
+    return merged
+
+
+class _SocketOutput(io.TextIOBase):
+    """Text stream that forwards writes to a client as {"<channel>": text} lines."""
+
+    def __init__(self, wfile, channel: str):
+        self._wfile = wfile
+        self._channel = channel
+        self._chunks = []
+        self._size = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        self._chunks.append(text)
+        self._size += len(text)
+        if self._size >= SERVER_OUTPUT_CHUNK:
+            self.flush()
+        return len(text)
+
+    def flush(self) -> None:
+        if self._chunks:
+            message = {self._channel: "".join(self._chunks)}
+            self._wfile.write((json.dumps(message) + "\n").encode())
+            self._chunks = []
+            self._size = 0
+        self._wfile.flush()
+
+
+class _ThreadStreams:
+    """Stand-in for sys.stdout/stderr/stdin that defers to a per-thread stream.
+
+    Server threads run commands concurrently, so each one swaps in its own
+    client stream here instead of replacing the process-wide sys.stdout.
+    """
+
+    def __init__(self, default):
+        self._default = default
+        self._local = threading.local()
+
+    def _stream(self):
+        return getattr(self._local, "stream", self._default)
+
+    def __getattr__(self, name):
+        return getattr(self._stream(), name)
+
+    def __iter__(self):
+        return iter(self._stream())
+
+    @contextlib.contextmanager
+    def use(self, stream):
+        self._local.stream = stream
+        try:
+            yield
+        finally:
+            del self._local.stream
+
+
+def _run_forwarded(request: dict, wfile) -> int:
+    """Run one client request in-process and return its exit code.
+
+    Expects sys.stdout, sys.stderr and sys.stdin to be _ThreadStreams, as
+    installed by serve().
+    """
+    out = _SocketOutput(wfile, "stdout")
+    err = _SocketOutput(wfile, "stderr")
+    code = 0
+    with sys.stdout.use(out), sys.stderr.use(err), sys.stdin.use(io.StringIO(request.get("stdin", ""))):
+        try:
+            args = build_parser().parse_args(request["argv"])
+            if args.command == "serve":
+                raise SystemExit("serve cannot be forwarded to a running server")
+            resolve_args(args, Path(request["cwd"]))
+            if args.command in WRITE_COMMANDS:
+                run_command(args)
+            else:
+                with _STATE_LOCK:
+                    run_command(args)
+        except SystemExit as exc:
+            if isinstance(exc.code, int):
+                code = exc.code
+            elif exc.code is not None:
+                print(exc.code, file=sys.stderr)
+                code = 1
+        except Exception as exc:  # Keep serving; report the failure to this client.
+            print(f"{type(exc).__name__}: {exc}", file=sys.stderr)
+            code = 1
+    out.flush()
+    err.flush()
+    return code
+
+
+def serve(graph_path: str) -> None:
+    """Serve commands for graph_path over a Unix socket until interrupted.
+
+    The materialized graph stays in memory between requests and is brought
+    up to date with whatever was appended to the log, so each command costs
+    a tail replay instead of a full load. Each client gets its own thread:
+    reads take turns on the cached graph, while writes queue for a shared
+    group commit. Protocol: the client sends one JSON line
+    {"argv": [...], "cwd": "...", "stdin": "..."?}; the server streams
+    {"stdout": text} and {"stderr": text} lines and ends with {"exit": code}.
+    """
+    import signal
+    import socketserver
+    global _STATE_CACHE
+    
+    sock_file = Path(socket_path(graph_path))
+    if sock_file.exists():
+        if connect(sock_file) is not None:
+            raise SystemExit(f"Ontology server already running on {sock_file}")
+        sock_file.unlink()
+    
+    _STATE_CACHE = {}
+    load_graph_state(graph_path)
+    
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            line = self.rfile.readline()
+            if not line:
+                return
+            code = _run_forwarded(json.loads(line), self.wfile)
+            self.wfile.write((json.dumps({"exit": code}) + "\n").encode())
+    
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+        
+        def service_actions(self):
+            # Tail the log between requests so the next command finds it warm.
+            with _STATE_LOCK:
+                for path in list(_STATE_CACHE):
+                    try:
+                        load_graph_state(path)
+                    except Exception as exc:
+                        print(f"Refresh failed for {path}: {exc}", file=sys.stderr)
+    
+    old_umask = os.umask(0o177)
+    try:
+        server = Server(str(sock_file), Handler)
+    finally:
+        os.umask(old_umask)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    streams = sys.stdout, sys.stderr, sys.stdin
+    sys.stdout, sys.stderr, sys.stdin = (_ThreadStreams(stream) for stream in streams)
+    print(f"Serving {graph_path} on {sock_file}", file=sys.stderr)
+    try:
+        server.serve_forever(poll_interval=0.5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        sys.stdout, sys.stderr, sys.stdin = streams
+        sock_file.unlink(missing_ok=True)
+        _STATE_CACHE = None
+
+
+def _non_negative_int(value: str) -> int:
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must be >= 0, got {number}")
+    return number
+
+
+def add_output_args(parser: argparse.ArgumentParser) -> None:
+    """Add --format/--limit/--offset to a command that prints a result list."""
+    parser.add_argument("--format", choices=["json", "ndjson"], default="json",
+                        help="json: one indented array; ndjson: stream one result per line")
+    parser.add_argument("--limit", type=_non_negative_int, help="Maximum number of results")
+    parser.add_argument("--offset", type=_non_negative_int, default=0, help="Results to skip first")
+
+
+def add_as_of_arg(parser: argparse.ArgumentParser) -> None:
+    """Add --as-of to a command that reads the graph."""
+    parser.add_argument("--as-of", type=parse_as_of, metavar="OFFSET|TIMESTAMP",
+                        help="Read the graph as it was at a log byte offset or ISO timestamp")
+
+
+def add_graph_args(parser: argparse.ArgumentParser) -> None:
+    """Add --graph/--backend to a command that works on either storage backend."""
+    parser.add_argument("--graph", "-g", default=DEFAULT_GRAPH_PATH)
+    parser.add_argument("--backend", choices=["jsonl", "sqlite"], default=os.environ.get(BACKEND_ENV),
+                        help=f"Storage backend (default: ${BACKEND_ENV}, else by --graph suffix); "
+                             "sqlite uses the graph path with a .db suffix")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Build the CLI argument parser."""
+    parser = argparse.ArgumentParser(description="Ontology graph operations")
+    parser.add_argument("--stats", action="store_true", default=os.environ.get(STATS_ENV, "") not in ("", "0"),
+                        help=f"Print a per-phase timing breakdown to stderr (or set {STATS_ENV}=1)")
+    parser.add_argument("--profile", default=os.environ.get(PROFILE_ENV) or None, metavar="FILE",
+                        help=f"Write a cProfile dump of the command to FILE (or set {PROFILE_ENV})")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    
+    # Create
+    create_p = subparsers.add_parser("create", help="Create entity")
+    create_p.add_argument("--type", "-t", required=True, help="Entity type")
+    create_p.add_argument("--props", "-p", default="{}", help="Properties JSON")
+    create_p.add_argument("--id", help="Entity ID (auto-generated if not provided)")
+    add_graph_args(create_p)
+    
+    # Get
+    get_p = subparsers.add_parser("get", help="Get entity by ID")
+    get_p.add_argument("--id", required=True, help="Entity ID")
+    add_graph_args(get_p)
+    add_as_of_arg(get_p)
+    
+    # Query
+    query_p = subparsers.add_parser("query", help="Query entities")
+    query_p.add_argument("--type", "-t", help="Entity type")
+    query_p.add_argument("--where", "-w", default="{}",
+                         help='Filter JSON, e.g. {"status":"open","priority":{"$in":["high","urgent"]}}')
+    query_p.add_argument("--sort", help="Sort by property (entities without it come last)")
+    query_p.add_argument("--desc", action="store_true", help="Sort descending")
+    query_p.add_argument("--explain", action="store_true", help="Print the query plan instead of results")
+    add_graph_args(query_p)
+    add_as_of_arg(query_p)
+    add_output_args(query_p)
+    
+    # Aggregate
+    aggregate_p = subparsers.add_parser("aggregate", help="Count/group entities or summarize relation degrees")
+    aggregate_p.add_argument("--type", "-t", help="Entity type")
+    aggregate_p.add_argument("--where", "-w", default="{}", help="Filter JSON, as for query")
+    aggregate_p.add_argument("--group-by", default="",
+                             help='Comma-separated fields to group by: "type" and/or property names')
+    aggregate_p.add_argument("--distinct", default="",
+                             help="Comma-separated properties whose distinct values are counted per group")
+    aggregate_p.add_argument("--degrees", action="store_true", help="Degree statistics per relation type instead")
+    aggregate_p.add_argument("--rel", "-r", help="Relation type for --degrees")
+    aggregate_p.add_argument("--dir", "-d", choices=["outgoing", "incoming", "both"], default="both",
+                             help="Edge direction for --degrees")
+    add_graph_args(aggregate_p)
+    add_as_of_arg(aggregate_p)
+    add_output_args(aggregate_p)
+    
+    # Search
+    search_p = subparsers.add_parser("search", help="Full-text search over string properties")
+    search_p.add_argument("--query", "-q", required=True, help="Words to find; end a word with * for prefix matching")
+    search_p.add_argument("--type", "-t", help="Only entities of this type")
+    add_graph_args(search_p)
+    add_output_args(search_p)
+    
+    # List
+    list_p = subparsers.add_parser("list", help="List entities")
+    list_p.add_argument("--type", "-t", help="Entity type")
+    add_graph_args(list_p)
+    add_as_of_arg(list_p)
+    add_output_args(list_p)
+    
+    # Update
+    update_p = subparsers.add_parser("update", help="Update entity")
+    update_p.add_argument("--id", required=True, help="Entity ID")
+    update_p.add_argument("--props", "-p", required=True, help="Properties JSON")
+    add_graph_args(update_p)
+    
+    # Delete
+    delete_p = subparsers.add_parser("delete", help="Delete entity")
+    delete_p.add_argument("--id", required=True, help="Entity ID")
+    add_graph_args(delete_p)
+    
+    # Relate
+    relate_p = subparsers.add_parser("relate", help="Create relation")
+    relate_p.add_argument("--from", dest="from_id", required=True, help="From entity ID")
+    relate_p.add_argument("--rel", "-r", required=True, help="Relation type")
+    relate_p.add_argument("--to", dest="to_id", required=True, help="To entity ID")
+    relate_p.add_argument("--props", "-p", default="{}", help="Relation properties JSON")
+    relate_p.add_argument("--enforce", action="store_true",
+                          help="Reject the relation if it would violate the schema")
+    relate_p.add_argument("--schema", "-s", default=DEFAULT_SCHEMA_PATH)
+    add_graph_args(relate_p)
+    
+    # Related
+    related_p = subparsers.add_parser("related", help="Get related entities")
+    related_p.add_argument("--id", required=True, help="Entity ID")
+    related_p.add_argument("--rel", "-r", help="Relation type filter")
+    related_p.add_argument("--dir", "-d", choices=["outgoing", "incoming", "both"], default="outgoing")
+    add_graph_args(related_p)
+    add_as_of_arg(related_p)
+    add_output_args(related_p)
+    
+    # Traverse
+    traverse_p = subparsers.add_parser("traverse", help="Multi-hop walk from one or more entities")
+    traverse_p.add_argument("--id", required=True, action="append", help="Seed entity ID (repeatable)")
+    traverse_p.add_argument("--rel", "-r", action="append", help="Relation type filter (repeatable)")
+    traverse_p.add_argument("--dir", "-d", choices=["outgoing", "incoming", "both"], default="outgoing")
+    traverse_p.add_argument("--depth", type=_non_negative_int, default=3, help="Maximum hops (0 = unlimited)")
+    traverse_p.add_argument("--mode", choices=["bfs", "dfs"], default="bfs")
+    add_graph_args(traverse_p)
+    add_output_args(traverse_p)
+    
+    # Path
+    path_p = subparsers.add_parser("path", help="Shortest path between two entities")
+    path_p.add_argument("--from", dest="from_id", required=True, help="From entity ID")
+    path_p.add_argument("--to", dest="to_id", required=True, help="To entity ID")
+    path_p.add_argument("--rel", "-r", action="append", help="Relation type filter (repeatable)")
+    path_p.add_argument("--dir", "-d", choices=["outgoing", "incoming", "both"], default="outgoing")
+    path_p.add_argument("--max-depth", type=_non_negative_int, default=0, help="Maximum hops (0 = unlimited)")
+    add_graph_args(path_p)
+    
+    # Validate
+    validate_p = subparsers.add_parser("validate", help="Validate graph")
+    add_graph_args(validate_p)
+    validate_p.add_argument("--schema", "-s", default=DEFAULT_SCHEMA_PATH)
+    validate_p.add_argument("--incremental", "-i", action="store_true",
+                            help="Recheck only what changed since the last incremental run")
+
+    # Snapshot
+    snapshot_p = subparsers.add_parser("snapshot", help="Rebuild the graph snapshot now")
+    snapshot_p.add_argument("--graph", "-g", default=DEFAULT_GRAPH_PATH)
+
+    # Compact
+    compact_p = subparsers.add_parser("compact", help="Rewrite the log in its smallest equivalent form")
+    compact_p.add_argument("--graph", "-g", default=DEFAULT_GRAPH_PATH)
+
+    # Index
+    index_p = subparsers.add_parser("index", help="Manage (type, property) query indexes")
+    index_p.add_argument("action", choices=["add", "drop", "list"])
+    index_p.add_argument("--type", "-t", help="Entity type")
+    index_p.add_argument("--prop", help="Property name")
+    index_p.add_argument("--graph", "-g", default=DEFAULT_GRAPH_PATH)
+
+    # Batch
+    batch_p = subparsers.add_parser("batch", help="Apply NDJSON operations from stdin or a file in one write")
+    batch_p.add_argument("--file", "-f", help="NDJSON operations file (default: stdin)")
+    batch_p.add_argument("--atomic", action="store_true", help="Write nothing if any operation fails")
+    add_graph_args(batch_p)
+
+    # Watch
+    watch_p = subparsers.add_parser("watch", help="Stream log operations written after a cursor as NDJSON")
+    watch_p.add_argument("--cursor", "-c", help="Resume after this cursor (default: start of the log)")
+    watch_p.add_argument("--type", "-t", action="append", help="Entity type filter (repeatable)")
+    watch_p.add_argument("--rel", "-r", action="append", help="Relation type filter (repeatable)")
+    watch_p.add_argument("--follow", "-f", action="store_true", help="Keep polling for new operations")
+    watch_p.add_argument("--interval", type=float, default=1.0, help="Seconds between polls with --follow")
+    watch_p.add_argument("--graph", "-g", default=DEFAULT_GRAPH_PATH)
+
+    # Migrate / export between backends
+    migrate_p = subparsers.add_parser("migrate", help="Copy a JSONL graph into a new SQLite database")
+    migrate_p.add_argument("--graph", "-g", default=DEFAULT_GRAPH_PATH)
+    migrate_p.add_argument("--to", help="Database path (default: the graph path with a .db suffix)")
+    migrate_p.add_argument("--force", action="store_true", help="Replace an existing database")
+    export_p = subparsers.add_parser("export", help="Write a SQLite graph back out as a JSONL log")
+    add_graph_args(export_p)
+    export_p.add_argument("--to", help="JSONL path (default: the database path with a .jsonl suffix)")
+    export_p.add_argument("--force", action="store_true", help="Replace an existing file")
+
+    # Serve
+    serve_p = subparsers.add_parser("serve", help="Keep the graph in memory and answer commands over a Unix socket")
+    serve_p.add_argument("--graph", "-g", default=DEFAULT_GRAPH_PATH)
+
+    # Schema append
+    schema_p = subparsers.add_parser("schema-append", help="Append/merge schema fragment")
+    schema_p.add_argument("--schema", "-s", default=DEFAULT_SCHEMA_PATH)
+    schema_p.add_argument("--data", "-d", help="Schema fragment as JSON")
+    schema_p.add_argument("--file", "-f", help="Schema fragment file (YAML or JSON)")
+
+    return parser
+
+
+def resolve_args(args: argparse.Namespace, root: Path | None = None) -> None:
+    """Resolve user-supplied paths inside the workspace root (default: cwd)."""
+    workspace_root = (root or Path.cwd()).resolve()
+
+    if hasattr(args, "graph"):
+        args.graph = str(
+            resolve_safe_path(args.graph, root=workspace_root, label="graph path")
+        )
+        backend = getattr(args, "backend", None)
+        if backend == "sqlite" or args.command == "export":
+            args.graph = str(sqlite_path(args.graph))
+        elif backend == "jsonl" and is_sqlite(args.graph):
+            raise SystemExit(f"--backend jsonl cannot use SQLite database {args.graph}")
+    if getattr(args, "profile", None):
+        args.profile = str(resolve_safe_path(args.profile, root=workspace_root, label="profile path"))
+    if getattr(args, "to", None):
+        args.to = str(resolve_safe_path(args.to, root=workspace_root, label="target path"))
+    if hasattr(args, "schema"):
+        args.schema = str(
+            resolve_safe_path(args.schema, root=workspace_root, label="schema path")
+        )
+    if hasattr(args, "file") and args.file:
+        label = "batch file" if args.command == "batch" else "schema file"
+        args.file = str(
+            resolve_safe_path(
+                args.file, root=workspace_root, must_exist=True, label=label
+            )
+        )
+
+
+def run_command(args: argparse.Namespace) -> None:
+    """Execute a parsed command, printing its result to stdout."""
+    if hasattr(args, "graph") and is_sqlite(args.graph) and args.command in JSONL_ONLY_COMMANDS:
+        raise SystemExit(f"{args.command} works on the JSONL log only, not {args.graph}")
+    
+    if args.command == "create":
+        props = json.loads(args.props)
+        entity = create_entity(args.type, props, args.graph, args.id)
+        print(json.dumps(entity, indent=2))
+    
+    elif args.command == "get":
+        entity = get_entity(args.id, args.graph, args.as_of)
+        if entity:
+            print(json.dumps(entity, indent=2))
+        else:
+            print(f"Entity not found: {args.id}")
+    
+    elif args.command == "query":
+        where = json.loads(args.where)
+        # With --sort, keep only the rows that survive --offset/--limit (top-k).
+        top = None if args.limit is None else args.offset + args.limit
+        if args.explain:
+            plan = explain_query(args.type, where, args.graph, args.sort, args.desc, top, args.as_of)
+            print(json.dumps(plan, indent=2))
+        else:
+            results = iter_query(args.type, where, args.graph, args.sort, args.desc, top, args.as_of)
+            print_results(results, args.format, args.limit, args.offset)
+    
+    elif args.command == "aggregate":
+        if args.degrees:
+            results = degree_stats(args.graph, args.rel, args.dir, args.as_of)
+        else:
+            group_by = [field.strip() for field in args.group_by.split(",") if field.strip()]
+            distinct = [prop.strip() for prop in args.distinct.split(",") if prop.strip()]
+            results = aggregate_entities(args.graph, args.type, json.loads(args.where), group_by, distinct,
+                                         args.as_of)
+        print_results(results, args.format, args.limit, args.offset)
+    
+    elif args.command == "search":
+        top = None if args.limit is None else args.offset + args.limit
+        results = search_entities(args.query, args.graph, args.type, top)
+        print_results(results, args.format, args.limit, args.offset)
+    
+    elif args.command == "list":
+        results = iter_entities(args.type, args.graph, args.as_of)
+        print_results(results, args.format, args.limit, args.offset)
+    
+    elif args.command == "update":
+        props = json.loads(args.props)
+        entity = update_entity(args.id, props, args.graph)
+        if entity:
+            print(json.dumps(entity, indent=2))
+        else:
+            print(f"Entity not found: {args.id}")
+    
+    elif args.command == "delete":
+        if delete_entity(args.id, args.graph):
+            print(f"Deleted: {args.id}")
+        else:
+            print(f"Entity not found: {args.id}")
+    
+    elif args.command == "relate":
+        props = json.loads(args.props)
+        rel = create_relation(args.from_id, args.rel, args.to_id, props, args.graph,
+                              args.enforce, args.schema)
+        print(json.dumps(rel, indent=2))
+    
+    elif args.command == "related":
+        results = iter_related(args.id, args.rel, args.graph, args.dir, args.as_of)
+        print_results(results, args.format, args.limit, args.offset)
+    
+    elif args.command == "traverse":
+        results = traverse(args.id, args.rel, args.graph, args.dir, args.depth or None, args.mode)
+        print_results(results, args.format, args.limit, args.offset)
+    
+    elif args.command == "path":
+        path = find_path(args.from_id, args.to_id, args.rel, args.graph, args.dir, args.max_depth or None)
+        if path:
+            print(json.dumps(path, indent=2))
+        else:
+            print(f"No path found: {args.from_id} -> {args.to_id}")
+    
+    elif args.command == "validate":
+        if args.incremental:
+            errors, info = validate_graph_incremental(args.graph, args.schema)
+            print(f"Validated ({info['mode']}): {info['entities']} entities, "
+                  f"{info['relations']} relations checked", file=sys.stderr)
+        else:
+            errors = validate_graph(args.graph, args.schema)
+        if errors:
+            print("Validation errors:")
+            for err in errors:
+                print(f"  - {err}")
+        else:
+            print("Graph is valid.")
+    
+    elif args.command == "snapshot":
+        print(json.dumps(refresh_snapshot(args.graph), indent=2))
+    
+    elif args.command == "compact":
+        print(json.dumps(compact_graph(args.graph), indent=2))
+    
+    elif args.command == "index":
+        if args.action == "list":
+            specs = load_index_specs(args.graph)
+        elif not args.type or not args.prop:
+            raise SystemExit(f"index {args.action} requires --type and --prop")
+        elif args.action == "add":
+            specs = add_index(args.graph, args.type, args.prop)
+        else:
+            specs = drop_index(args.graph, args.type, args.prop)
+        print(json.dumps([{"type": t, "property": p} for t, p in specs], indent=2))
+    
+    elif args.command == "batch":
+        if args.file:
+            with open(args.file) as f:
+                results, written = apply_batch(f, args.graph, args.atomic)
+        else:
+            results, written = apply_batch(sys.stdin, args.graph, args.atomic)
+        for result in results:
+            print(json.dumps(result))
+        failed = sum(1 for result in results if not result["ok"])
+        print(f"Applied {written} of {len(results)} operations ({failed} failed)", file=sys.stderr)
+        if failed:
+            raise SystemExit(1)
+    
+    elif args.command == "watch":
+        changes = watch_changes(args.graph, args.cursor, args.type, args.rel, args.follow, args.interval)
+        try:
+            for change in changes:
+                print(json.dumps(change))
+                if "cursor" in change:
+                    sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+    
+    elif args.command == "migrate":
+        print(json.dumps(migrate_to_sqlite(args.graph, args.to, args.force), indent=2))
+    
+    elif args.command == "export":
+        print(json.dumps(export_jsonl(args.graph, args.to, args.force), indent=2))
+    
+    elif args.command == "serve":
+        serve(args.graph)
+    
+    elif args.command == "schema-append":
+        if not args.data and not args.file:
+            raise SystemExit("schema-append requires --data or --file")
+        
+        incoming = {}
+        if args.data:
+            incoming = json.loads(args.data)
+        else:
+            path = Path(args.file)
+            if path.suffix.lower() == ".json":
+                with open(path) as f:
+                    incoming = json.load(f)
+            else:
+                import yaml
+                with open(path) as f:
+                    incoming = yaml.safe_load(f) or {}
+        
+        merged = append_schema(args.schema, incoming)
+        print(json.dumps(merged, indent=2))
+
+
+def run_measured(args: argparse.Namespace) -> None:
+    """run_command under --stats and/or --profile; reports go to stderr."""
+    global _STATS
+    if args.stats:
+        _STATS = CommandStats()
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+    try:
+        if profiler:
+            profiler.runcall(run_command, args)
+        else:
+            run_command(args)
+    finally:
+        sys.stdout.flush()
+        if profiler:
+            profiler.dump_stats(args.profile)
+            print(f"Profile written to {args.profile} (python3 -m pstats {args.profile})", file=sys.stderr)
+        if _STATS is not None:
+            report, _STATS = _STATS.report(args.command), None
+            print(json.dumps({"stats": report}, indent=2), file=sys.stderr)
+
+
+def main(argv: list = None):
+    """Run a command in this process (ontology_client.main tries the server first)."""
+    args = build_parser().parse_args(argv)
+    resolve_args(args)
+    
+    if args.command == "serve" or not (args.stats or args.profile):
+        run_command(args)
+    else:
+        run_measured(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,649 @@
+"""Tests for ontology.py: each fast load/validate path against a plain full replay,
+plus behavior tests for the query and write commands."""
+
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+
+SCRIPTS = Path(__file__).resolve().parent.parent / "scripts"
+sys.path.insert(0, str(SCRIPTS))
+import ontology_client  # noqa: E402
+import ontology_core as ontology  # noqa: E402
+
+SCHEMA = """\
+types:
+  Person:
+    required: [name]
+  Task:
+    required: [title, status]
+    status_enum: [open, done]
+relations:
+  assigned_to:
+    from_types: [Task]
+    to_types: [Person]
+    cardinality: many_to_one
+  blocks:
+    from_types: [Task]
+    to_types: [Task]
+    acyclic: true
+"""
+
+START = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture(autouse=True)
+def isolated_env(monkeypatch):
+    for name in (ontology.WORKERS_ENV, ontology.LAZY_PROPERTIES_ENV, ontology.COMPACT_STORE_ENV,
+                 ontology.SNAPSHOT_THRESHOLD_ENV, ontology.CHECKPOINT_BYTES_ENV):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv(ontology.WORKERS_ENV, "1")
+
+
+def make_records(count: int, seed: int = 7, start: int = 0) -> list:
+    """A log mixing every op: updates, deletes, parallel and interleaved edges, unrelates."""
+    rng = random.Random(seed)
+    records = []
+    ids = []
+    for n in range(start, start + count):
+        stamp = (START + timedelta(seconds=n)).isoformat()
+        roll = rng.random()
+        if roll < 0.3 or len(ids) < 4:
+            type_name = rng.choice(["Person", "Task"])
+            entity_id = f"{type_name.lower()}_{n}"
+            if type_name == "Person":
+                properties = {"name": f"person {n}"} if rng.random() < 0.9 else {}
+            else:
+                properties = {"title": f"task {n}", "status": rng.choice(["open", "done", "stuck"])}
+            ids.append(entity_id)
+            entity = {"id": entity_id, "type": type_name, "properties": properties,
+                      "created": stamp, "updated": stamp}
+            records.append({"op": "create", "entity": entity, "timestamp": stamp})
+        elif roll < 0.4:
+            records.append({"op": "update", "id": rng.choice(ids), "properties": {"note": n},
+                            "timestamp": stamp})
+        elif roll < 0.45:
+            records.append({"op": "delete", "id": rng.choice(ids), "timestamp": stamp})
+        elif roll < 0.9:
+            records.append({"op": "relate", "from": rng.choice(ids), "rel": rng.choice(["assigned_to", "blocks"]),
+                            "to": rng.choice(ids), "properties": {"n": n}, "timestamp": stamp})
+        else:
+            edge = rng.choice([r for r in records if r["op"] == "relate"] or [None])
+            if edge is not None:
+                records.append({"op": "unrelate", "from": edge["from"], "rel": edge["rel"],
+                                "to": edge["to"], "timestamp": stamp})
+    return records
+
+
+def write_log(path: Path, records: list, mode: str = "w") -> None:
+    with open(path, mode) as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+def full_replay(records: list) -> tuple[dict, list]:
+    """The reference semantics: apply every record in order to plain dicts and lists."""
+    entities, relations = {}, []
+    for record in json.loads(json.dumps(records)):
+        op = record["op"]
+        if op == "create":
+            entities[record["entity"]["id"]] = record["entity"]
+        elif op == "update":
+            if record["id"] in entities:
+                entities[record["id"]]["properties"].update(record.get("properties", {}))
+                entities[record["id"]]["updated"] = record.get("timestamp")
+        elif op == "delete":
+            entities.pop(record["id"], None)
+        elif op == "relate":
+            relations.append({"from": record["from"], "rel": record["rel"], "to": record["to"],
+                              "properties": record.get("properties", {})})
+        elif op == "unrelate":
+            key = (record["from"], record["rel"], record["to"])
+            relations = [r for r in relations if (r["from"], r["rel"], r["to"]) != key]
+    return entities, relations
+
+
+def state(graph) -> tuple[dict, list]:
+    return {entity_id: graph.entities[entity_id] for entity_id in graph.entities}, graph.relations
+
+
+def line_ends(path: Path) -> list:
+    ends, offset = [], 0
+    with open(path, "rb") as f:
+        for line in f:
+            offset += len(line)
+            ends.append(offset)
+    return ends
+
+
+@pytest.fixture
+def log(tmp_path):
+    path = tmp_path / "graph.jsonl"
+    records = make_records(600)
+    write_log(path, records)
+    return path, records
+
+
+def test_serve_answers_forwarded_commands(tmp_path, capsys, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path = tmp_path / "graph.jsonl"
+    person = ontology.create_entity("Person", {"name": "Alice"}, str(path))
+    server = subprocess.Popen([sys.executable, str(SCRIPTS / "ontology.py"), "serve", "--graph", str(path)],
+                              cwd=tmp_path, stderr=subprocess.DEVNULL)
+    try:
+        sock_file = ontology_client.socket_path(os.path.realpath(path))
+        for _ in range(100):
+            if ontology_client.connect(sock_file) is not None:
+                break
+            time.sleep(0.05)
+        graph_path = ontology_client.server_graph(["get", "--id", person["id"], "--graph", str(path)])
+        assert graph_path == os.path.realpath(path)
+        code = ontology_client.forward_to_server(graph_path, ["get", "--id", person["id"], "--graph", str(path)])
+        assert code == 0
+        assert json.loads(capsys.readouterr().out)["properties"] == {"name": "Alice"}
+        batch = json.dumps({"op": "create", "type": "Person", "properties": {"name": "Bob"}}) + "\n"
+        assert ontology_client.forward_to_server(graph_path, ["batch", "--graph", str(path)], batch) == 0
+        capsys.readouterr()
+        ontology_client.forward_to_server(graph_path, ["get", "--id", "nobody", "--graph", str(path)])
+        assert capsys.readouterr().out == "Entity not found: nobody\n"
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+    assert sorted(e["properties"]["name"] for e in ontology.list_entities("Person", str(path))) == ["Alice", "Bob"]
+    assert ontology_client.forward_to_server(os.path.realpath(path), ["list", "--graph", str(path)]) is None
+
+
+def test_parallel_load_matches_full_replay(log, monkeypatch):
+    path, records = log
+    monkeypatch.setenv(ontology.WORKERS_ENV, "3")
+    monkeypatch.setattr(ontology, "PARALLEL_MIN_BYTES", 1)
+    monkeypatch.setattr(ontology, "PARALLEL_CHUNK_BYTES", 4096)
+    assert state(ontology.load_graph_state(str(path))) == full_replay(records)
+
+
+def test_parallel_parse_survives_the_file_being_replaced(log, monkeypatch):
+    path, records = log
+    monkeypatch.setenv(ontology.WORKERS_ENV, "2")
+    monkeypatch.setattr(ontology, "PARALLEL_MIN_BYTES", 1)
+    monkeypatch.setattr(ontology, "PARALLEL_CHUNK_BYTES", 4096)
+    graph = ontology.Graph()
+    with open(path, "rb") as f:
+        end = os.fstat(f.fileno()).st_size
+        replacement = path.with_name("replacement.jsonl")
+        write_log(replacement, make_records(600, seed=10))
+        os.replace(replacement, path)
+        for record in ontology.iter_records(f, 0, end):
+            graph.apply(record)
+    assert state(graph) == full_replay(records)
+
+
+def make_chain(path: Path, edges: list) -> dict:
+    """Create one Person per letter in edges and relate them with "r"; returns letter -> id."""
+    ids = {}
+    for a, b in edges:
+        for letter in (a, b):
+            if letter not in ids:
+                ids[letter] = ontology.create_entity("Person", {"name": letter}, str(path))["id"]
+    for a, b in edges:
+        ontology.create_relation(ids[a], "r", ids[b], {}, str(path))
+    return ids
+
+
+@pytest.mark.parametrize("order", ["bfs", "dfs"])
+def test_traverse_reaches_everything_within_the_depth_limit(tmp_path, order):
+    path = tmp_path / "graph.jsonl"
+    # dfs meets B first at depth 2 (via C), then again at depth 1; D is only
+    # within reach of the shorter path.
+    ids = make_chain(path, [("A", "C"), ("A", "B"), ("C", "B"), ("B", "D")])
+    names = {entity_id: letter for letter, entity_id in ids.items()}
+    reached = {names[step["entity"]["id"]]: step["depth"]
+               for step in ontology.traverse([ids["A"]], ["r"], str(path), max_depth=2, order=order)}
+    assert set(reached) == {"B", "C", "D"}
+    assert reached["D"] == 2
+    reached = [names[step["entity"]["id"]]
+               for step in ontology.traverse([ids["A"]], ["r"], str(path), max_depth=1, order=order)]
+    assert sorted(reached) == ["B", "C"]
+
+
+def test_path_is_the_shortest_within_the_depth_limit(tmp_path):
+    path = tmp_path / "graph.jsonl"
+    ids = make_chain(path, [("A", "B"), ("B", "C"), ("C", "D"), ("A", "C")])
+    found = ontology.find_path(ids["A"], ids["D"], ["r"], str(path))
+    assert found["ids"] == [ids["A"], ids["C"], ids["D"]]
+    assert found["length"] == 2
+    assert ontology.find_path(ids["A"], ids["D"], ["r"], str(path), max_depth=1) is None
+    assert ontology.find_path(ids["D"], ids["A"], ["r"], str(path)) is None
+    found = ontology.find_path(ids["D"], ids["A"], ["r"], str(path), direction="both")
+    assert found["ids"] == [ids["D"], ids["C"], ids["A"]]
+
+
+def test_compact_store_load_matches_full_replay(log, monkeypatch):
+    path, records = log
+    monkeypatch.setenv(ontology.COMPACT_STORE_ENV, "1")
+    graph = ontology.load_graph_state(str(path))
+    assert isinstance(graph.entities, ontology.CompactEntities)
+    assert state(graph) == full_replay(records)
+
+
+@pytest.mark.parametrize("created, updated", [
+    (1700000000, 1700000000),
+    (1700000000, "2026-01-01T00:00:00+00:00"),
+    ("2026-01-01T00:00:00+00:00", 0),
+    ("2026-01-01T00:00:00Z", "2026-01-01 00:00:00+00:00"),
+    ("2026-01-01T02:00:00+02:00", None),
+    ("yesterday", 1.5),
+])
+def test_compact_store_keeps_timestamps_as_given(created, updated):
+    entities = ontology.CompactEntities()
+    entity = {"id": "p_1", "type": "Person", "properties": {"name": "A"}, "created": created, "updated": updated}
+    entities["p_1"] = entity
+    assert entities["p_1"] == entity
+    assert type(entities["p_1"]["created"]) is type(created)
+    assert type(entities["p_1"]["updated"]) is type(updated)
+
+
+def test_snapshot_load_matches_full_replay(log):
+    path, records = log
+    ontology.refresh_snapshot(str(path))
+    more = make_records(200, seed=8, start=600)
+    write_log(path, more, "a")
+    graph = ontology.load_graph_state(str(path))
+    assert graph.base_offset > 0
+    assert state(graph) == full_replay(records + more)
+
+
+def test_snapshot_missing_records_is_ignored(log):
+    path, records = log
+    ontology.refresh_snapshot(str(path))
+    snap_file = ontology.snapshot_path(str(path))
+    lines = snap_file.read_text().splitlines(keepends=True)
+    # Drop one create record: the header's counts no longer match.
+    first_create = next(n for n, line in enumerate(lines) if '"op": "create"' in line)
+    snap_file.write_text("".join(lines[:first_create] + lines[first_create + 1:]))
+    graph = ontology.load_graph_state(str(path))
+    assert graph.base_offset == 0
+    assert state(graph) == full_replay(records)
+
+
+def test_rewrites_leave_no_temp_files(log, tmp_path):
+    path, records = log
+    schema_path = path.with_name("schema.yaml")
+    schema_path.write_text(SCHEMA)
+    ontology.refresh_snapshot(str(path))
+    ontology.validate_graph_incremental(str(path), str(schema_path))
+    ontology.compact_graph(str(path))
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+    assert os.stat(path).st_mode & 0o777 == 0o666 & ~ontology._UMASK
+
+
+def test_stats_report_snapshot_phases_only_when_one_was_loaded(log, monkeypatch):
+    path, records = log
+    monkeypatch.setattr(ontology, "_STATS", ontology.CommandStats())
+    ontology.load_graph_state(str(path))
+    phases = ontology._STATS.report("list")["phases"]
+    assert "snapshot.apply" not in phases
+    assert "log.apply" in phases
+    ontology.refresh_snapshot(str(path))
+    monkeypatch.setattr(ontology, "_STATS", ontology.CommandStats())
+    ontology.load_graph_state(str(path))
+    phases = ontology._STATS.report("list")["phases"]
+    assert {"snapshot.read", "snapshot.parse", "snapshot.apply"} <= set(phases)
+
+
+def test_as_of_matches_replay_of_the_prefix(log, monkeypatch):
+    path, records = log
+    monkeypatch.setenv(ontology.CHECKPOINT_BYTES_ENV, "1")
+    # A checkpoint halfway through, so later offsets start from it.
+    write_log(path, records[:300])
+    ontology.refresh_snapshot(str(path))
+    write_log(path, records[300:], "a")
+    ends = line_ends(path)
+    for count in (0, 1, 150, 300, 301, 450, 600):
+        offset = ends[count - 1] if count else 0
+        assert state(ontology.load_graph_state(str(path), as_of=offset)) == full_replay(records[:count])
+    # An offset inside a line covers only the lines before it.
+    assert state(ontology.load_graph_state(str(path), as_of=ends[449] + 3)) == full_replay(records[:450])
+    moment = ontology.parse_as_of(records[449]["timestamp"])
+    assert state(ontology.load_graph_state(str(path), as_of=moment)) == full_replay(records[:450])
+
+
+def test_as_of_before_a_compaction_is_refused(log):
+    path, records = log
+    ontology.compact_graph(str(path))
+    last = ontology.parse_as_of(records[-1]["timestamp"])
+    assert state(ontology.load_graph_state(str(path), as_of=last)) == full_replay(records)
+    with pytest.raises(SystemExit, match="compacted"):
+        ontology.load_graph_state(str(path), as_of=last - timedelta(seconds=1))
+    later = ontology.create_entity("Person", {"name": "later"}, str(path))
+    moment = ontology.parse_as_of(later["created"])
+    assert later["id"] in ontology.load_graph_state(str(path), as_of=moment).entities
+    assert later["id"] not in ontology.load_graph_state(str(path), as_of=last).entities
+
+
+def test_concurrent_writers_stamp_records_in_log_order(tmp_path):
+    import threading
+    path = str(tmp_path / "graph.jsonl")
+    people = [ontology.create_entity("Person", {"name": str(n)}, path) for n in range(2)]
+
+    def write(n):
+        for _ in range(20):
+            ontology.create_entity("Task", {"title": str(n), "status": "open"}, path)
+            ontology.create_relation(people[0]["id"], "knows", people[1]["id"], {}, path)
+
+    threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with open(path) as f:
+        stamps = [json.loads(line)["timestamp"] for line in f]
+    assert len(stamps) == 2 + 4 * 40
+    assert stamps == sorted(stamps)
+
+
+def test_compacted_log_loads_the_same_state(log):
+    path, records = log
+    ontology.compact_graph(str(path))
+    assert state(ontology.load_graph_state(str(path))) == full_replay(records)
+
+
+def test_plain_load_matches_full_replay(log):
+    path, records = log
+    assert state(ontology.load_graph_state(str(path))) == full_replay(records)
+
+
+def test_relations_keep_relate_order_across_unrelates(tmp_path):
+    path = tmp_path / "graph.jsonl"
+    records = make_records(40)
+    ids = [r["entity"]["id"] for r in records if r["op"] == "create"]
+    edges = [(ids[n % 3], "blocks", ids[(n + 1) % 3]) for n in range(9)]
+    for n, (a, rel, b) in enumerate(edges):
+        records.append({"op": "relate", "from": a, "rel": rel, "to": b, "properties": {"n": n}})
+        if n == 4:
+            records.append({"op": "unrelate", "from": edges[1][0], "rel": rel, "to": edges[1][2]})
+    write_log(path, records)
+    assert ontology.load_graph_state(str(path)).relations == full_replay(records)[1]
+
+
+def test_batch_applies_valid_operations_in_one_write(tmp_path):
+    path = str(tmp_path / "graph.jsonl")
+    lines = [
+        json.dumps({"op": "create", "id": "p_1", "type": "Person", "props": {"name": "Alice"}}),
+        json.dumps({"op": "update", "id": "p_1", "props": {"role": "lead"}}),
+        json.dumps({"op": "create", "id": "t_1", "type": "Task", "props": {"title": "x", "status": "open"}}),
+        json.dumps({"op": "relate", "from": "t_1", "rel": "assigned_to", "to": "p_1"}),
+        json.dumps({"op": "update", "id": "missing", "props": {}}),
+        "not json",
+        "",
+        json.dumps({"op": "delete", "id": "t_1"}),
+    ]
+    results, written = ontology.apply_batch(lines, path)
+    assert written == 5
+    assert [result["ok"] for result in results] == [True, True, True, True, False, False, True]
+    assert results[4]["error"] == "Entity not found: missing"
+    assert results[6]["line"] == 8
+    graph = ontology.load_graph_state(path)
+    assert list(graph.entities) == ["p_1"]
+    assert graph.entities["p_1"]["properties"] == {"name": "Alice", "role": "lead"}
+    assert len(graph.relations) == 1
+
+
+def test_atomic_batch_writes_nothing_on_any_failure(tmp_path):
+    path = tmp_path / "graph.jsonl"
+    lines = [
+        json.dumps({"op": "create", "id": "p_1", "type": "Person", "props": {"name": "Alice"}}),
+        json.dumps({"op": "relate", "from": "p_1", "rel": "knows"}),
+    ]
+    results, written = ontology.apply_batch(lines, str(path), atomic=True)
+    assert written == 0
+    assert results[1] == {"line": 2, "ok": False, "error": "relate requires to"}
+    assert not path.exists() or path.read_text() == ""
+
+
+def test_incremental_validation_matches_full_validation(log):
+    path, records = log
+    schema_path = path.with_name("schema.yaml")
+    schema_path.write_text(SCHEMA)
+    errors, info = ontology.validate_graph_incremental(str(path), str(schema_path))
+    assert info["mode"] == "full"
+    assert errors == ontology.validate_graph(str(path), str(schema_path))
+    assert errors
+    write_log(path, make_records(200, seed=9, start=600), "a")
+    errors, info = ontology.validate_graph_incremental(str(path), str(schema_path))
+    assert info["mode"] == "incremental"
+    assert errors == ontology.validate_graph(str(path), str(schema_path))
+
+
+def make_tasks(path: Path) -> list:
+    tasks = []
+    for n, (status, priority) in enumerate([("open", 3), ("done", 1), ("open", "high"), ("stuck", 2),
+                                            ("open", None), ("done", 5), ("open", 2)]):
+        properties = {"title": f"task {n}", "status": status}
+        if priority is not None:
+            properties["priority"] = priority
+        tasks.append(ontology.create_entity("Task", properties, str(path), f"task_{n}"))
+    ontology.create_entity("Person", {"name": "Alice", "status": "open"}, str(path))
+    return tasks
+
+
+@pytest.mark.parametrize("indexed", [False, True])
+@pytest.mark.parametrize("where, expected", [
+    ({"status": "open"}, [0, 2, 4, 6]),
+    ({"status": {"$in": ["done", "stuck"]}}, [1, 3, 5]),
+    ({"status": {"$nin": ["open"]}, "priority": {"$gte": 2}}, [3, 5]),
+    ({"priority": {"$gt": 1, "$lt": 5}}, [0, 3, 6]),
+    ({"priority": {"$exists": False}}, [4]),
+    ({"priority": {"$ne": 2}, "status": "open"}, [0, 2, 4]),
+    ({"title": {"$prefix": "task 1"}}, [1]),
+])
+def test_where_operators(tmp_path, indexed, where, expected):
+    path = tmp_path / "graph.jsonl"
+    make_tasks(path)
+    if indexed:
+        ontology.add_index(str(path), "Task", "status")
+    found = [entity["id"] for entity in ontology.iter_query("Task", where, str(path))]
+    assert found == [f"task_{n}" for n in expected]
+    plan = ontology.explain_query("Task", where, str(path))
+    status = where.get("status")
+    uses_index = indexed and (isinstance(status, str) or isinstance(status, dict) and "$in" in status)
+    assert plan["access"] == ("index" if uses_index else "scan")
+
+
+def test_where_rejects_unknown_operators(tmp_path):
+    with pytest.raises(SystemExit, match=r"unknown operator \$like"):
+        ontology.parse_where({"title": {"$like": "x"}})
+    with pytest.raises(SystemExit, match=r"\$in on 'status' needs a list"):
+        ontology.parse_where({"status": {"$in": "open"}})
+
+
+def test_sort_orders_numbers_then_strings_and_missing_last(tmp_path):
+    path = tmp_path / "graph.jsonl"
+    make_tasks(path)
+    ids = lambda **kwargs: [e["id"] for e in ontology.iter_query("Task", {}, str(path), sort="priority", **kwargs)]
+    assert ids() == ["task_1", "task_3", "task_6", "task_0", "task_5", "task_2", "task_4"]
+    assert ids(descending=True) == ["task_2", "task_5", "task_0", "task_3", "task_6", "task_1", "task_4"]
+    assert ids(top=2) == ["task_1", "task_3"]
+    assert ids(descending=True, top=3) == ["task_2", "task_5", "task_0"]
+
+
+def watch(path: Path, cursor: str = None, **kwargs) -> tuple[list, str]:
+    """(operations, final cursor) of one non-following watch pass."""
+    ops, position = [], None
+    for item in ontology.watch_changes(str(path), cursor, **kwargs):
+        if "cursor" in item:
+            position = item["cursor"]
+        else:
+            ops.append(item)
+    return ops, position
+
+
+def test_watch_resumes_from_its_cursor(tmp_path):
+    path = tmp_path / "graph.jsonl"
+    person = ontology.create_entity("Person", {"name": "Alice"}, str(path))
+    ops, cursor = watch(path)
+    assert [op["op"] for op in ops] == ["create"]
+    assert watch(path, cursor) == ([], cursor)
+    task = ontology.create_entity("Task", {"title": "x", "status": "open"}, str(path))
+    ontology.create_relation(task["id"], "assigned_to", person["id"], {}, str(path))
+    ontology.update_entity(person["id"], {"role": "lead"}, str(path))
+    ops, later = watch(path, cursor)
+    assert [op["op"] for op in ops] == ["create", "relate", "update"]
+    assert later != cursor
+    # Filters: an update is matched by the type of an entity created before the cursor.
+    assert [op["op"] for op in watch(path, cursor, types=["Person"])[0]] == ["update"]
+    assert [op["op"] for op in watch(path, cursor, rels=["assigned_to"])[0]] == ["relate"]
+
+
+def test_watch_aligns_a_bare_offset_to_its_line(tmp_path):
+    path = tmp_path / "graph.jsonl"
+    records = make_records(20)
+    write_log(path, records)
+    ends = line_ends(path)
+    ops, _ = watch(path, str(ends[9] + 5))
+    assert ops == records[10:]
+    ops, _ = watch(path, str(ends[9]))
+    assert ops == records[10:]
+
+
+def test_watch_resets_after_the_log_is_rewritten(tmp_path):
+    path = tmp_path / "graph.jsonl"
+    ontology.create_entity("Person", {"name": "Alice"}, str(path))
+    ontology.create_entity("Person", {"name": "Bob"}, str(path))
+    _, cursor = watch(path)
+    ontology.compact_graph(str(path))
+    ops, _ = watch(path, cursor)
+    assert ops[0] == {"reset": True}
+    assert [op["entity"]["properties"]["name"] for op in ops[1:]] == ["Alice", "Bob"]
+
+
+def test_sqlite_backend_matches_the_jsonl_log(log, tmp_path):
+    path, records = log
+    db = tmp_path / "graph.db"
+    assert ontology.migrate_to_sqlite(str(path), str(db))["entities"] == len(full_replay(records)[0])
+    try:
+        assert state(ontology.load_graph_state(str(db))) == full_replay(records)
+        for graph_path in (str(path), str(db)):
+            person = ontology.create_entity("Person", {"name": "Zed"}, graph_path, "person_zed")
+            ontology.create_relation("person_zed", "knows", records[0]["entity"]["id"], {}, graph_path)
+            ontology.update_entity(person["id"], {"age": 40}, graph_path)
+            ontology.delete_entity(records[0]["entity"]["id"], graph_path)
+        jsonl_entities, jsonl_relations = state(ontology.load_graph_state(str(path)))
+        db_entities, db_relations = state(ontology.load_graph_state(str(db)))
+        strip = lambda entities: {k: {**v, "created": None, "updated": None} for k, v in entities.items()}
+        assert strip(db_entities) == strip(jsonl_entities)
+        assert db_relations == jsonl_relations
+        for where in ({"status": "open"}, {"name": {"$prefix": "person 1"}}, {"note": {"$gte": 300}}):
+            found = [e["id"] for e in ontology.iter_query(None, where, str(path))]
+            assert found
+            assert [e["id"] for e in ontology.iter_query(None, where, str(db))] == found
+        # Replacing the database drops cached connections to the old file.
+        ontology.migrate_to_sqlite(str(path), str(db), force=True)
+        assert state(ontology.load_graph_state(str(db))) == state(ontology.load_graph_state(str(path)))
+        exported = tmp_path / "exported.jsonl"
+        ontology.export_jsonl(str(db), str(exported))
+        assert state(ontology.load_graph_state(str(exported))) == state(ontology.load_graph_state(str(path)))
+    finally:
+        ontology._close_sqlite_graphs(str(db))
+
+
+def test_lazy_load_matches_full_replay(log, monkeypatch):
+    path, records = log
+    monkeypatch.setenv(ontology.LAZY_PROPERTIES_ENV, "1")
+    monkeypatch.setattr(ontology, "LAZY_MIN_BYTES", 1)
+    graph = ontology.load_graph_state(str(path))
+    assert isinstance(graph.entities, ontology.LazyEntities)
+    assert state(graph) == full_replay(records)
+
+
+def test_lazy_properties_survive_a_snapshot_and_updates(log, monkeypatch):
+    path, records = log
+    monkeypatch.setenv(ontology.LAZY_PROPERTIES_ENV, "1")
+    monkeypatch.setattr(ontology, "LAZY_MIN_BYTES", 1)
+    ontology.refresh_snapshot(str(path))
+    more = make_records(100, seed=11, start=600)
+    write_log(path, more, "a")
+    graph = ontology.load_graph_state(str(path))
+    assert graph.base_offset > 0
+    assert state(graph) == full_replay(records + more)
+
+
+def test_relate_enforce_rejects_schema_violations(tmp_path):
+    path = str(tmp_path / "graph.jsonl")
+    schema_path = tmp_path / "schema.yaml"
+    schema_path.write_text(SCHEMA)
+    alice = ontology.create_entity("Person", {"name": "Alice"}, path)["id"]
+    bob = ontology.create_entity("Person", {"name": "Bob"}, path)["id"]
+    tasks = [ontology.create_entity("Task", {"title": str(n), "status": "open"}, path)["id"] for n in range(3)]
+    relate = lambda a, rel, b: ontology.create_relation(a, rel, b, {}, path, enforce=True,
+                                                        schema_path=str(schema_path))
+    relate(tasks[0], "assigned_to", alice)
+    relate(tasks[1], "assigned_to", alice)
+    with pytest.raises(SystemExit, match="violates cardinality many_to_one"):
+        relate(tasks[0], "assigned_to", bob)
+    with pytest.raises(SystemExit, match="Relation rejected"):
+        relate(alice, "assigned_to", tasks[2])
+    relate(tasks[0], "blocks", tasks[1])
+    relate(tasks[1], "blocks", tasks[2])
+    with pytest.raises(SystemExit, match="would create a cycle"):
+        relate(tasks[2], "blocks", tasks[0])
+    # An unrelate frees the slot and breaks the cycle again.
+    ontology.apply_batch([json.dumps({"op": "unrelate", "from": tasks[0], "rel": "assigned_to", "to": alice}),
+                          json.dumps({"op": "unrelate", "from": tasks[1], "rel": "blocks", "to": tasks[2]})], path)
+    relate(tasks[0], "assigned_to", bob)
+    relate(tasks[2], "blocks", tasks[0])
+    assert len(ontology.load_graph_state(path).relations) == 4
+    assert ontology.validate_graph(path, str(schema_path)) == []
+
+
+def test_search_ranks_matches_and_follows_writes(tmp_path):
+    path = str(tmp_path / "graph.jsonl")
+    ids = {}
+    for name, text in [("a", "graph database index"), ("b", "graph graph graph"), ("c", "indexing notes"),
+                       ("d", "unrelated words")]:
+        ids[name] = ontology.create_entity("Task", {"title": text, "status": "open"}, path)["id"]
+    ontology.create_entity("Person", {"name": "Graph Person"}, path)
+    found = lambda query, **kwargs: [hit["id"] for hit in ontology.search_entities(query, path, **kwargs)]
+    assert found("graph", type_name="Task") == [ids["b"], ids["a"]]
+    assert len(found("graph")) == 3
+    assert set(found("index*")) == {ids["a"], ids["c"]}
+    assert found("graph", type_name="Task", top=1) == [ids["b"]]
+    assert found("nothing") == []
+    # The index catches up with what was appended since it was last synced.
+    ontology.update_entity(ids["d"], {"title": "graph words"}, path)
+    ontology.delete_entity(ids["b"], path)
+    assert set(found("graph", type_name="Task")) == {ids["a"], ids["d"]}
+    incremental = ontology.search_entities("graph words index*", path)
+    ontology.search_index_path(path).unlink()
+    assert ontology.search_entities("graph words index*", path) == incremental
+
+
+def test_aggregate_counts_zero_with_and_without_an_index(tmp_path):
+    path = str(tmp_path / "graph.jsonl")
+    person = ontology.create_entity("Person", {"name": "Alice"}, path)
+    ontology.delete_entity(person["id"], path)
+    assert ontology.aggregate_entities(path, "Person") == [{"count": 0}]
+    ontology.add_index(path, "Person", "name")
+    assert ontology.aggregate_entities(path, "Person") == [{"count": 0}]
+
+
+@pytest.mark.parametrize("indexed", [False, True])
+def test_aggregate_groups_match_a_plain_count(tmp_path, indexed):
+    path = tmp_path / "graph.jsonl"
+    make_tasks(path)
+    if indexed:
+        ontology.add_index(str(path), "Task", "status")
+    rows = ontology.aggregate_entities(str(path), "Task", group_by=["status"], distinct=["priority"])
+    assert rows == [
+        {"group": {"status": "open"}, "count": 4, "distinct": {"priority": 3}},
+        {"group": {"status": "done"}, "count": 2, "distinct": {"priority": 2}},
+        {"group": {"status": "stuck"}, "count": 1, "distinct": {"priority": 1}},
+    ]
+    assert ontology.aggregate_entities(str(path), "Task", where={"status": "open"}) == [{"count": 4}]
+    assert ontology.aggregate_entities(str(path), group_by=["type"]) == [
+        {"group": {"type": "Task"}, "count": 7}, {"group": {"type": "Person"}, "count": 1}]